@@ -39,3 +39,4 @@ from geometric import ClockwiseConstraint
 from geometric import NotCounterClockwiseConstraint
 from geometric import NotClockwiseConstraint
 
+from clsolver import CostScheduler
@@ -4,22 +4,24 @@ This module provides basic functionality for
 ClusterSolver2D and ClusterSolver3D.
 """
 
+import itertools
 from graph import Graph
 from method import Method, MethodGraph
-from diagnostic import diag_print
-from notify import Notifier
+from diagnostic import diag_print, diag_selected
+from notify import Notifier, Listener
 from multimethod import MultiVariable, MultiMethod
 from cluster import *
-from configuration import Configuration
-from gmatch import gmatch
+from configuration import Configuration, equal_configurations, configurations_size
+from gmatch import compile_pattern, imatch
 from method import OrMethod,SetMethod
 from incremental import IncrementalSet,MutableSet,Union,Filter
+from icpm import PatternMatches
 
 # --------------------------------------------------
 # ---------- ClusterSolver main class --------------
 # --------------------------------------------------
 
-class ClusterSolver(Notifier):
+class ClusterSolver(Notifier, Listener):
     """ 
     Finds a generic solution for problems formulated by Clusters.
 
@@ -38,13 +40,26 @@ class ClusterSolver(Notifier):
 
     # ------- PUBLIC METHODS --------
 
-    def __init__(self, methodclasses):
-        """Create a new solver, using the given subclasses of ClusterMethod."""
+    def __init__(self, methodclasses, pattern_network=False):
+        """Create a new solver, using the given subclasses of ClusterMethod.
+           If pattern_network is True, methods with a patterngraph and no
+           incremental_matcher are matched incrementally by a network of 
+           partial matches (see icpm.PatternMatches), else these methods are 
+           matched by graph matching from each new cluster."""
         # init superclasses
         Notifier.__init__(self)
+        Listener.__init__(self)
         # store arguments
         self._methodclasses = methodclasses
         self._pattern_methods = filter(lambda m: hasattr(m,"patterngraph"),self._methodclasses)
+        if pattern_network:
+            self._network_methods = filter(lambda m: not hasattr(m,"incremental_matcher"),self._pattern_methods)
+            self._pattern_methods = filter(lambda m: m not in self._network_methods,self._pattern_methods)
+        else:
+            self._network_methods = []
+        self._compiled_patterns = {}
+        for methodclass in self._pattern_methods:
+            self._compiled_patterns[methodclass] = compile_pattern(methodclass.patterngraph)
         self._handcoded_methods = filter(lambda m: hasattr(m,"handcoded_match"),self._methodclasses)
         self._incremental_methods = filter(lambda m: hasattr(m,"incremental_matcher"),self._methodclasses)
         # init instance vars
@@ -54,8 +69,15 @@ class ClusterSolver(Notifier):
         self._graph.add_vertex("_variables")
         self._graph.add_vertex("_clusters")
         self._graph.add_vertex("_methods")
+        # adjacency maps for each label of the edges in the graph, 
+        # mapping label to a pair of (outgoing, ingoing) maps from vertex to set of vertices
+        self._adjacency = {"dependency":({},{}), "contains":({},{}), "needed_by":({},{})}
+        # maps from point variables to clusters, grouped by kind (see cluster_kind)
+        self._cluster_index = {}
+        self._toplevel_index = {}
         self._new = []
-        self._mg = MethodGraph()
+        # compare configurations by point positions, for early cutoff of propagation
+        self._mg = MethodGraph(equal_configurations)
         # add prototype_selection boolean var to method graph
         self._prototype_selection_var = "_prototype_selection_enabled"
         self._mg.add_variable(self._prototype_selection_var)
@@ -68,8 +90,33 @@ class ClusterSolver(Notifier):
         self._toplevel = MutableSet()
         # incrementally updated set of applicable methods
         self._incremental_matchers = map(lambda method: method.incremental_matcher(self), self._incremental_methods)
+        self._incremental_matchers += map(lambda method: PatternMatches(graph2pattern(method.patterngraph), self, method), self._network_methods)
         #print "incremental matchers:",self._incremental_matchers
         self._applicable_methods = Union(*self._incremental_matchers)
+        # cached redundancy of applicable methods, invalidated when the 
+        # top-level clusters on the variables of their output cluster change
+        self._redundancy_cache = {}
+        self._redundancy_index = {}
+        self._redundancy_stats = {"checked":0, "skipped":0}
+        # map from clusters to the applicable deferred methods on them
+        self._deferred_index = {}
+        # map from clusters to maps from constraints (see source_key) to 
+        # source clusters, invalidated when clusters are removed
+        self._source_cache = {}
+        self._toplevel.add_listener(self)
+        self._applicable_methods.add_listener(self)
+        # nesting depth of begin_batch/commit calls
+        self._batch_depth = 0
+        # scheduler to choose between applicable methods (see set_scheduler)
+        self._scheduler = None
+        # select solutions in merges (see set_fused_selection)
+        self._fused_selection = False
+        # maximum number of solutions of merges (see set_max_solutions)
+        self._max_solutions = None
+        # merges without limit on their number of solutions (see lift_max_solutions)
+        self._lifted_methods = set()
+        # number of solutions nearest to prototype kept by merges (see set_solution_beam)
+        self._solution_beam = None
 
     # ------- methods for setting up constraint problems ------------
     
@@ -77,31 +124,192 @@ class ClusterSolver(Notifier):
         """Add a cluster"""
         diag_print("add_cluster "+str(cluster), "clsolver")
         self._add_cluster(cluster)
-        self._process_new()
+        if not self.in_batch():
+            self._process_new()
 
     def remove(self, cluster):
         """Remove a cluster. 
            All dependend objects are also removed.
         """
         self._remove(cluster)
-        self._process_new()
+        if not self.in_batch():
+            self._process_new()
 
     def set(self, cluster, configurations):
         """Associate a list of configurations with a cluster"""
-        self._mg.set(cluster, configurations)
+        self._mg.set(cluster, configurations, not self.in_batch())
         
     def get(self, cluster):
         """Return a set of configurations associated with a cluster"""
         return self._mg.get(cluster)
  
+    def is_stale(self, cluster):
+        """True iff the configurations of the cluster will be computed when 
+           requested with get (only in lazy mode, see set_lazy)"""
+        return self._mg.is_stale(cluster)
+
+    def set_lazy(self, lazy):
+        """Enable (True) or disable (False) lazy evaluation. In lazy mode, 
+           the configurations of a cluster are computed when requested with 
+           get, by executing only the methods that the cluster depends on 
+           (see MethodGraph.set_lazy)."""
+        self._mg.set_lazy(lazy, not self.in_batch())
+
+    def is_lazy(self):
+        """True iff lazy evaluation is enabled (see set_lazy)"""
+        return self._mg.is_lazy()
+
+    def set_memory_budget(self, budget):
+        """Bound the memory used by the configurations of clusters that are not 
+           top-level and not the root cluster to approximately budget bytes. The 
+           least recently used configurations are dropped and computed again when 
+           requested with get. If budget is None, memory is not bounded, but still
+           measured (see store_stats and MethodGraph.set_budget)."""
+        self._mg.set_budget(budget, configurations_size, self._is_evictable)
+
+    def get_memory_budget(self):
+        """Returns the budget set with set_memory_budget, or None"""
+        return self._mg.get_budget()
+
+    def store_stats(self):
+        """Return a dictionary with the memory used by configurations and the number 
+           of configurations dropped and computed again (see MethodGraph.store_stats)"""
+        return self._mg.store_stats()
+
+    def set_executor(self, executor):
+        """Set the executor used to execute methods that do not depend on each
+           other, e.g. the merges of sibling clusters (see method.ThreadExecutor 
+           and method.ProcessExecutor). If executor is None (the default), 
+           methods are executed one after another."""
+        self._mg.set_executor(executor)
+
+    def get_executor(self):
+        """Returns the executor set with set_executor, or None"""
+        return self._mg.get_executor()
+
+    def set_fused_selection(self, fused):
+        """If fused is True, merges added from now on select their solutions 
+           themselves, by prototype and by selection constraints, instead of 
+           adding a PrototypeMethod and a SelectionMethod, each with a copy of 
+           the output cluster (see ClusterMethod.fuse_selection). 
+           The solutions are the same, with fewer clusters and methods."""
+        self._fused_selection = fused
+
+    def is_fused_selection(self):
+        """True iff merges select their solutions (see set_fused_selection)"""
+        return self._fused_selection
+
+    def set_max_solutions(self, max_solutions):
+        """Limit the number of solutions of each merge to max_solutions, or 
+           None (the default) for no limit. Merges stop generating solutions 
+           when the limit is reached (see MultiMethod.set_max_solutions), 
+           so the solutions kept depend on the order in which they are found. 
+           The first solutions of different merges may not be compatible, so 
+           a cluster may have no configurations (see lift_max_solutions). 
+           The limit applies to all merges, including lifted merges."""
+        self._max_solutions = max_solutions
+        self._lifted_methods.clear()
+        for method in self.methods():
+            if isinstance(method, ClusterMethod):
+                method.set_max_solutions(max_solutions)
+                self._mg.execute(method, False)
+        if not self.in_batch():
+            self._mg.propagate()
+
+    def get_max_solutions(self):
+        """Returns the limit set with set_max_solutions, or None"""
+        return self._max_solutions
+
+    def lift_max_solutions(self, cluster):
+        """Lift the limit on the number of solutions of the merges that a cluster 
+           depends on and that reached their limit, nearest first, one level of 
+           merges at a time, until the cluster has configurations or no merge 
+           that it depends on is limited. The lifted merges keep all their 
+           solutions until set_max_solutions is called (see lifted_methods). 
+           Returns the configurations of the cluster."""
+        if self.in_batch():
+            raise StandardError, "cannot lift limits of merges in a batch"
+        configurations = self._mg.get(cluster)
+        level = [cluster]
+        visited = set()
+        while configurations != None and len(configurations) == 0 and len(level) > 0:
+            lifted = False
+            inputs = []
+            for object in level:
+                method = self._determining_method(object)
+                if method == None or method in visited:
+                    continue
+                visited.add(method)
+                inputs += filter(lambda var: isinstance(var, Cluster), method.inputs())
+                if not isinstance(method, ClusterMethod) or method.get_max_solutions() == None:
+                    continue
+                output = self._mg.get(method.outputs()[0])
+                if output != None and len(output) >= method.get_max_solutions():
+                    diag_print("lifting max solutions of "+str(method), "clsolver")
+                    method.set_max_solutions(None)
+                    self._lifted_methods.add(method)
+                    self._mg.execute(method, False)
+                    lifted = True
+            if lifted:
+                self._mg.propagate()
+                configurations = self._mg.get(cluster)
+            level = inputs
+        return configurations
+
+    def lifted_methods(self):
+        """Returns the merges whose limit was lifted with lift_max_solutions 
+           since the last call of set_max_solutions"""
+        return list(self._lifted_methods)
+
+    def set_solution_beam(self, width):
+        """Keep only the width solutions of each merge that are nearest to the 
+           prototype (see prototype_distance), or all solutions if width is None 
+           (the default). The point clusters with the prototypes of the variables 
+           of a merge become inputs of the merge when a beam is first set."""
+        self._solution_beam = width
+        for method in self.methods():
+            if isinstance(method, ClusterMethod):
+                self._set_solution_beam(method)
+                self._mg.execute(method, False)
+        if not self.in_batch():
+            self._mg.propagate()
+
+    def get_solution_beam(self):
+        """Returns the width set with set_solution_beam, or None"""
+        return self._solution_beam
+
+    def prototype_distance(self, configuration):
+        """Returns the root mean square distance between the points of a configuration 
+           and their prototypes, after the best rigid alignment. The prototype of a 
+           point is the configuration of its point cluster."""
+        prototype = {}
+        for var in configuration.vars():
+            for cluster in self.find_clusters(var, "point"):
+                configurations = self.get(cluster)
+                if configurations != None and len(configurations) > 0:
+                    prototype.update(iter(configurations).next().map)
+        if len(prototype) == 0:
+            return 0.0
+        return configuration.rms_distance(Configuration(prototype))
+
+    def set_scheduler(self, scheduler):
+        """Set the scheduler that chooses which of the applicable methods is 
+           applied first (see CostScheduler). If scheduler is None (the default), 
+           the first method found is applied."""
+        self._scheduler = scheduler
+
+    def get_scheduler(self):
+        """Returns the scheduler set with set_scheduler, or None"""
+        return self._scheduler
+
     def set_root(self, cluster):
         """Set root cluster, used for positionig and orienting the solutions"""
         diag_print("set root "+str(self._rootcluster), "clsolver")
         if self._rootcluster != None:
             oldrootvar = rootname(self._rootcluster)
-            self._mg.set(oldrootvar, False)
+            self._mg.set(oldrootvar, False, not self.in_batch())
         newrootvar = rootname(cluster)
-        self._mg.set(newrootvar, True)
+        self._mg.set(newrootvar, True, not self.in_batch())
         self._rootcluster = cluster
 
     def get_root(self):
@@ -110,7 +318,7 @@ class ClusterSolver(Notifier):
    
     def set_prototype_selection(self, enabled):
         """Enable or disable prototype-based solution selection"""
-        self._mg.set(self._prototype_selection_var, enabled)
+        self._mg.set(self._prototype_selection_var, enabled, not self.in_batch())
 
     def add_selection_constraint(self, con):
         """Add a SelectionConstraint to filter solutions"""
@@ -119,7 +327,7 @@ class ClusterSolver(Notifier):
             if selector != None:
                 selector.add_constraint(con)
                 self._selection_method[con] = selector
-                self._mg.execute(selector)                
+                self._mg.execute(selector, not self.in_batch())
             #self._selection_method[con] = None     # this line wrong?
             self._selection_method[con] = selector     # this line better?
 
@@ -129,22 +337,55 @@ class ClusterSolver(Notifier):
             selector = self._selection_method[con]
             if selector != None:
                 selector.rem_constraint(con)
-                self._mg.execute(selector)                
+                self._mg.execute(selector, not self.in_batch())
             del self._selection_method[con] 
 
+    # ------- batch editing ------------
+
+    def begin_batch(self):
+        """Start a batch of edits. 
+
+           Until the matching commit, added and removed clusters are not 
+           searched for new methods and configurations are not propagated.
+           Batches may be nested; only the outermost commit takes effect.
+        """
+        self._batch_depth += 1
+
+    def commit(self):
+        """End a batch of edits started with begin_batch.
+
+           Searches all new clusters for methods and then propagates
+           all pending configuration changes once. 
+        """
+        if self._batch_depth == 0:
+            raise StandardError, "commit without begin_batch"
+        if self._batch_depth == 1:
+            diag_print("commit batch", "clsolver")
+            try:
+                self._process_new()
+            finally:
+                self._batch_depth = 0
+            self._mg.propagate()
+        else:
+            self._batch_depth -= 1
+
+    def in_batch(self):
+        """Returns True iff begin_batch was called without matching commit"""
+        return self._batch_depth > 0
+
     # ------- methods for inspecting the state of the solver ------------
     
     def variables(self):
         """get list of variables"""
-        return self._graph.outgoing_vertices("_variables")
+        return self._adjacent("contains", "_variables")
 
     def clusters(self):
         """get list of clusters"""
-        return self._graph.outgoing_vertices("_clusters")
+        return self._adjacent("contains", "_clusters")
 
     def methods(self):
         """get list of methods"""
-        return self._graph.outgoing_vertices("_methods")
+        return self._adjacent("contains", "_methods")
 
     def top_level(self):
         """return IncrementalSet of top-level clusters"""
@@ -158,16 +399,77 @@ class ClusterSolver(Notifier):
 
     def find_dependend(self, object):
         """Return a list of objects that depend on given object directly."""
-        l = self._graph.outgoing_vertices(object)
-        return filter(lambda x: self._graph.get(object,x) == "dependency", l)
+        return self._adjacent("dependency", object)
         
     def find_depends(self, object):
         """Return a list of objects that the given object depends on directly"""
-        l = self._graph.ingoing_vertices(object)
-        return filter(lambda x: self._graph.get(x,object) == "dependency", l)
+        return self._adjacent("dependency", object, False)
+
+    def find_clusters(self, var, kinds=None):
+        """Return a list of clusters on given point variable.
+           If kinds is given (a kind or a list of kinds, see cluster_kind),
+           only clusters of those kinds are returned."""
+        return self._lookup(self._cluster_index, var, kinds)
+
+    def find_top_level(self, var, kinds=None):
+        """Return a list of top-level clusters on given point variable.
+           If kinds is given (a kind or a list of kinds, see cluster_kind),
+           only clusters of those kinds are returned."""
+        return self._lookup(self._toplevel_index, var, kinds)
+
+    def find_top_level_in(self, var, incrset):
+        """Return a list of top-level clusters on given point variable that are also in 
+           the given IncrementalSet. If incrset has an attribute 'kinds', only clusters 
+           of those kinds are considered."""
+        kinds = getattr(incrset, "kinds", None)
+        return filter(lambda c: c in incrset, self.find_top_level(var, kinds))
 
     def contains(self, obj):
         return self._graph.has_vertex(obj)
+
+    def redundancy_stats(self):
+        """Return a dictionary with the number of redundancy checks done ("checked") 
+           and the number of checks skipped because a cached result was used ("skipped")"""
+        return dict(self._redundancy_stats)
+
+    def propagation_stats(self):
+        """Return a dictionary with the number of propagations of configurations
+           and the number of method executions (see MethodGraph.propagation_stats)"""
+        return self._mg.propagation_stats()
+
+    # ------- notifications from incremental sets ------------
+
+    def receive_notify(self, source, message):
+        """Keep the redundancy cache up to date with the top-level 
+           clusters and the applicable methods"""
+        (action, object) = message
+        if source == self._applicable_methods:
+            for var in object.outputs()[0].vars:
+                if action == "add":
+                    if var not in self._redundancy_index:
+                        self._redundancy_index[var] = set()
+                    self._redundancy_index[var].add(object)
+                elif var in self._redundancy_index:
+                    self._redundancy_index[var].discard(object)
+                    if len(self._redundancy_index[var]) == 0:
+                        del self._redundancy_index[var]
+            if object in self._redundancy_cache:
+                del self._redundancy_cache[object]
+            if object.deferred:
+                for cluster in object.input_clusters():
+                    if action == "add":
+                        if cluster not in self._deferred_index:
+                            self._deferred_index[cluster] = set()
+                        self._deferred_index[cluster].add(object)
+                    elif cluster in self._deferred_index:
+                        self._deferred_index[cluster].discard(object)
+                        if len(self._deferred_index[cluster]) == 0:
+                            del self._deferred_index[cluster]
+        elif source == self._toplevel:
+            for var in object.vars:
+                for method in self._redundancy_index.get(var, []):
+                    if method in self._redundancy_cache:
+                        del self._redundancy_cache[method]
     
     # ------------ INTERNALLY USED METHODS --------
 
@@ -175,37 +477,117 @@ class ClusterSolver(Notifier):
 
     def _add_dependency(self, on, dependend):
         """Add a dependence for second object on first object"""
-        self._graph.add_edge(on, dependend, "dependency")
+        self._add_edge(on, dependend, "dependency")
 
     def _add_to_group(self, group, object):
         """Add object to group"""
-        self._graph.add_edge(group, object, "contains")
+        self._add_edge(group, object, "contains")
 
     def _add_needed_by(self, needed, by):
         """Add relation 'needed' object is needed 'by'"""
-        self._graph.add_edge(needed, by, "needed_by")
+        self._add_edge(needed, by, "needed_by")
 
     def _objects_that_need(self, needed):
         """Return objects needed by given object"""
-        l = self._graph.outgoing_vertices(needed)
-        return filter(lambda x: self._graph.get(needed,x) == "needed_by", l)
+        return self._adjacent("needed_by", needed)
 
     def _objects_needed_by(self, needer):
         """Return objects needed by given object"""
-        l = self._graph.ingoing_vertices(needer)
-        return filter(lambda x: self._graph.get(x,needer) == "needed_by", l)
+        return self._adjacent("needed_by", needer, False)
+
+    def _add_edge(self, v1, v2, label):
+        """Add an edge with given label to the graph and the adjacency maps.
+           An existing edge is not changed."""
+        if not self._graph.has_edge(v1, v2):
+            self._graph.add_edge(v1, v2, label)
+            (outgoing, ingoing) = self._adjacency[label]
+            if v1 not in outgoing:
+                outgoing[v1] = set()
+            outgoing[v1].add(v2)
+            if v2 not in ingoing:
+                ingoing[v2] = set()
+            ingoing[v2].add(v1)
+
+    def _rem_vertex(self, v):
+        """Remove a vertex and its edges from the graph, the adjacency maps and cluster index"""
+        self._graph.rem_vertex(v)
+        for (outgoing, ingoing) in self._adjacency.values():
+            for (map1, map2) in [(outgoing, ingoing), (ingoing, outgoing)]:
+                if v in map1:
+                    for w in map1[v]:
+                        map2[w].remove(v)
+                        if len(map2[w]) == 0:
+                            del map2[w]
+                    del map1[v]
+        if isinstance(v, Cluster):
+            self._unindex_cluster(self._cluster_index, v)
+
+    def _adjacent(self, label, v, outgoing=True):
+        """Return a list of vertices connected to v by edges with given label"""
+        if outgoing:
+            map = self._adjacency[label][0]
+        else:
+            map = self._adjacency[label][1]
+        if v in map:
+            return list(map[v])
+        else:
+            return []
+
+    def _index_cluster(self, index, cluster):
+        """Add cluster to a map from variables to clusters by kind"""
+        kind = cluster_kind(cluster)
+        for var in cluster.vars:
+            if var not in index:
+                index[var] = {}
+            if kind not in index[var]:
+                index[var][kind] = set()
+            index[var][kind].add(cluster)
+
+    def _unindex_cluster(self, index, cluster):
+        """Remove cluster from a map from variables to clusters by kind"""
+        kind = cluster_kind(cluster)
+        for var in cluster.vars:
+            if var in index and kind in index[var]:
+                index[var][kind].discard(cluster)
+                if len(index[var][kind]) == 0:
+                    del index[var][kind]
+                    if len(index[var]) == 0:
+                        del index[var]
+
+    def _lookup(self, index, var, kinds):
+        """Return a list of clusters in index on var of given kinds (all kinds if None)"""
+        if var not in index:
+            return []
+        bykind = index[var]
+        if kinds == None:
+            kinds = bykind.keys()
+        elif isinstance(kinds, str):
+            kinds = [kinds]
+        result = []
+        for kind in kinds:
+            if kind in bykind:
+                result.extend(bykind[kind])
+        return result
    
     def _add_top_level(self, cluster):
         # self._graph.add_edge("_toplevel",cluster)
         self._new.append(cluster)
+        if cluster not in self._toplevel:
+            self._index_cluster(self._toplevel_index, cluster)
         self._toplevel.add(cluster)
 
     def _rem_top_level(self, object):
         # self._graph.rem_edge("_toplevel",object)
         if object in self._new:
             self._new.remove(object)
+        if object in self._toplevel:
+            self._unindex_cluster(self._toplevel_index, object)
         self._toplevel.remove(object)
 
+    def _is_evictable(self, var):
+        """True iff the configurations of var may be dropped (see set_memory_budget)"""
+        return isinstance(var, Cluster) and var not in self._toplevel and var is not self._rootcluster
+
     def _find_descendend(self,v):
         """find all descendend objects of v (i.e.. directly or indirectly dependend)"""
         front = [v]
@@ -233,6 +615,7 @@ class ClusterSolver(Notifier):
             raise StandardError, "cluster %s already in clsolver"%(str(newcluster))
         # update graph
         self._add_to_group("_clusters", newcluster)
+        self._index_cluster(self._cluster_index, newcluster)
         for var in newcluster.vars:
             self._add_variable(var)
             self._add_dependency(var, newcluster)
@@ -244,7 +627,7 @@ class ClusterSolver(Notifier):
         root = rootname(newcluster)
         if not self._mg.contains(root):
             self._mg.add_variable(root, False)
-            self._mg.set(root, False)
+            self._mg.set(root, False, not self.in_batch())
             # add root-variable to dependency graph
             self._add_dependency(newcluster, root)
         # if there is no root cluster, this one will be it
@@ -261,27 +644,33 @@ class ClusterSolver(Notifier):
         for obj in method.outputs():
             self._add_dependency(method, obj)
             self._add_dependency(obj, method)
-        self._mg.add_method(method)
+        if isinstance(method, ClusterMethod):
+            method.set_max_solutions(self._max_solutions)
+            self._set_solution_beam(method)
+        self._mg.add_method(method, not self.in_batch())
         self.send_notify(("add", method))
     
     # ----- solution selection
 
-    def _add_prototype_selector(self, merge):
-        incluster = merge.outputs()[0]
-        constraints = merge.prototype_constraints()
+    def _find_prototype_clusters(self, constraints):
+        """Returns the point clusters with the prototype of the variables of the constraints"""
         vars = set()
         for con in constraints:
             vars.update(con.variables())
         selclusters = []
         for var in vars:
-            clusters = self._graph.outgoing_vertices(var)
-            clusters = filter(lambda c: isinstance(c, Rigid), clusters)
-            clusters = filter(lambda c: len(c.vars) == 1, clusters)
+            clusters = self.find_clusters(var, "point")
             if len(clusters) < 1:
                 raise StandardError, "no prototype cluster for variable "+str(var)
             elif len(clusters) > 1:
                 raise StandardError, "more than one candidate prototype cluster for variable "+str(var)
             selclusters.append(clusters[0])
+        return selclusters
+
+    def _add_prototype_selector(self, merge):
+        incluster = merge.outputs()[0]
+        constraints = merge.prototype_constraints()
+        selclusters = self._find_prototype_clusters(constraints)
         outcluster = incluster.copy()
         selector = PrototypeMethod(incluster, selclusters, outcluster, constraints, self._prototype_selection_var)
         self._add_cluster(outcluster)
@@ -301,12 +690,39 @@ class ClusterSolver(Notifier):
         self._rem_top_level(incluster)
         return selector
 
+    def _set_solution_beam(self, merge):
+        """Set the solution beam of a merge, adding the point clusters of its 
+           variables as inputs if needed (see set_solution_beam)"""
+        if self._solution_beam != None and not merge.has_prototype_inputs():
+            protoclusters = []
+            for var in merge.outputs()[0].vars:
+                protoclusters += self.find_clusters(var, "point")
+            protoclusters = filter(lambda c: c not in merge.inputs(), protoclusters)
+            # the inputs of a method in the method graph must not change
+            added = self._mg.contains(merge)
+            if added:
+                self._mg.rem_method(merge)
+            merge.set_prototype_inputs(protoclusters)
+            for cluster in protoclusters:
+                self._add_dependency(cluster, merge)
+            if added:
+                self._mg.add_method(merge, False)
+        merge.set_beam(self._solution_beam)
+
+    def _fuse_selection(self, merge):
+        constraints = merge.prototype_constraints()
+        selclusters = self._find_prototype_clusters(constraints)
+        merge.fuse_selection(selclusters, constraints, self._prototype_selection_var)
+        for con in self._find_selection_constraints(merge.outputs()[0]): 
+            merge.add_constraint(con)
+            self._selection_method[con] = merge
+
     def _find_selection_method(self, con):
         # find clusters containing all constraints vars
         candidates = None
         for var in con.variables():
             # find clusters
-            clusters = set(self.find_dependend(var))
+            clusters = set(self.find_clusters(var))
             if candidates == None:
                 candidates = clusters
             else:
@@ -314,10 +730,10 @@ class ClusterSolver(Notifier):
         # get selection methods of clusters
         methods = []
         for cluster in candidates:
-            methods += filter(lambda c: isinstance(c,SelectionMethod), self.find_depends(cluster))
+            methods += filter(is_selection_method, self.find_depends(cluster))
         # get selection method with smallest cluster
         if len(methods)>0:
-            method = min(methods, key=lambda m: len(m.inputs()[0].vars))
+            method = min(methods, key=lambda m: len(m.outputs()[0].vars))
             return method
         else:
             return None
@@ -351,11 +767,10 @@ class ClusterSolver(Notifier):
  
     def _process_new(self):
         # try incremental matchers and old style matching alternatingly
-        non_redundant_methods = filter(lambda m: not self._is_redundant_method(m), self._applicable_methods)
-        while len(non_redundant_methods) > 0 or len(self._new) > 0:
+        method = self._find_non_redundant_method()
+        while method != None or len(self._new) > 0:
             # check incremental matches
-            if len(non_redundant_methods) > 0:  
-                method = iter(non_redundant_methods).next()
+            if method != None:
                 #print "applicable methods:", map(str, self._applicable_methods)
                 diag_print("incremental search found:"+str(method),"clsolver._process_new")
                 self._add_method_complete(method)
@@ -368,9 +783,22 @@ class ClusterSolver(Notifier):
                     self._new.append(newobject)
                 #endif
             # endif
-            non_redundant_methods = filter(lambda m: not self._is_redundant_method(m), self._applicable_methods)
+            method = self._find_non_redundant_method()
         # endwhile
     #end def
+
+    def _find_non_redundant_method(self):
+        """Returns the applicable method that is not deferred, not redundant 
+           and is ranked highest by the scheduler, or the first one found if 
+           there is no scheduler, or None. Only methods that are not in the 
+           redundancy cache are checked."""
+        if self._scheduler != None:
+            candidates = filter(lambda m: not m.deferred and not self._is_redundant_method(m), self._applicable_methods)
+            return self._scheduler.select(self, candidates)
+        for method in self._applicable_methods:
+            if not method.deferred and not self._is_redundant_method(method):
+                return method
+        return None
     
     def _search(self, newcluster):
         diag_print("search from:"+str(newcluster),"clsolver3D")
@@ -378,17 +806,23 @@ class ClusterSolver(Notifier):
         # via one or more variables
         connected = set()
         for var in newcluster.vars:
-            dependend = self.find_dependend(var)
-            dependend = filter(lambda x: self.is_top_level(x), dependend)
-            connected.update(dependend)
+            connected.update(self.find_top_level(var))
         diag_print("search: connected clusters="+str(connected),"clsolver3D")
         
         # first try handcoded matching
-        for methodclass in self._handcoded_methods:
-            diag_print("trying handcoded match for "+str(methodclass), "clsolver3D")
-            matches = methodclass.handcoded_match(self, newcluster, connected)
-            if self._try_matches(methodclass, matches):
+        if self._scheduler != None:
+            if self._try_scheduled(newcluster, connected):
                 return True
+        else:
+            for methodclass in self._handcoded_methods:
+                diag_print("trying handcoded match for "+str(methodclass), "clsolver3D")
+                matches = methodclass.handcoded_match(self, newcluster, connected)
+                if self._try_matches(methodclass, matches):
+                    return True
+
+        # then try deferred incremental matches
+        if self._try_deferred(newcluster, connected):
+            return True
 
         # if incremental matching failed, try full pattern matching
         if self._try_methods(connected):
@@ -396,6 +830,50 @@ class ClusterSolver(Notifier):
         return False
 
 
+    def _try_scheduled(self, newcluster, connected):
+        """applies the handcoded matches on newcluster in the order given by the 
+           scheduler, until one is successfully added. Returns True iff successfull"""
+        candidates = []
+        for methodclass in self._handcoded_methods:
+            matches = methodclass.handcoded_match(self, newcluster, connected)
+            candidates.extend(map(methodclass, matches))
+        while len(candidates) > 0:
+            method = self._scheduler.select(self, candidates)
+            diag_print("try scheduled: "+str(method),"clsolver3D")
+            if self._add_method_complete(method):
+                return True
+            candidates.remove(method)
+        return False
+
+    def _try_deferred(self, newcluster, connected):
+        """applies the deferred applicable methods on the connected clusters, in the 
+           order given by the scheduler, or else in the order of the method classes, 
+           of the number of constraints shared by their inputs and output, and of 
+           creation of their input clusters, until one is successfully added. 
+           Returns True iff successfull"""
+        candidates = set()
+        for cluster in connected:
+            for method in self._deferred_index.get(cluster, []):
+                if set(method.input_clusters()).issubset(connected):
+                    candidates.add(method)
+        candidates = list(candidates)
+        # within a method class, first try the methods that take the most constraints 
+        # of their output from their inputs. Constraints derived anew have the output 
+        # as their source, and would seem inconsistent with their original sources.
+        candidates.sort(key=lambda m: (self._methodclasses.index(m.__class__), 
+            -sum(map(lambda c: shared_constraint_count(c, m.outputs()[0]), m.input_clusters())),
+            sorted(map(lambda c: c.creationtime, m.input_clusters()))))
+        while len(candidates) > 0:
+            if self._scheduler != None:
+                method = self._scheduler.select(self, candidates)
+            else:
+                method = candidates[0]
+            diag_print("try deferred: "+str(method),"clsolver")
+            if self._add_method_complete(method):
+                return True
+            candidates.remove(method)
+        return False
+
     def _try_methods(self, nlet):
         """finds a possible rewrite rule applications on given set of clusters, applies it 
            and returns True iff successfull
@@ -403,7 +881,7 @@ class ClusterSolver(Notifier):
         refgraph = reference2graph(nlet)
         for methodclass in self._pattern_methods:
             diag_print("trying generic pattern matching for "+str(methodclass), "clsolver3D")
-            matches = gmatch(methodclass.patterngraph, refgraph)
+            matches = imatch(self._compiled_patterns[methodclass], refgraph)
             if self._try_matches(methodclass,matches):
                 return True
             # end for match
@@ -411,7 +889,7 @@ class ClusterSolver(Notifier):
         return False
     
     def _try_matches(self, methodclass, matches):
-        # print "method="+str(methodclass),"number of matches = "+str(len(matches))
+        # note: matches may be a generator; only the first match is generated 
         for s in matches:
             diag_print("try match: "+str(s),"clsolver3D")
             method = apply(methodclass, [s])
@@ -431,12 +909,10 @@ class ClusterSolver(Notifier):
         infinc = True
         connected = set()
         for var in output.vars:
-            dependend = self.find_dependend(var)
-            dependend = filter(lambda x: self.is_top_level(x), dependend)
-            connected.update(dependend)
+            connected.update(self.find_top_level(var))
         # NOTE 07-11-2007 (while writing the paper): this  implementation of information increasing may not be correct. We may need to check that the total sum of the information in the overlapping clusters is equal to the information in the output.
         for cluster in connected:
-            if num_constraints(cluster.intersection(output)) >= num_constraints(output):
+            if shared_constraint_count(cluster, output) >= num_constraints(output):
                 infinc = False
                 break
         diag_print("information increasing:"+str(infinc),"clsolver")
@@ -448,7 +924,7 @@ class ClusterSolver(Notifier):
         output = merge.outputs()[0]
         nremove = 0
         for cluster in merge.input_clusters():
-            if num_constraints(cluster.intersection(output)) >= num_constraints(cluster): 
+            if shared_constraint_count(cluster, output) >= num_constraints(cluster): 
                # will be removed from toplevel
                nremove += 1
         # exeption if method sets noremove flag
@@ -460,14 +936,20 @@ class ClusterSolver(Notifier):
 
     def _is_redundant_method(self, merge):
         # check if the method is redundant (not information increasing and not reducing number of clusters)
+        if merge in self._redundancy_cache:
+            self._redundancy_stats["skipped"] += 1
+            return self._redundancy_cache[merge]
+        self._redundancy_stats["checked"] += 1
         infinc = self._is_information_increasing(merge)
         reduc = self._is_cluster_reducing(merge)
-        if not infinc and not reduc:
+        redundant = not infinc and not reduc
+        if redundant:
             diag_print("method is redundant","clsolver")
-            return True
         else:
             diag_print("method is not redundant","clsolver")
-            return False
+        if merge in self._applicable_methods:
+            self._redundancy_cache[merge] = redundant
+        return redundant
 
     def _add_method_complete(self, merge):
         diag_print("add_method_complete "+str(merge), "clsolver")
@@ -485,7 +967,7 @@ class ClusterSolver(Notifier):
             for i2 in range(i1+1, len(merge.input_clusters())):
                 c1 = merge.input_clusters()[i1] 
                 c2 = merge.input_clusters()[i2] 
-                if num_constraints(c1.intersection(c2)) != 0:
+                if shared_constraint_count(c1, c2) != 0:
                     local_oc = True
                 consistent = consistent and self._is_consistent_pair(c1, c2)
         merge.consistent = consistent
@@ -502,6 +984,8 @@ class ClusterSolver(Notifier):
         
         # add to graph
         self._add_cluster(output)
+        if infinc and self._fused_selection:
+            self._fuse_selection(merge)
         self._add_method(merge)
         
         # remove input clusters from top_level
@@ -513,7 +997,7 @@ class ClusterSolver(Notifier):
                     diag_print("block top-level", "clsolver")
                     break
             # remove input clusters when all its constraints are in output cluster 
-            if num_constraints(cluster.intersection(output)) >= num_constraints(cluster): 
+            if shared_constraint_count(cluster, output) >= num_constraints(cluster): 
                 diag_print("remove from top-level: "+str(cluster),"clsolver")
                 self._rem_top_level(cluster) 
                 merge.restore_toplevel.append(cluster)
@@ -526,7 +1010,7 @@ class ClusterSolver(Notifier):
         else:
             self._add_root_method(merge.input_clusters(),merge.outputs()[0])
         # add solution selection methods, only if information increasing
-        if infinc:
+        if infinc and not merge.is_fused():
             output2 = self._add_prototype_selector(merge)
             output3 = self._add_solution_selector(output2)
         
@@ -567,12 +1051,9 @@ class ClusterSolver(Notifier):
                     torestore.add(cluster)
             # delete it from graph
             diag_print("deleting "+str(item),"clsolver.remove")
-            self._graph.rem_vertex(item)
-            # remove from _new list
-            if item in self._new:
-                self._new.remove(item)
-            # remove from incremental top_level
-            self._toplevel.remove(item)
+            self._rem_vertex(item)
+            # remove from _new list and incremental top_level
+            self._rem_top_level(item)
             # remove from methodgraph
             if isinstance(item, Method):
                 # note: method may have been removed because variable removed
@@ -580,17 +1061,20 @@ class ClusterSolver(Notifier):
                     self._mg.rem_method(item)
                 except:
                     pass
+                self._lifted_methods.discard(item)
                 # restore SelectionConstraints
-                if isinstance(item, SelectionMethod):
+                if is_selection_method(item):
                     for con in item.iter_constraints():
                         self._selection_method[con] = None
             if isinstance(item, MultiVariable):
                 self._mg.rem_variable(item)
             # remove variables with no dependent clusters
             if isinstance(item, Cluster):
+                if item in self._source_cache:
+                    del self._source_cache[item]
                 for var in item.vars:
                     if len(self.find_dependend(var)) == 0:
-                        self._graph.rem_vertex(var)
+                        self._rem_vertex(var)
             # notify listeners
             self.send_notify(("remove", item))
         # restore toplevel (also added to _new)
@@ -635,13 +1119,37 @@ class ClusterSolver(Notifier):
 
     def _is_consistent_pair(self, object1, object2):
         diag_print("in is_consistent_pair "+str(object1)+" "+str(object2),"clsolver")
-        oc = over_constraints(object1, object2) 
-        diag_print("over_constraints: "+str(map(str,oc)),"clsolver")
-        consistent = True
-        for con in oc:
-            consistent = consistent and self._consistent_overconstraint_in_pair(con, object1, object2)
-        diag_print("global consistent? "+str(consistent),"clsolver")
-        return consistent
+        if diag_selected("clsolver"):
+            # check each over-constraint separately, for diagnostic messages 
+            oc = over_constraints(object1, object2) 
+            diag_print("over_constraints: "+str(map(str,oc)),"clsolver")
+            consistent = True
+            for con in oc:
+                consistent = consistent and self._consistent_overconstraint_in_pair(con, object1, object2)
+            diag_print("global consistent? "+str(consistent),"clsolver")
+            return consistent
+        # check classes of over-constraints with the same sources 
+        oc = over_constraint_class(object1, object2)
+        if oc == None:
+            return True
+        sources1 = self._cached_class_sources(oc, object1)
+        sources2 = self._cached_class_sources(oc, object2)
+        for (s1, class1, excl1) in sources1:
+            for (s2, class2, excl2) in sources2:
+                if s1 == None or s2 == None:
+                    consistent = False
+                elif s1 == s2:
+                    consistent = True
+                else:
+                    consistent = (self._is_atomic(s1) == self._is_atomic(s2))
+                if consistent:
+                    continue
+                # inconsistent if there is a constraint with these sources
+                if shared_constraint_count(class1, class2) == 0:
+                    continue
+                if not constraints_covered(class1.intersection(class2), excl1+excl2):
+                    return False
+        return True
     
     def _consistent_overconstraint_in_pair(self, overconstraint, object1, object2):
         diag_print("consistent "+str(overconstraint)+" in "+str(object1)+" and "+str(object2)+" ?", "clsolver")
@@ -672,25 +1180,83 @@ class ClusterSolver(Notifier):
         diag_print("consistent? "+str(consistent), "clsolver")
         return consistent
 
+    def _cached_class_sources(self, constraints, cluster):
+        """_constraint_class_sources, memoized in the source cache of the cluster"""
+        key = source_key(constraints)
+        cache = self._source_cache.setdefault(cluster, {})
+        if key not in cache:
+            cache[key] = self._constraint_class_sources(constraints, cluster)
+        return cache[key]
+
+    def _constraint_class_sources(self, constraints, cluster):
+        """Determine the sources of a class of constraints in a cluster,
+           like _source_constraint_in_cluster does for a single constraint.
+           
+           Returns a list of (source, class, excluded) tuples, where source
+           is the source cluster (or None if the source is inconsistent) of the 
+           constraints in class that are not in any of the excluded clusters.
+        """
+        sources = []
+        stack = [(cluster, constraints, [])]
+        while len(stack) > 0:
+            (cluster, constraints, excluded) = stack.pop()
+            method = self._determining_method(cluster)
+            if method == None:
+                sources.append((cluster, constraints, excluded))
+                continue
+            down = filter(lambda x: shared_constraint_count(x, constraints) > 0, method.inputs())
+            for i in range(len(down)):
+                # constraints in more than one input are traced via the first 
+                # input if the method is consistent, else the source is inconsistent
+                if len(down) > 1 and method.consistent == True:
+                    others = down[:i]
+                else:
+                    others = down[:i] + down[i+1:]
+                part = constraints.intersection(down[i])
+                if not constraints_covered(part, excluded + others):
+                    stack.append((down[i], part, excluded + others))
+                if len(down) > 1 and method.consistent != True:
+                    for other in down[i+1:]:
+                        if shared_constraint_count(part, other) == 0:
+                            continue
+                        shared = part.intersection(other)
+                        if not constraints_covered(shared, excluded):
+                            sources.append((None, shared, excluded))
+            # constraints not in any input have this cluster as source
+            if not constraints_covered(constraints, excluded + down):
+                sources.append((cluster, constraints, excluded + down))
+        return sources
+
     def _source_constraint_in_cluster(self, constraint, cluster):
         if not self._contains_constraint(cluster, constraint):
             raise StandardError, "constraint not in cluster"
-        elif self._is_atomic(cluster):
-            return cluster
-        else:
+        key = source_key(constraint)
+        # walk down the DR-plan until the source or a cached source is found
+        path = []
+        while True:
+            cache = self._source_cache.get(cluster)
+            if cache != None and key in cache:
+                source = cache[key]
+                break
+            path.append(cluster)
             method = self._determining_method(cluster)
-            inputs = method.inputs()
-            down = filter(lambda x: self._contains_constraint(x, constraint), inputs)
+            if method == None:
+                source = cluster
+                break
+            down = filter(lambda x: self._contains_constraint(x, constraint), method.inputs())
             if len(down) == 0:
-                return cluster
-            elif len(down) > 1:
-                if method.consistent == True:
-                    return self._source_constraint_in_cluster(constraint, down[0])
-                else: 
-                    diag_print("Warning: source is inconsistent","clsolver")
-                    return None
+                source = cluster
+                break
+            elif len(down) > 1 and method.consistent != True:
+                diag_print("Warning: source is inconsistent","clsolver")
+                source = None
+                break
             else:
-                return self._source_constraint_in_cluster(constraint, down[0])
+                cluster = down[0]
+        # the source is the same for all clusters on the path 
+        for cluster in path:
+            self._source_cache.setdefault(cluster, {})[key] = source
+        return source
 
            
     def _is_atomic(self, object):
@@ -775,6 +1341,10 @@ class ClusterMethod(MultiMethod):
        Alternatively, subclasses may implement the static class method 'handcoded_match', which should
        return a list of matches (given a new cluster and all connected clusters).   
 
+       Subclasses with an 'incremental_matcher' may set the class variable 'deferred' to True.
+       Their matches are then only tried when searching from a new cluster, after the handcoded 
+       matches, as if they were matched by a pattern. 
+
        Subclasses should implement function _multi_execute such that the output cluster satisfies all 
        the constraints in the input clusters. 
 
@@ -784,15 +1354,108 @@ class ClusterMethod(MultiMethod):
         (these variables are automatically set by the solver for debugging purposes )
     """
 
+    deferred = False
+
     def __init__(self):
         self.overconstrained = None
         self.consistent = None
+        # inputs and constraints for solution selection (see fuse_selection)
+        self._selection_inputs = []
+        self._prototype = None
+        self._constraints = None
+        # point clusters with the prototype of the output (see set_prototype_inputs)
+        self._prototype_inputs = None
         MultiMethod.__init__(self)
 
     def prototype_constraints(self):
         """Return a list of SelectionConstraint"""
         return []
 
+    def fuse_selection(self, selclusters, constraints, enabled):
+        """Select solutions of this method like a PrototypeMethod, with the given 
+           prototype clusters, constraints and enabled variable, followed by a 
+           SelectionMethod, with the constraints added by add_constraint. 
+           The prototype clusters and the enabled variable become inputs."""
+        self._selection_inputs = selclusters + [enabled]
+        self._prototype = constraints
+        self._constraints = []
+
+    def is_fused(self):
+        """True iff solutions are selected by this method (see fuse_selection)"""
+        return self._constraints != None
+
+    def add_constraint(self, con):
+        self._constraints.append(con)
+
+    def rem_constraint(self, con):
+        self._constraints.remove(con)
+
+    def iter_constraints(self):
+        return iter(self._constraints)
+
+    def set_prototype_inputs(self, protoclusters):
+        """Add point clusters with the prototype of the output as inputs, 
+           to rank solutions by distance to the prototype (see rank)"""
+        self._prototype_inputs = protoclusters
+
+    def has_prototype_inputs(self):
+        """True iff set_prototype_inputs was called"""
+        return self._prototype_inputs != None
+
+    def inputs(self):
+        if self._prototype_inputs != None:
+            return self._inputs + self._selection_inputs + self._prototype_inputs
+        return self._inputs + self._selection_inputs
+
+    def rank(self, conf, inmap):
+        """Returns the root mean square distance between a solution and the 
+           prototype, after the best rigid alignment"""
+        prototype = {}
+        for cluster in self.inputs():
+            if cluster_kind(cluster) == "point" and inmap[cluster] != None:
+                for protoconf in inmap[cluster]:
+                    prototype.update(protoconf.map)
+        if len(prototype) == 0:
+            return 0.0
+        return conf.rms_distance(Configuration(prototype))
+
+    def predicates(self):
+        """Returns the predicates applied to solutions, including solution 
+           selection if fused (see fuse_selection)"""
+        predicates = MultiMethod.predicates(self)
+        if self.is_fused():
+            predicates.append(self._is_selected)
+        return predicates
+
+    def memo_state(self):
+        if self.is_fused():
+            return (MultiMethod.memo_state(self), tuple(self._constraints))
+        else:
+            return MultiMethod.memo_state(self)
+
+    def _is_selected(self, conf, inmap):
+        """True iff a solution satisfies the prototype constraints like the 
+           prototype, for some configurations of the prototype clusters, 
+           and all selection constraints"""
+        selclusters = self._selection_inputs[:-1]
+        if inmap[self._selection_inputs[-1]] == True and len(self._prototype) > 0:
+            for selconfs in itertools.product(*map(lambda c: inmap[c], selclusters)):
+                selmap = {}
+                for selconf in selconfs:
+                    var = selconf.vars()[0]
+                    selmap[var] = selconf.map[var]
+                sat = True
+                for con in self._prototype:
+                    sat = sat and con.satisfied(conf.map) == con.satisfied(selmap)
+                if sat:
+                    break
+            else:
+                return False
+        for con in self._constraints:
+            if not con.satisfied(conf.map):
+                return False
+        return True
+
     def status_str(self):
         s = ""
         if self.consistent == True:
@@ -806,16 +1469,20 @@ class ClusterMethod(MultiMethod):
         return s
 
     def input_clusters(self):
-        return filter(lambda var: isinstance(var, Cluster), self.inputs())
+        return filter(lambda var: isinstance(var, Cluster), self._inputs)
 
     def __eq__(self, other):
+        # methods on the same inputs may derive clusters on different points
         if self.__class__ == other.__class__:
-            return self._inputs == other._inputs
+            return self._inputs == other._inputs and self._outputs[0].vars == other._outputs[0].vars
         else:
             return False
 
     def __hash__(self):
-        return hash(tuple(self._inputs)+tuple([self.__class__]))
+        # inputs do not change, but methods are hashed very often by incremental matchers
+        if not hasattr(self, "_hash"):
+            self._hash = hash(tuple(self._inputs)+(self.__class__, self._outputs[0].vars))
+        return self._hash
 
 
 class PrototypeMethod(MultiMethod):
@@ -879,6 +1546,9 @@ class SelectionMethod(MultiMethod):
        all selectionconstraints are satisfied.
     """
 
+    # constraints may be added and removed
+    memoize = False
+
     def __init__(self, incluster, outcluster):
         self._inputs = [incluster]
         self._outputs = [outcluster]
@@ -915,6 +1585,66 @@ class SelectionMethod(MultiMethod):
     def __str__(self):
         return "SelectionMethod#%d(%s & %s ->%s)"%(id(self),str(self._inputs[0]), str(self._constraints), str(self._outputs[0]))
 
+#  -----------------------------------------------------------
+#  ----------Schedulers used by ClusterSolver -----------------
+#  -----------------------------------------------------------
+
+class MergeScheduler:
+    """Chooses which of a number of applicable methods a ClusterSolver applies
+       first (see ClusterSolver.set_scheduler). Subclasses override rank; the
+       method with the highest rank is selected."""
+
+    def rank(self, solver, method):
+        """Returns a value to compare methods by. Here, all methods rank equal."""
+        return 0
+
+    def select(self, solver, methods):
+        """Returns the method with the highest rank from a list of methods,
+           or None if the list is empty. Of equally ranked methods, the first
+           is returned."""
+        best = None
+        bestrank = None
+        for method in methods:
+            rank = self.rank(solver, method)
+            if best == None or rank > bestrank:
+                best = method
+                bestrank = rank
+        return best
+
+class CostScheduler(MergeScheduler):
+    """Ranks methods by expected benefit: first by the number of input clusters
+       removed from the top-level, then by the size of the output cluster, then 
+       by the number of constraints of the output taken from the inputs (as 
+       ClusterSolver does for deferred methods), and then by the estimated cost 
+       of executing the method, lowest first. Applying large merges first avoids 
+       many short-lived intermediate clusters, each with its own root, prototype 
+       and solution selection methods."""
+
+    def rank(self, solver, method):
+        output = method.outputs()[0]
+        nremove = 0
+        if not (hasattr(method,"noremove") and method.noremove == True):
+            for cluster in method.input_clusters():
+                if shared_constraint_count(cluster, output) >= num_constraints(cluster):
+                    nremove += 1
+        shared = sum(map(lambda c: shared_constraint_count(c, output), method.input_clusters()))
+        return (nremove, len(output.vars), shared, -self.cost(solver, method))
+
+    def cost(self, solver, method):
+        """Estimated cost of multi_execute: the number of point variables of the
+           input clusters, times the number of input configurations (if known)"""
+        cost = 0
+        for cluster in method.input_clusters():
+            if solver.is_stale(cluster):
+                configurations = None
+            else:
+                configurations = solver.get(cluster)
+            if configurations == None:
+                cost += len(cluster.vars)
+            else:
+                cost += len(cluster.vars) * max(1, len(configurations))
+        return cost
+
 # --------------------------------------
 # helper functions for pattern matching
 # --------------------------------------
@@ -946,6 +1676,21 @@ def pattern2graph(pattern):
     #diag_print("pattern graph:"+str(pgraph),"match");
     return pgraph
 
+def graph2pattern(pgraph):
+    """Convert a pattern graph (see pattern2graph) back to a pattern, a list of tuples 
+       (pattype, patname, patvars)."""
+    pattern = []
+    for pattype in ["point","distance","rigid","balloon","hedgehog"]:
+        for patname in pgraph.outgoing_vertices(pattype):
+            patvars = pgraph.outgoing_vertices(patname)
+            if pattype == "hedgehog":
+                cvar = "cvar"+"#"+patname
+                patvars.remove(cvar)
+                patvars.remove(pgraph.outgoing_vertices(cvar)[0])
+                patvars.insert(0, pgraph.outgoing_vertices(cvar)[0])
+            pattern.append((pattype, patname, patvars))
+    return pattern
+
 def reference2graph(nlet):
     """Convert a set of (supposedly connected) clusters to a reference graph, used before graph-based matching."""
     rgraph = Graph()
@@ -972,6 +1717,40 @@ def reference2graph(nlet):
     #diag_print("reference graph:"+str(rgraph),"match");
     return rgraph
 
+def cluster_kind(cluster):
+    """returns the kind of a cluster, used to index clusters by variable: 
+       "point" (a rigid with one variable), "rigid", "hedgehog", "balloon", 
+       "glueable" or "flexible"."""
+    if isinstance(cluster, Rigid):
+        if len(cluster.vars) == 1:
+            return "point"
+        else:
+            return "rigid"
+    elif isinstance(cluster, Hedgehog):
+        return "hedgehog"
+    elif isinstance(cluster, Balloon):
+        return "balloon"
+    elif isinstance(cluster, Glueable):
+        return "glueable"
+    else:
+        return "flexible"
+
+def source_key(constraint):
+    """returns a key for a Distance, an Angle or a class of constraints 
+       (see cluster.over_constraint_class), used to cache their sources"""
+    if isinstance(constraint, Distance):
+        return ("distance", frozenset(constraint.vars))
+    elif isinstance(constraint, Angle):
+        return ("angle", constraint.vars[1], frozenset([constraint.vars[0],constraint.vars[2]]))
+    elif isinstance(constraint, Hedgehog):
+        return ("hedgehog", constraint.cvar, constraint.xvars)
+    else:
+        return (cluster_kind(constraint), constraint.vars)
+
+def is_selection_method(method):
+    """returns True iff method is a SelectionMethod or a ClusterMethod that selects solutions"""
+    return isinstance(method, SelectionMethod) or (isinstance(method, ClusterMethod) and method.is_fused())
+
 def rootname(cluster):
     """returns the name of the root variable associated with the name of a cluster variable"""
     return "root#"+str(id(cluster))
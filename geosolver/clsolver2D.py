@@ -4,7 +4,7 @@ from clsolver import *
 from diagnostic import diag_print, diag_select
 from selconstr import *
 from intersections import *
-from configuration import Configuration
+from configuration import Configuration, make_configuration
 from cluster import *
 from map import Map
 import incremental
@@ -14,9 +14,9 @@ class ClusterSolver2D(ClusterSolver):
     """A 2D geometric constraint solver. See ClusterSolver for details."""  
        # ------- PUBLIC METHODS --------
 
-    def __init__(self):
-        """Instantiate a ClusterSolver2D"""
-        ClusterSolver.__init__(self, [CheckAR, MergePR, MergeRR, DeriveDDD, DeriveDAD, DeriveADD, DeriveHH2S, MergeSR])
+    def __init__(self, pattern_network=False):
+        """Instantiate a ClusterSolver2D. See ClusterSolver for pattern_network."""
+        ClusterSolver.__init__(self, [CheckAR, MergePR, MergeRR, DeriveDDD, DeriveDAD, DeriveADD, DeriveHH2S, MergeSR], pattern_network)
         
 
 # ----------------------------------------------
@@ -573,7 +573,7 @@ def solve_ddd(v1,v2,v3,d12,d23,d31):
     p3s = cc_int(p1,d31,p2,d23)
     solutions = []
     for p3 in p3s:
-        solution = Configuration({v1:p1, v2:p2, v3:p3})
+        solution = make_configuration({v1:p1, v2:p2, v3:p3})
         solutions.append(solution)
     diag_print("solve_ddd solutions"+str(solutions),"clmethods")
     return solutions
@@ -590,7 +590,7 @@ def solve_dad(v1,v2,v3,d12,a123,d23):
     p3s = [ vector.vector([d23*math.cos(a123), d23*math.sin(a123)]) ]
     solutions = []
     for p3 in p3s:
-        solution = Configuration({v1:p1, v2:p2, v3:p3})
+        solution = make_configuration({v1:p1, v2:p2, v3:p3})
         solutions.append(solution)
     return solutions
 
@@ -609,7 +609,7 @@ def solve_add(a,b,c, a_cab, d_ab, d_bc):
     rval = []
     for p_c in solutions:
         map = {a:p_a, b:p_b, c:p_c}
-        rval.append(Configuration(map))
+        rval.append(make_configuration(map))
     return rval
 
 def solve_ada(a, b, c, a_cab, d_ab, a_abc):
@@ -645,7 +645,7 @@ def solve_ada(a, b, c, a_cab, d_ab, a_abc):
                 for p_c in solutions:
                         #p_c.append(0.0)
                         map = {a:p_a, b:p_b, c:p_c}
-                        rval.append(Configuration(map))
+                        rval.append(make_configuration(map))
     return rval
 
 # -------------------------------------
@@ -653,6 +653,8 @@ def solve_ada(a, b, c, a_cab, d_ab, a_abc):
 # -------------------------------------
 
 class Rigids(incremental.Filter):
+
+    kinds = ("point", "rigid")
     
     def __init__(self, solver): 
         self._solver = solver
@@ -671,6 +673,8 @@ class Rigids(incremental.Filter):
         return "Rigids("+repr(self._solver)+")"
 
 class Hogs(incremental.Filter):
+
+    kinds = ("hedgehog",)
     
     def __init__(self, solver): 
         self._solver = solver
@@ -689,6 +693,8 @@ class Hogs(incremental.Filter):
         return "Hogs("+repr(self._solver)+")"
 
 class Balloons(incremental.Filter):
+
+    kinds = ("balloon",)
     
     def __init__(self, solver): 
         self._solver = solver
@@ -708,6 +714,8 @@ class Balloons(incremental.Filter):
 
 
 class Points(incremental.Filter):
+
+    kinds = ("point",)
     
     def __init__(self, solver): 
         self._solver = solver
@@ -727,6 +735,8 @@ class Points(incremental.Filter):
         return "Points("+repr(self._solver)+")"
 
 class Distances(incremental.Filter):
+
+    kinds = ("rigid",)
     
     def __init__(self, solver): 
         self._solver = solver
@@ -759,8 +769,7 @@ class ConnectedPairs1(incremental.IncrementalSet):
     def _receive_add(self,source, obj):
         connected = set()
         for var in obj.vars:
-            dependend = self._solver.find_dependend(var)
-            dependend = filter(lambda x: x in self._incrset, dependend)
+            dependend = self._solver.find_top_level_in(var, self._incrset)
             connected.update(dependend)
         if obj in connected:
             connected.remove(obj)
@@ -795,11 +804,10 @@ class ConnectedPairs2(incremental.IncrementalSet):
     def _receive_add(self,source, obj):
         connected = set()
         for var in obj.vars:
-            dependend = self._solver.find_dependend(var)
             if source == self._incrset1:
-                dependend = filter(lambda x: x in self._incrset2, dependend)
+                dependend = self._solver.find_top_level_in(var, self._incrset2)
             elif source == self._incrset2:
-                dependend = filter(lambda x: x in self._incrset1, dependend)
+                dependend = self._solver.find_top_level_in(var, self._incrset1)
             connected.update(dependend)
         if obj in connected:
             connected.remove(obj)
@@ -835,8 +843,7 @@ class DistanceTriplets(incremental.IncrementalSet):
     def _receive_add(self,source, obj):
         connected = set()
         for var in obj.vars:
-            dependend = self._solver.find_dependend(var)
-            dependend = filter(lambda x: x in self._incrset, dependend)
+            dependend = self._solver.find_top_level_in(var, self._incrset)
             dependend = filter(lambda x: len(x.vars.intersection(obj.vars))==1, dependend)
             connected.update(dependend)
         if obj in connected:
@@ -886,8 +893,7 @@ class ConnectedTriplets(incremental.IncrementalSet):
     def _receive_add(self,source, obj):
         connected = set()
         for var in obj.vars:
-            dependend = self._solver.find_dependend(var)
-            dependend = filter(lambda x: x in self._incrset, dependend)
+            dependend = self._solver.find_top_level_in(var, self._incrset)
             dependend = filter(lambda x: len(x.vars.intersection(obj.vars))>=1, dependend)
             connected.update(dependend)
         if obj in connected:
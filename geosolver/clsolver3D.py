@@ -4,7 +4,7 @@ from clsolver import *
 from diagnostic import diag_print, diag_select
 from selconstr import *
 from intersections import *
-from configuration import Configuration
+from configuration import Configuration, make_configuration
 from cluster import *
 from map import Map
 import incremental
@@ -14,9 +14,9 @@ class ClusterSolver3D(ClusterSolver):
     """A 3D geometric constraint solver. See ClusterSolver for details."""  
        # ------- PUBLIC METHODS --------
 
-    def __init__(self):
-        """Instantiate a ClusterSolver3D"""
-        ClusterSolver.__init__(self, [MergeGlueable, CheckAR, MergePR, MergeDR, MergeRR, MergeSR, DeriveTTD, DeriveDDD, DeriveADD, DeriveDAD, DeriveAA])
+    def __init__(self, pattern_network=False):
+        """Instantiate a ClusterSolver3D. See ClusterSolver for pattern_network."""
+        ClusterSolver.__init__(self, [MergeGlueable, CheckAR, MergePR, MergeDR, MergeRR, MergeSR, DeriveTTD, DeriveDDD, DeriveADD, DeriveDAD, DeriveAA], pattern_network)
         
 
 # ----------------------------------------------
@@ -54,9 +54,7 @@ class MergeGlueable(ClusterMethod):
             for o in glues:
                 connected2 = set()
                 for var in o.vars:
-                    dependend = problem.find_dependend(var)
-                    dependend = filter(lambda x: problem.is_top_level(x), dependend)
-                    connected2.update(dependend)
+                    connected2.update(problem.find_top_level(var))
                 rigids2 = filter(lambda r2: isinstance(r2, Rigid) and r2 != rigid1 and len(r2.vars.intersection(o.vars)) >=3, connected2)
                 for rigid2 in rigids2:
                     m = Map({
@@ -103,18 +101,11 @@ class MergeGlueable(ClusterMethod):
         v1 = shared[0]
         v2 = shared[1]
         v3 = shared[2]
-        # determine coordinate system for shared points in r1
-        p1r = r1.map[v1]
-        p2r = r1.map[v2]
-        p3r = r1.map[v3]
-        csr = make_hcs_3d(p1r, p2r, p3r)
-        # determine coordinate system for shared points in glue cluster
-        p1o = o.map[v1]
-        p2o = o.map[v2]
-        p3o = o.map[v3]
-        cso = make_hcs_3d(p1o, p2o, p3o)
+        # determine coordinate systems for shared points in r1 and glue cluster
+        csr_inverse = r1.frame_inverse((v1, v2, v3))
+        cso = o.frame((v1, v2, v3))
         # do transform
-        trans1 = cs_transform_matrix(csr, cso)
+        trans1 = cso.mmul(csr_inverse)
 
         # transform r2
         # determine shared vars for r2 and o, in the correct order
@@ -125,30 +116,23 @@ class MergeGlueable(ClusterMethod):
         v1 = shared[0]
         v2 = shared[1]
         v3 = shared[2]
-        # determine coordinate system for shared points in r2
-        p1r = r2.map[v1]
-        p2r = r2.map[v2]
-        p3r = r2.map[v3]
-        csr = make_hcs_3d(p1r, p2r, p3r)
-        # determine coordinate system for shared points in glue cluster
-        p1o = o.map[v1]
-        p2o = o.map[v2]
-        p3o = o.map[v3]
-        cso = make_hcs_3d(p1o, p2o, p3o)
+        # determine coordinate systems for shared points in r2 and glue cluster
+        csr_inverse = r2.frame_inverse((v1, v2, v3))
+        cso = o.frame((v1, v2, v3))
         # do transform 
-        trans2 = cs_transform_matrix(csr, cso)
+        trans2 = cso.mmul(csr_inverse)
 
         # merge r1 and r2
         isroot1 = inmap[self.root1]
         isroot2 = inmap[self.root2]
         if isroot1 and not isroot2:
-            res = r1.add(r2.transform(trans1.inverse().mmul(trans2)))
+            res = r1.add(r2.transform(hcs_inverse(trans1).mmul(trans2)))
         elif isroot2 and not isroot1:
-            res = r2.add(r1.transform(trans2.inverse().mmul(trans1)))
+            res = r2.add(r1.transform(hcs_inverse(trans2).mmul(trans1)))
         elif len(self.rigid1.vars) < len(self.rigid2.vars):  # cheapest - transform smallest config
-            res = r2.add(r1.transform(trans2.inverse().mmul(trans1)))
+            res = r2.add(r1.transform(hcs_inverse(trans2).mmul(trans1)))
         else:
-            res = r1.add(r2.transform(trans1.inverse().mmul(trans2)))
+            res = r1.add(r2.transform(hcs_inverse(trans1).mmul(trans2)))
         
         return [res]
 
@@ -349,6 +333,9 @@ class MergeDR(ClusterMethod):
    
 class MergeRR(ClusterMethod):
     """Represents a merging of two rigids sharing three points."""
+
+    deferred = True
+
     def __init__(self, map):
         # check inputs
         in1 = map["$r1"]
@@ -362,11 +349,19 @@ class MergeRR(ClusterMethod):
         self._outputs = [out]
         ClusterMethod.__init__(self)
 
-    def _pattern():
-        pattern = [["rigid","$r1",["$a","$b","$c"]], ["rigid", "$r2", ["$a", "$b", "$c"]]]
-        return pattern2graph(pattern)
-    pattern = staticmethod(_pattern)
-    patterngraph = _pattern()
+    #def _pattern():
+    #    pattern = [["rigid","$r1",["$a","$b","$c"]], ["rigid", "$r2", ["$a", "$b", "$c"]]]
+    #    return pattern2graph(pattern)
+    #pattern = staticmethod(_pattern)
+    #patterngraph = _pattern()
+
+    def _incremental_matcher(solver):
+        rigids = Rigids(solver)
+        connectedpairs = ConnectedPairs1(solver, rigids)
+        threeconnectedpairs = incremental.Filter(lambda (r1,r2): len(r1.vars.intersection(r2.vars))>=3, connectedpairs)
+        matcher = incremental.Map(lambda (r1,r2): MergeRR({"$r1":r1, "$r2":r2}), threeconnectedpairs)
+        return matcher
+    incremental_matcher = staticmethod(_incremental_matcher)
 
     def __str__(self):
         s =  "MergeRR("+str(self._inputs[0])+"+"+str(self._inputs[1])+"->"+str(self._outputs[0])+")"
@@ -393,6 +388,9 @@ class MergeRR(ClusterMethod):
 
 class DeriveDDD(ClusterMethod):
     """Represents a merging of three distances"""
+
+    deferred = True
+
     def __init__(self, map):
         # check inputs
         self.d_ab = map["$d_ab"]
@@ -410,13 +408,19 @@ class DeriveDDD(ClusterMethod):
         # do not remove input clusters (because root not considered here)
         self.noremove = True
 
-    def _pattern():
-        pattern = [["rigid","$d_ab",["$a", "$b"]], 
-            ["rigid", "$d_ac",["$a", "$c"]], 
-            ["rigid", "$d_bc",["$b","$c"]]]
-        return pattern2graph(pattern)
-    pattern = staticmethod(_pattern)
-    patterngraph = _pattern()
+    #def _pattern():
+    #    pattern = [["rigid","$d_ab",["$a", "$b"]], 
+    #        ["rigid", "$d_ac",["$a", "$c"]], 
+    #        ["rigid", "$d_bc",["$b","$c"]]]
+    #    return pattern2graph(pattern)
+    #pattern = staticmethod(_pattern)
+    #patterngraph = _pattern()
+
+    def _incremental_matcher(solver):
+        triplets = ConnectedTriplets(solver, RigidsAndHogs(solver))
+        matcher = incremental.FlatMap(triplet2ddd, triplets)
+        return matcher
+    incremental_matcher = staticmethod(_incremental_matcher)
 
 
     def __str__(self):
@@ -440,6 +444,9 @@ class DeriveDDD(ClusterMethod):
 
 class DeriveTTD(ClusterMethod):
     """Represents a derive of a tetra from six distances"""
+
+    deferred = True
+
     def __init__(self, map):
         # check inputs
         self.t_abc = map["$t_abc"]
@@ -467,13 +474,19 @@ class DeriveTTD(ClusterMethod):
         s += "[" + self.status_str()+"]"
         return s
 
-    def _pattern():
-        pattern  = [["rigid","$t_abc",["$a", "$b", "$c"]]]
-        pattern += [["rigid","$t_abd",["$a", "$b", "$d"]]]
-        pattern += [["rigid","$d_cd",["$c", "$d"]]]
-        return pattern2graph(pattern)
-    pattern = staticmethod(_pattern)
-    patterngraph = _pattern()
+    #def _pattern():
+    #    pattern  = [["rigid","$t_abc",["$a", "$b", "$c"]]]
+    #    pattern += [["rigid","$t_abd",["$a", "$b", "$d"]]]
+    #    pattern += [["rigid","$d_cd",["$c", "$d"]]]
+    #    return pattern2graph(pattern)
+    #pattern = staticmethod(_pattern)
+    #patterngraph = _pattern()
+
+    def _incremental_matcher(solver):
+        triplets = ConnectedTriplets(solver, RigidsAndHogs(solver))
+        matcher = incremental.FlatMap(triplet2ttd, triplets)
+        return matcher
+    incremental_matcher = staticmethod(_incremental_matcher)
 
     def multi_execute(self, inmap):
         diag_print("DeriveTTD.multi_execute called","clmethods")
@@ -500,6 +513,9 @@ class DeriveTTD(ClusterMethod):
 
 class DeriveDAD(ClusterMethod):
     """Represents a merging of two distances and an angle"""
+
+    deferred = True
+
     def __init__(self, map):
         # check inputs
         self.d_ab = map["$d_ab"]
@@ -517,13 +533,19 @@ class DeriveDAD(ClusterMethod):
         # do not remove input clusters (because root not considered here)
         self.noremove = True
 
-    def _pattern():
-        pattern = [["rigid","$d_ab",["$a", "$b"]], 
-            ["hedgehog", "$a_abc",["$b", "$a", "$c"]], 
-            ["rigid", "$d_bc",["$b","$c"]]]
-        return pattern2graph(pattern)
-    pattern = staticmethod(_pattern)
-    patterngraph = _pattern()
+    #def _pattern():
+    #    pattern = [["rigid","$d_ab",["$a", "$b"]], 
+    #        ["hedgehog", "$a_abc",["$b", "$a", "$c"]], 
+    #        ["rigid", "$d_bc",["$b","$c"]]]
+    #    return pattern2graph(pattern)
+    #pattern = staticmethod(_pattern)
+    #patterngraph = _pattern()
+
+    def _incremental_matcher(solver):
+        triplets = ConnectedTriplets(solver, RigidsAndHogs(solver))
+        matcher = incremental.FlatMap(triplet2dad, triplets)
+        return matcher
+    incremental_matcher = staticmethod(_incremental_matcher)
 
     def __str__(self):
         s =  "DeriveDAD("+str(self._inputs[0])+"+"+str(self._inputs[1])+"+"+str(self._inputs[2])+"->"+str(self._outputs[0])+")"
@@ -546,6 +568,9 @@ class DeriveDAD(ClusterMethod):
 
 class DeriveADD(ClusterMethod):
     """Represents a merging of one angle and two distances"""
+
+    deferred = True
+
     def __init__(self, map):
         # check inputs
         self.a_cab = map["$a_cab"]
@@ -564,13 +589,19 @@ class DeriveADD(ClusterMethod):
         self.noremove = True
 
 
-    def _pattern():
-        pattern = [["hedgehog","$a_cab",["$a", "$c", "$b"]], 
-            ["rigid", "$d_ab",["$a", "$b"]], 
-            ["rigid", "$d_bc",["$b","$c"]]]
-        return pattern2graph(pattern)
-    pattern = staticmethod(_pattern)
-    patterngraph = _pattern()
+    #def _pattern():
+    #    pattern = [["hedgehog","$a_cab",["$a", "$c", "$b"]], 
+    #        ["rigid", "$d_ab",["$a", "$b"]], 
+    #        ["rigid", "$d_bc",["$b","$c"]]]
+    #    return pattern2graph(pattern)
+    #pattern = staticmethod(_pattern)
+    #patterngraph = _pattern()
+
+    def _incremental_matcher(solver):
+        triplets = ConnectedTriplets(solver, RigidsAndHogs(solver))
+        matcher = incremental.FlatMap(triplet2add, triplets)
+        return matcher
+    incremental_matcher = staticmethod(_incremental_matcher)
 
     def __str__(self):
         s =  "DeriveADD("+str(self._inputs[0])+"+"+str(self._inputs[1])+"+"+str(self._inputs[2])+"->"+str(self._outputs[0])+")"
@@ -593,6 +624,9 @@ class DeriveADD(ClusterMethod):
 
 class DeriveAA(ClusterMethod):
     """Derive a scalable from two angles"""
+
+    deferred = True
+
     def __init__(self, map):
         # check inputs
         self.a_cab = map["$a_cab"]
@@ -611,12 +645,19 @@ class DeriveAA(ClusterMethod):
 
 
 
-    def _pattern():
-        pattern = [["hedgehog","$a_cab",["$a", "$c", "$b"]], 
-            ["hedgehog", "$a_abc",["$b", "$a","$c"]]]
-        return pattern2graph(pattern)
-    pattern = staticmethod(_pattern)
-    patterngraph = _pattern()
+    #def _pattern():
+    #    pattern = [["hedgehog","$a_cab",["$a", "$c", "$b"]], 
+    #        ["hedgehog", "$a_abc",["$b", "$a","$c"]]]
+    #    return pattern2graph(pattern)
+    #pattern = staticmethod(_pattern)
+    #patterngraph = _pattern()
+
+    def _incremental_matcher(solver):
+        hogs = Hogs(solver)
+        connectedpairs = ConnectedPairs1(solver, hogs)
+        matcher = incremental.FlatMap(pair2aa, connectedpairs)
+        return matcher
+    incremental_matcher = staticmethod(_incremental_matcher)
 
     def __str__(self):
         s =  "DeriveAA("+str(self._inputs[0])+"+"+str(self._inputs[1])+"->"+str(self._outputs[0])+")"
@@ -638,6 +679,9 @@ class DeriveAA(ClusterMethod):
 
 class MergeSR(ClusterMethod):
     """Merge a Scalabe and a Rigid sharing two points"""
+
+    deferred = True
+
     def __init__(self, map):
         # check inputs
         in1 = map["$r"]
@@ -649,11 +693,20 @@ class MergeSR(ClusterMethod):
         self._outputs = [out]
         ClusterMethod.__init__(self)
 
-    def _pattern():
-        pattern = [["rigid","$r",["$a","$b"]], ["balloon", "$s", ["$a", "$b"]]]
-        return pattern2graph(pattern)
-    pattern = staticmethod(_pattern)
-    patterngraph = _pattern()
+    #def _pattern():
+    #    pattern = [["rigid","$r",["$a","$b"]], ["balloon", "$s", ["$a", "$b"]]]
+    #    return pattern2graph(pattern)
+    #pattern = staticmethod(_pattern)
+    #patterngraph = _pattern()
+
+    def _incremental_matcher(solver):
+        rigids = Rigids(solver)
+        balloons = Balloons(solver)
+        connectedpairs = ConnectedPairs(solver, rigids, balloons)
+        twoconnectedpairs = incremental.Filter(lambda (r,s): len(r.vars.intersection(s.vars))>=2, connectedpairs)
+        matcher = incremental.Map(lambda (r,s): MergeSR({"$r":r, "$s":s}), twoconnectedpairs)
+        return matcher
+    incremental_matcher = staticmethod(_incremental_matcher)
 
     def __str__(self):
         s =  "MergeSR("+str(self._inputs[0])+"+"+str(self._inputs[1])+"->"+str(self._outputs[0])+")"
@@ -666,7 +719,100 @@ class MergeSR(ClusterMethod):
         c2 = self._inputs[1]
         conf1 = inmap[c1]
         conf2 = inmap[c2]
-        return [conf1.merge_scale(conf2)]
+        # the other points of the rigid may rotate about the shared points
+        return [conf1.merge_scale(conf2).select(self._outputs[0].vars)]
+
+# ---------------------------------------------------------
+# ------- functions to map matched clusters to methods ----
+# ---------------------------------------------------------
+
+def distinct_choices(sets):
+    """returns a list of all lists with one element from each of the given 
+       sets, such that all elements in a list are different."""
+    if len(sets) == 0:
+        return [[]]
+    choices = []
+    for x in sets[0]:
+        rest = map(lambda s: s.difference([x]), sets[1:])
+        for choice in distinct_choices(rest):
+            choices.append([x] + choice)
+    return choices
+
+def triplet2ddd(triplet):
+    """returns a list of DeriveDDDs for a triplet of rigids, one for each choice of points"""
+    rigids = filter(lambda c: isinstance(c, Rigid), triplet)
+    if len(rigids) != 3: return []
+    (d_ab, d_ac, d_bc) = rigids
+    # a triangle in one of the rigids would not be information increasing
+    choices = distinct_choices([d_ab.vars.intersection(d_ac.vars).difference(d_bc.vars),
+                                d_ab.vars.intersection(d_bc.vars).difference(d_ac.vars),
+                                d_ac.vars.intersection(d_bc.vars).difference(d_ab.vars)])
+    methods = []
+    for (a,b,c) in choices:
+        methods.append(DeriveDDD({"$d_ab":d_ab, "$d_ac":d_ac, "$d_bc":d_bc, "$a":a, "$b":b, "$c":c}))
+    return methods
+
+def triplet2ttd(triplet):
+    """returns a list of DeriveTTDs for a triplet of rigids, one for each choice of points"""
+    rigids = filter(lambda c: isinstance(c, Rigid), triplet)
+    if len(rigids) != 3: return []
+    methods = []
+    for i in range(3):
+        d_cd = rigids[i]
+        (t_abc, t_abd) = rigids[:i] + rigids[i+1:]
+        shared = t_abc.vars.intersection(t_abd.vars)
+        choices = distinct_choices([shared, shared,
+                                    t_abc.vars.intersection(d_cd.vars).difference(t_abd.vars),
+                                    t_abd.vars.intersection(d_cd.vars).difference(t_abc.vars)])
+        for (a,b,c,d) in choices:
+            # a and b are interchangeable
+            if a < b:
+                methods.append(DeriveTTD({"$t_abc":t_abc, "$t_abd":t_abd, "$d_cd":d_cd, "$a":a, "$b":b, "$c":c, "$d":d}))
+    return methods
+
+def triplet2dad(triplet):
+    """returns a list of DeriveDADs for a triplet of a hedgehog and two rigids, one for each choice of points"""
+    hogs = filter(lambda c: isinstance(c, Hedgehog), triplet)
+    rigids = filter(lambda c: isinstance(c, Rigid), triplet)
+    if not(len(hogs)==1 and len(rigids)==2): return []
+    hog = hogs[0]
+    (d_ab, d_bc) = rigids
+    b = hog.cvar
+    if not(b in d_ab.vars and b in d_bc.vars): return []
+    choices = distinct_choices([d_ab.vars.intersection(hog.xvars).difference(d_bc.vars),
+                                d_bc.vars.intersection(hog.xvars).difference(d_ab.vars)])
+    methods = []
+    for (a,c) in choices:
+        methods.append(DeriveDAD({"$d_ab":d_ab, "$a_abc":hog, "$d_bc":d_bc, "$a":a, "$b":b, "$c":c}))
+    return methods
+
+def triplet2add(triplet):
+    """returns a list of DeriveADDs for a triplet of a hedgehog and two rigids, one for each choice of points"""
+    hogs = filter(lambda c: isinstance(c, Hedgehog), triplet)
+    rigids = filter(lambda c: isinstance(c, Rigid), triplet)
+    if not(len(hogs)==1 and len(rigids)==2): return []
+    hog = hogs[0]
+    a = hog.cvar
+    methods = []
+    for (d_ab, d_bc) in [rigids, rigids[::-1]]:
+        if not(a in d_ab.vars): continue
+        if a in d_bc.vars: continue
+        choices = distinct_choices([d_ab.vars.intersection(d_bc.vars).intersection(hog.xvars),
+                                    d_bc.vars.intersection(hog.xvars).difference(d_ab.vars)])
+        for (b,c) in choices:
+            methods.append(DeriveADD({"$a_cab":hog, "$d_ab":d_ab, "$d_bc":d_bc, "$a":a, "$b":b, "$c":c}))
+    return methods
+
+def pair2aa(pair):
+    """returns a list of DeriveAAs for a pair of hedgehogs, one for each choice of points"""
+    (a_cab, a_abc) = pair
+    a = a_cab.cvar
+    b = a_abc.cvar
+    if not(a in a_abc.xvars and b in a_cab.xvars): return []
+    methods = []
+    for c in a_cab.xvars.intersection(a_abc.xvars).difference([a,b]):
+        methods.append(DeriveAA({"$a_cab":a_cab, "$a_abc":a_abc, "$a":a, "$b":b, "$c":c}))
+    return methods
 
 # ---------------------------------------------------------
 # ------- functions to determine configurations  ----------
@@ -689,7 +835,7 @@ def solve_ddd_3D(v1,v2,v3,d12,d23,d31):
     p2.append(0.0)
     for p3 in p3s:
         p3.append(0.0)
-        solution = Configuration({v1:p1, v2:p2, v3:p3})
+        solution = make_configuration({v1:p1, v2:p2, v3:p3})
         solutions.append(solution)
     # return only one solution (if any)
     if len(solutions) > 0:
@@ -713,7 +859,7 @@ def solve_dad_3D(v1,v2,v3,d12,a123,d23):
     solutions = []
     for p3 in p3s:
         p3.append(0.0)
-        solution = Configuration({v1:p1, v2:p2, v3:p3})
+        solution = make_configuration({v1:p1, v2:p2, v3:p3})
         solutions.append(solution)
     return solutions
 
@@ -735,7 +881,7 @@ def solve_add_3D(a,b,c, a_cab, d_ab, d_bc):
     for p_c in solutions:
         p_c.append(0.0)
         map = {a:p_a, b:p_b, c:p_c}
-        rval.append(Configuration(map))
+        rval.append(make_configuration(map))
     return rval
 
 def solve_ada_3D(a, b, c, a_cab, d_ab, a_abc):
@@ -770,7 +916,7 @@ def solve_ada_3D(a, b, c, a_cab, d_ab, a_abc):
                 for p_c in solutions:
                         p_c.append(0.0)
                         map = {a:p_a, b:p_b, c:p_c}
-                        rval.append(Configuration(map))
+                        rval.append(make_configuration(map))
     return rval
 
 def solve_3p3d(v1,v2,v3,v4,p1,p2,p3,d14,d24,d34):
@@ -790,7 +936,7 @@ def solve_3p3d(v1,v2,v3,v4,p1,p2,p3,d14,d24,d34):
     p4s = sss_int(p1,d14,p2,d24,p3,d34)
     solutions = []
     for p4 in p4s:
-        solution = Configuration({v1:p1, v2:p2, v3:p3, v4:p4})
+        solution = make_configuration({v1:p1, v2:p2, v3:p3, v4:p4})
         solutions.append(solution)
     return solutions
 
@@ -808,8 +954,7 @@ class Connected(incremental.IncrementalSet):
     def _receive_add(self,source, obj):
         connected = set()
         for var in obj.vars:
-            dependend = self._solver.find_dependend(var)
-            dependend = filter(lambda x: x in self._incrset, dependend)
+            dependend = self._solver.find_top_level_in(var, self._incrset)
             connected.update(dependend)
         connected.remove(obj)
         for obj2 in connected:
@@ -836,30 +981,29 @@ class ConnectedPairs(incremental.IncrementalSet):
         self._solver = solver
         self._incrset1 = incrset1
         self._incrset2 = incrset2
+        # maps clusters to the pairs they are in
+        self._index = {}
         incremental.IncrementalSet.__init__(self, [incrset1, incrset2])
         return 
 
     def _receive_add(self,source, obj):
         connected = set()
         for var in obj.vars:
-            dependend = self._solver.find_dependend(var)
             if source == self._incrset1:
-                dependend = filter(lambda x: x in self._incrset2, dependend)
+                dependend = self._solver.find_top_level_in(var, self._incrset2)
             elif source == self._incrset2:
-                dependend = filter(lambda x: x in self._incrset1, dependend)
+                dependend = self._solver.find_top_level_in(var, self._incrset1)
             connected.update(dependend)
         if obj in connected:
             connected.remove(obj)
         for obj2 in connected:
             if source == self._incrset1:
-                self._add((obj, obj2))
+                add_indexed(self, (obj, obj2))
             elif source == self._incrset2:
-                self._add((obj2, obj))
+                add_indexed(self, (obj2, obj))
 
     def _receive_remove(self,source, obj):
-        for (c1,c2) in list(self):
-            if c1==obj or c2==obj:
-                self._remove((c1,c2))
+        remove_indexed(self, obj)
 
     def __eq__(self, other):
         if isinstance(other, ConnectedPairs):
@@ -870,8 +1014,108 @@ class ConnectedPairs(incremental.IncrementalSet):
     def __hash__(self):
         return hash((self._solver, self._incrset1, self._incrset2))
 
+class ConnectedPairs1(incremental.IncrementalSet):
+    """Incremental set of all pairs of connected clusters in 1 incremental set"""
+    
+    def __init__(self, solver, incrset):
+        """Creates an incremental set of all pairs of connected clusters in incrset, according to solver"""
+        self._solver = solver
+        self._incrset = incrset
+        # maps clusters to the pairs they are in
+        self._index = {}
+        incremental.IncrementalSet.__init__(self, [incrset])
+        return 
+
+    def _receive_add(self,source, obj):
+        connected = set()
+        for var in obj.vars:
+            dependend = self._solver.find_top_level_in(var, self._incrset)
+            connected.update(dependend)
+        if obj in connected:
+            connected.remove(obj)
+        for obj2 in connected:
+            add_indexed(self, frozenset((obj, obj2)))
+
+    def _receive_remove(self,source, obj):
+        remove_indexed(self, obj)
+
+    def __eq__(self, other):
+        if isinstance(other, ConnectedPairs1):
+            return self._solver == other._solver and self._incrset == other._incrset
+        else:
+            return False
+
+    def __hash__(self):
+        return hash((self._solver, self._incrset))
+
+class ConnectedTriplets(incremental.IncrementalSet):
+    
+    def __init__(self, solver, incrset):
+        """Creates an incremental set of all triplets of connected clusters in incrset, according to solver"""
+        self._solver = solver
+        self._incrset = incrset
+        # maps clusters to the triplets they are in
+        self._index = {}
+        incremental.IncrementalSet.__init__(self, [incrset])
+        return 
+
+    def _receive_add(self,source, obj):
+        connected = set()
+        for var in obj.vars:
+            dependend = self._solver.find_top_level_in(var, self._incrset)
+            connected.update(dependend)
+        if obj in connected:
+            connected.remove(obj)
+        obj1 = obj
+        if len(connected) >= 2:
+            l = list(connected)
+            for i in range(len(l)):
+                obj2 = l[i]
+                shared12 = obj1.vars.intersection(obj2.vars)
+                if len(shared12)>=3: continue
+                for j in range(i):
+                    obj3 = l[j]
+                    shared23 = obj2.vars.intersection(obj3.vars)
+                    shared13 = obj1.vars.intersection(obj3.vars)
+                    if 1<=len(shared23)<3 and len(shared13)<3:
+                        shared = shared12.union(shared23).union(shared13)
+                        if len(shared)>=3: 
+                            add_indexed(self, frozenset((obj1,obj2,obj3)))
+
+    def _receive_remove(self,source, obj):
+        remove_indexed(self, obj)
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self._solver == other._solver and self._incrset == other._incrset
+        else:
+            return False
+
+    def __hash__(self):
+        return hash((self.__class__, self._solver, self._incrset))
+
+    def __repr__(self):
+        return "ConnectedTriplets("+repr(self._solver)+","+repr(self._incrset)+")"
+
+def add_indexed(incrset, tup):
+    """add a tuple or frozenset of clusters to incrset and to its index"""
+    for obj in tup:
+        if obj not in incrset._index:
+            incrset._index[obj] = set()
+        incrset._index[obj].add(tup)
+    incrset._add(tup)
+
+def remove_indexed(incrset, obj):
+    """remove all tuples or frozensets containing obj from incrset and from its index"""
+    for tup in incrset._index.pop(obj, []):
+        for obj2 in tup:
+            if obj2 != obj:
+                incrset._index[obj2].discard(tup)
+        incrset._remove(tup)
 
 class Rigids(incremental.Filter):
+
+    kinds = ("point", "rigid")
     
     def __init__(self, solver): 
         self._solver = solver
@@ -889,9 +1133,71 @@ class Rigids(incremental.Filter):
     def __repr__(self):
         return "Rigids("+repr(self._solver)+")"
 
+class Hogs(incremental.Filter):
+
+    kinds = ("hedgehog",)
+    
+    def __init__(self, solver): 
+        self._solver = solver
+        incremental.Filter.__init__(self, lambda c: isinstance(c, Hedgehog), self._solver.top_level())
+
+    def __hash__(self):
+        return hash((self.__class__, self._solver))
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self._solver == other._solver
+        else:
+            return False
+
+    def __repr__(self):
+        return "Hogs("+repr(self._solver)+")"
+
+class Balloons(incremental.Filter):
+
+    kinds = ("balloon",)
+    
+    def __init__(self, solver): 
+        self._solver = solver
+        incremental.Filter.__init__(self, lambda c: isinstance(c, Balloon), self._solver.top_level())
+
+    def __hash__(self):
+        return hash((self.__class__, self._solver))
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self._solver == other._solver
+        else:
+            return False
+
+    def __repr__(self):
+        return "Balloons("+repr(self._solver)+")"
+
+class RigidsAndHogs(incremental.Filter):
+    """Top-level rigids of at least two points and hedgehogs, i.e. the clusters 
+       that may be matched by Derive<X> methods"""
+
+    kinds = ("rigid", "hedgehog")
+    
+    def __init__(self, solver): 
+        self._solver = solver
+        incremental.Filter.__init__(self, lambda c: cluster_kind(c) in self.kinds, self._solver.top_level())
+
+    def __hash__(self):
+        return hash((self.__class__, self._solver))
 
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self._solver == other._solver
+        else:
+            return False
+
+    def __repr__(self):
+        return "RigidsAndHogs("+repr(self._solver)+")"
 
 class Points(incremental.Filter):
+
+    kinds = ("point",)
     
     def __init__(self, solver): 
         self._solver = solver
@@ -911,6 +1217,8 @@ class Points(incremental.Filter):
         return "Points("+repr(self._solver)+")"
 
 class Distances(incremental.Filter):
+
+    kinds = ("rigid",)
     
     def __init__(self, solver): 
         self._solver = solver
@@ -407,6 +407,109 @@ def num_angles(cluster):
     else:
         return 0
 
+def shared_constraint_count(c1, c2):
+    """returns num_constraints(c1.intersection(c2)), computed from the
+       number of shared variables and the cluster types, without creating
+       an intersection cluster."""
+    if isinstance(c1, Hedgehog) and isinstance(c2, Hedgehog):
+        if c1.cvar != c2.cvar:
+            return 0
+        return binomial(len(c1.xvars.intersection(c2.xvars)), 2)
+    elif isinstance(c1, Hedgehog):
+        c1, c2 = c2, c1
+    if isinstance(c2, Hedgehog):
+        if not isinstance(c1, Rigid) and not isinstance(c1, Balloon):
+            return 0
+        if c2.cvar not in c1.vars:
+            return 0
+        return binomial(len(c1.vars.intersection(c2.xvars)), 2)
+    elif isinstance(c1, Rigid) and isinstance(c2, Rigid):
+        n = len(c1.vars.intersection(c2.vars))
+        return binomial(n,2) + binomial(n,3) * 3
+    elif (isinstance(c1, Rigid) or isinstance(c1, Balloon)) and \
+         (isinstance(c2, Rigid) or isinstance(c2, Balloon)):
+        n = len(c1.vars.intersection(c2.vars))
+        return binomial(n,3) * 3
+    else:
+        # glueables and flexibles do not share constraints
+        return 0
+
+# ----- constraint classes -----
+# A Rigid, Balloon or Hedgehog also represents the class of all distances
+# and angles it determines, so over-constraints can be handled a class
+# at a time, instead of one Distance or Angle object at a time.
+
+def over_constraint_class(c1, c2):
+    """returns a cluster representing the class of over-constraints of
+       a pair of clusters (i.e. over_constraints(c1,c2)), or None if there
+       are no over-constraints."""
+    if isinstance(c1,Glueable) or isinstance(c2,Glueable):
+        return None
+    for c in (c1,c2):
+        if not (isinstance(c,Rigid) or isinstance(c,Balloon) or isinstance(c,Hedgehog)):
+            raise StandardError, "unexpected case"
+    if shared_constraint_count(c1, c2) == 0:
+        return None
+    return c1.intersection(c2)
+
+def _iter_constraints(cluster):
+    """generate the constraints in a cluster as tuples; (a,b) for a
+       distance, (a,c,b) for an angle on center c"""
+    if isinstance(cluster, Hedgehog):
+        xvars = list(cluster.xvars)
+        for i in range(len(xvars)):
+            for j in range(i+1, len(xvars)):
+                yield (xvars[i],cluster.cvar,xvars[j])
+        return
+    vars = list(cluster.vars)
+    if isinstance(cluster, Rigid):
+        for i in range(len(vars)):
+            for j in range(i+1, len(vars)):
+                yield (vars[i],vars[j])
+    for i in range(len(vars)):
+        for j in range(i+1, len(vars)):
+            for k in range(j+1, len(vars)):
+                yield (vars[i],vars[j],vars[k])
+                yield (vars[j],vars[k],vars[i])
+                yield (vars[k],vars[i],vars[j])
+
+def _has_constraint(cluster, con):
+    """true iff the constraint tuple (see _iter_constraints) is in cluster"""
+    if len(con) == 2:
+        return isinstance(cluster, Rigid) and con[0] in cluster.vars and con[1] in cluster.vars
+    elif isinstance(cluster, Rigid) or isinstance(cluster, Balloon):
+        return con[0] in cluster.vars and con[1] in cluster.vars and con[2] in cluster.vars
+    elif isinstance(cluster, Hedgehog):
+        return con[1] == cluster.cvar and con[0] in cluster.xvars and con[2] in cluster.xvars
+    else:
+        return False
+
+def constraints_covered(cluster, others):
+    """true iff every constraint in cluster is also in one of the other clusters.
+       Decided by counting where possible; individual constraints are only
+       enumerated when the counts are inconclusive."""
+    n = num_constraints(cluster)
+    if n == 0:
+        return True
+    counts = []
+    overlapping = []
+    for other in others:
+        count = shared_constraint_count(cluster, other)
+        if count >= n:
+            return True
+        elif count > 0:
+            counts.append(count)
+            overlapping.append(other)
+    if sum(counts) < n:
+        return False
+    for con in _iter_constraints(cluster):
+        for other in overlapping:
+            if _has_constraint(other, con):
+                break
+        else:
+            return False
+    return True
+
 def test():
     r = Rigid([1,3,4,5])
     b = Balloon([1,2,3,4])
@@ -426,6 +529,17 @@ def test():
     print r.intersection(b).intersection(h)
     print r.intersection(h).intersection(b)
     print b.intersection(h).intersection(r)
+    print "shared constraint count"
+    h2 = Hedgehog(1,[3,4,5])
+    for c1 in [r,b,h,h2]:
+        for c2 in [r,b,h,h2]:
+            n = shared_constraint_count(c1,c2)
+            if n != num_constraints(c1.intersection(c2)):
+                print "ERROR", c1, c2, n
+    print "ok"
+    print "covered constraints"
+    print constraints_covered(Rigid([1,2,3]), [Rigid([1,2]), Rigid([2,3]), Rigid([1,3])]), "(False)"
+    print constraints_covered(Balloon([1,2,3]), [Hedgehog(1,[2,3]),Hedgehog(2,[1,3]),Hedgehog(3,[1,2])]), "(True)"
 
 
 if __name__ == "__main__": test()
@@ -2,9 +2,19 @@
 
 A configuration is a set of named points with coordinates."""
 
+import sys
+import heapq
+from UserDict import DictMixin
 from matfunc import Vec, Mat
 from intersections import *
 from tolerance import *
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the number of canonical points used by Configuration.distances_match
+num_canonical = 4
 
 def perp2D(v):
     w = Vec(v)
@@ -21,11 +31,14 @@ class Configuration:
        map - a dictionary mapping variable names to point values.
        dimension - the dimension of the space in which the configuration is embedded
        underconstrained - flag indicating an underconstrained merge (not a unique solution)
+       canonical - list of at most num_canonical variables, used for a quick equality test
+       canonical_distances - list of the distances between the canonical points
     """
     def __init__(self, map):
         """instantiate a Configuration"""
         self.map = dict(map)
         self.underconstrained = False
+        self._frames = {}
         self.dimension = self.checkdimension()
         if self.dimension == 0:
             raise Exception("could not determine dimension of configuration")
@@ -135,16 +148,19 @@ class Configuration:
                 underconstrained = True
                 cs1 = make_hcs_2d(p11, p11+vector.vector([1.0,0.0]))
             else:
-                cs1 = make_hcs_2d(p11, p12)
+                cs1 = self.frame((v1, v2))
             p21 = other.map[v1]
             p22 = other.map[v2]
             if tol_eq(vector.norm(p22-p21),0.0):
                 underconstrained = True
                 cs2 = make_hcs_2d(p21, p21+vector.vector([1.0,0.0]))
             else:
-                cs2 = make_hcs_2d(p21, p22)
+                cs2 = None
         # in any case
-        t = cs_transform_matrix(cs2, cs1)
+        if cs2 is None:
+            t = cs1.mmul(other.frame_inverse((v1, v2)))
+        else:
+            t = cs_transform_matrix(cs2, cs1)
         t.underconstrained = underconstrained
         return t
 
@@ -232,12 +248,12 @@ class Configuration:
             p1s = self.map[v1]
             p2s = self.map[v2]
             p3s = self.map[v3]
-            cs1 = make_hcs_3d(p1s, p2s, p3s)
+            cs1 = self.frame((v1, v2, v3))
             # determine coordinate system for shared points in config2
             p1o = other.map[v1]
             p2o = other.map[v2]
             p3o = other.map[v3]
-            cs2 = make_hcs_3d(p1o, p2o, p3o)
+            cs2 = None
             # determine degeneracies in coordinate systems
             num_degen = 0
             if tol_eq(vector.norm(p2s-p1s),0.0):
@@ -257,7 +273,14 @@ class Configuration:
         if num_degen > 0 and len(self.vars()) > len(shared) and len(other.vars()) > len(shared):
             underconstrained = True
         # determine transform
-        t = cs_transform_matrix(cs2, cs1)
+        if len(shared) > 3:
+            # least squares fit of all shared points
+            shared = list(shared)
+            t = rigid_fit(map(other.get, shared), map(self.get, shared))
+        elif cs2 is None:
+            t = cs1.mmul(other.frame_inverse((v1, v2, v3)))
+        else:
+            t = cs_transform_matrix(cs2, cs1)
         t.underconstrained = underconstrained
         return t
 
@@ -284,6 +307,26 @@ class Configuration:
             merge_scale_trans.underconstrained = merge_trans.underconstrained
             return merge_scale_trans
 
+    def frame(self, vars):
+        """returns the homogeneous coordinate system defined by the points of a 
+           tuple of variables: two in 2D (see make_hcs_2d), three in 3D (see 
+           make_hcs_3d). Frames are cached, since configurations are immutable."""
+        key = ("frame", vars)
+        if key not in self._frames:
+            points = map(self.get, vars)
+            if len(vars) == 2:
+                self._frames[key] = make_hcs_2d(*points)
+            else:
+                self._frames[key] = make_hcs_3d(*points)
+        return self._frames[key]
+
+    def frame_inverse(self, vars):
+        """returns the inverse of frame(vars), also cached"""
+        key = ("inverse", vars)
+        if key not in self._frames:
+            self._frames[key] = hcs_inverse(self.frame(vars))
+        return self._frames[key]
+
     def __eq__(self, other):
         """two configurations are equal if they map onto eachother modulo rotation and translation"""
         if hash(self) != hash(other):
@@ -296,6 +339,8 @@ class Configuration:
             for var in self.map:
                 if var not in other.map:
                     return False
+            if not self.distances_match(other):
+                return False
             # determine a rotation-translation transformation 
             # to transform other onto self
             t = self.merge_transform(other)
@@ -306,13 +351,70 @@ class Configuration:
                 if tol_gt(d, 0.0):
                     return False
             return True 
+
+    def coincides(self, other):
+        """two configurations coincide if they have the same points (within tolerance),
+           not modulo rotation and translation"""
+        if not isinstance(other, Configuration):
+            return False
+        elif len(self.map) != len(other.map):
+            return False
+        elif self.underconstrained != other.underconstrained:
+            return False
+        for var in self.map:
+            if var not in other.map:
+                return False
+            if tol_gt(distance_2p(other.get(var), self.get(var)), 0.0):
+                return False
+        return True
     
+    def rms_distance(self, other):
+        """returns the root mean square distance between the points of this configuration 
+           and the same points in the other configuration, after the best rigid alignment"""
+        shared = filter(lambda var: var in other.map, self.map)
+        return rms_rigid(map(self.get, shared), map(other.get, shared))
+
+    def fingerprint(self, tolerance=default_tol):
+        """returns a hashable value that is equal for configurations with the same
+           points, after rounding coordinates to a multiple of tolerance"""
+        points = []
+        for var in self.map:
+            point = tuple(map(lambda x: int(round(x / tolerance)), self.map[var]))
+            points.append((var, point))
+        return (frozenset(points), self.underconstrained)
+
+    def distances_match(self, other):
+        """a cheap test for equality: returns False if the distances between the 
+           canonical points of this configuration differ from the distances between 
+           the same points in the other configuration, else True."""
+        if other.canonical == self.canonical:
+            others = other.canonical_distances
+        else:
+            others = other._distances(self.canonical)
+        for (d1, d2) in zip(self.canonical_distances, others):
+            if tol_gt(abs(d1 - d2), 2 * default_tol):
+                return False
+        return True
+
+    def _distances(self, vars):
+        """returns the distances between all pairs of the given variables"""
+        distances = []
+        for i in range(len(vars)):
+            for j in range(i):
+                distances.append(distance_2p(self.get(vars[i]), self.get(vars[j])))
+        return distances
+
     def makehash(self):
-        """the hash is based only on variable names (not values)"""
+        """the hash is based only on variable names (not values), so that equal
+           configurations (within tolerance) always have the same hash.
+           Also determines the canonical points, i.e. the first num_canonical 
+           variables, and the distances between them (see distances_match)."""
         val = 0
         for var in self.map:
             val = val + hash(var) 
         self.hashvalue = hash(val)
+        self.canonical = heapq.nsmallest(num_canonical, self.map)
+        self.canonical_distances = self._distances(self.canonical)
 
     def checkdimension(self):
         """returns the dimension of the points, or zero if they are of different dimensions"""
@@ -339,6 +441,225 @@ class Configuration:
     def __getitem__(self,var):
         return self.map[var]
 
+class VariableIndex:
+    """Maps variables to rows of a point array. 
+    
+       Immutable, so it can be shared by configurations with the same variables.
+
+       Attributes:
+       vars - list of variables, in row order
+       rows - a dictionary mapping variables to row numbers
+    """
+    def __init__(self, vars):
+        self.vars = list(vars)
+        self.rows = dict(map(lambda (row, var): (var, row), enumerate(self.vars)))
+
+    def __len__(self):
+        return len(self.vars)
+
+class PointMap(DictMixin):
+    """A read-only dictionary view on a point array, mapping variables to 
+       vectors (copies of rows of the array)."""
+    def __init__(self, array, index):
+        self._array = array
+        self._index = index
+
+    def __getitem__(self, var):
+        return vector.vector(self._array[self._index.rows[var]].tolist())
+
+    def __contains__(self, var):
+        return var in self._index.rows
+
+    def __iter__(self):
+        return iter(self._index.vars)
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return list(self._index.vars)
+
+class ArrayConfiguration(Configuration):
+    """A Configuration that stores its points as rows of a (n, dimension) numpy 
+       array of float64, with a VariableIndex mapping variables to rows. 
+
+       Transformations, additions and selections operate on whole arrays. 
+       Transformed configurations share the index of the original.
+       The dictionary interface (map, get, __getitem__) is kept as a view.
+       Requires numpy. 
+
+       Attributes (in addition to those of Configuration):
+       array - the point array
+       index - the VariableIndex
+    """
+    def __init__(self, map):
+        """instantiate an ArrayConfiguration from a dictionary mapping variables to points. 
+           A PointMap is used as is, without copying its array."""
+        if numpy == None:
+            raise Exception("ArrayConfiguration requires numpy")
+        if isinstance(map, PointMap):
+            self.array = map._array
+            self.index = map._index
+        else:
+            self.index = VariableIndex(map.keys())
+            self.array = numpy.array([map[var] for var in self.index.vars], dtype=numpy.float64)
+        if len(self.index) == 0 or len(self.array.shape) != 2:
+            raise Exception("could not determine dimension of configuration")
+        self.map = PointMap(self.array, self.index)
+        self.underconstrained = False
+        self._frames = {}
+        self.dimension = self.array.shape[1]
+        if self.dimension < 2 or self.dimension > 3:
+            raise Exception("no support for "+str(self.dimension)+"-dimensional configurations")
+        self.makehash()
+
+    def _make(self, array, index):
+        """returns a new ArrayConfiguration on the given array and index"""
+        return ArrayConfiguration(PointMap(array, index))
+
+    def _to_array(self, other):
+        """returns the points of other (any Configuration) as an array and an index"""
+        if isinstance(other, ArrayConfiguration):
+            return (other.array, other.index)
+        index = VariableIndex(other.vars())
+        return (numpy.array(map(other.get, index.vars), dtype=numpy.float64), index)
+
+    def copy(self):
+        """returns a shallow copy"""
+        new = self._make(self.array, self.index)
+        new.underconstrained = self.underconstrained
+        return new 
+
+    def get(self, var):
+        """return position of point var"""
+        return self.map[var]
+
+    def transform(self, t):
+        """returns a new configuration, which is this one transformed by matrix t"""
+        t = numpy.array(t, dtype=numpy.float64)
+        d = self.dimension
+        ph = numpy.dot(self.array, t[:d,:d].T) + t[:d,d]
+        w = numpy.dot(self.array, t[d,:d]) + t[d,d]
+        return self._make(ph / w[:,numpy.newaxis], self.index)
+
+    def add(self, other):
+        """return a new configuration which is this configuration extended with all points in c not in this configuration"""
+        (array, index) = self._to_array(other)
+        extra = filter(lambda var: var not in self.index.rows, index.vars)
+        if len(extra) == 0:
+            return self._make(self.array, self.index)
+        rows = map(lambda var: index.rows[var], extra)
+        newarray = numpy.concatenate((self.array, array[rows]))
+        return self._make(newarray, VariableIndex(self.index.vars + extra))
+
+    def select(self, vars):
+        """return a new configuration that is a subconfiguration of this configuration, containing only the selected variables"""
+        vars = list(vars)
+        rows = map(lambda var: self.index.rows[var], vars)
+        return self._make(self.array[rows], VariableIndex(vars))
+
+    def coincides(self, other):
+        """two configurations coincide if they have the same points (within tolerance),
+           not modulo rotation and translation"""
+        if not isinstance(other, Configuration):
+            return False
+        elif len(self.map) != len(other.map):
+            return False
+        elif self.underconstrained != other.underconstrained:
+            return False
+        (array, index) = self._to_array(other)
+        for var in self.index.vars:
+            if var not in index.rows:
+                return False
+        if index is not self.index:
+            array = array[map(lambda var: index.rows[var], self.index.vars)]
+        distances = numpy.sqrt(numpy.sum((array - self.array)**2, axis=1))
+        return not tol_gt(numpy.max(distances), 0.0)
+
+    def makehash(self):
+        """the hash is based only on variable names (see Configuration.makehash)"""
+        val = 0
+        for var in self.index.vars:
+            val = val + hash(var) 
+        self.hashvalue = hash(val)
+        self.canonical = heapq.nsmallest(num_canonical, self.index.vars)
+        self.canonical_distances = self._distances(self.canonical)
+
+    def fingerprint(self, tolerance=default_tol):
+        """returns a hashable value that is equal for configurations with the same
+           points, after rounding coordinates to a multiple of tolerance"""
+        rounded = numpy.round(self.array / tolerance).astype(int).tolist()
+        points = map(lambda var, point: (var, tuple(point)), self.index.vars, rounded)
+        return (frozenset(points), self.underconstrained)
+
+    def __str__(self):
+        map = dict(self.map)
+        if self.underconstrained:
+            return "Configuration("+str(map)+" underconstrained)"
+        else:
+            return "Configuration("+str(map)+")"
+
+# the Configuration class used by make_configuration (see set_backend)
+_backend = Configuration
+
+def set_backend(name):
+    """Selects the class of the configurations made by make_configuration:
+       "dict" for Configuration, "array" for ArrayConfiguration (requires numpy)."""
+    global _backend
+    if name == "dict":
+        _backend = Configuration
+    elif name == "array":
+        if numpy == None:
+            raise Exception("the array backend requires numpy")
+        _backend = ArrayConfiguration
+    else:
+        raise Exception("unknown configuration backend "+str(name))
+
+def get_backend():
+    """Returns the name of the backend selected with set_backend"""
+    if _backend == ArrayConfiguration:
+        return "array"
+    else:
+        return "dict"
+
+def make_configuration(map):
+    """Returns a configuration for the given map, using the backend selected with set_backend"""
+    return _backend(map)
+
+def equal_configurations(value1, value2):
+    """Returns True iff value1 and value2 are collections of the same configurations, 
+       i.e. every configuration in one coincides with a configuration in the other. 
+       Other values are compared with ==."""
+    collections = (list, tuple, set, frozenset)
+    if not isinstance(value1, collections) or not isinstance(value2, collections):
+        return value1 == value2
+    if len(value1) != len(value2):
+        return False
+    for (values, others) in [(value1, value2), (value2, value1)]:
+        for c1 in values:
+            for c2 in others:
+                if c1 is c2 or (isinstance(c1, Configuration) and c1.coincides(c2)):
+                    break
+            else:
+                return False
+    return True
+
+def configurations_size(value):
+    """Returns an estimate of the memory used by a collection of configurations, 
+       in bytes, including the maps and points of the configurations. 
+       For other values, returns sys.getsizeof."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        for config in value:
+            size += sys.getsizeof(config)
+            if isinstance(config, ArrayConfiguration):
+                size += config.array.nbytes
+            elif isinstance(config, Configuration):
+                size += sys.getsizeof(config.map)
+                for point in config.map.itervalues():
+                    size += sys.getsizeof(point) + sum(map(sys.getsizeof, point))
+    return size
+
 def testeq():
     p1 = vector.vector([0.0,0.0,0.0])
     p2 = vector.vector([1.0,0.0,0.0])
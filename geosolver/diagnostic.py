@@ -24,6 +24,11 @@ def diag_direct(stream):
     global diag_stream
     diag_stream = stream
 
+def diag_selected(code=''):
+    """True iff messages with the given code are printed. Use this to avoid
+       computing expensive diagnostic information that would not be printed."""
+    return diag_selector.match(code) != None
+
 def diag_print(str, code=''):
     global diag_selector
     global diag_stream
@@ -3,12 +3,13 @@ problems incrementally."""
 
 import vector
 import math
-from clsolver import PrototypeMethod, SelectionMethod
+from contextlib import contextmanager
+from clsolver import ClusterMethod
 from clsolver3D import ClusterSolver3D 
 from clsolver2D import ClusterSolver2D 
 from cluster import *
 from selconstr import SelectionConstraint
-from configuration import Configuration 
+from configuration import Configuration, make_configuration
 from diagnostic import diag_print
 from constraint import Constraint, ConstraintGraph
 from notify import Notifier, Listener
@@ -52,19 +53,32 @@ class GeometricProblem (Notifier, Listener):
         self.prototype = {}             # mapping from variables to prototypes
         self.cg = ConstraintGraph()     # constraint graph
         self.use_prototype = use_prototype;     # whether to use prototype for solution selection
+        self.solution_beam = None       # number of solutions nearest to prototype to keep, or None
+        self._batch_depth = 0           # nesting depth of begin_batch/commit calls
 
     # ----------- prototype --------
 
     def set_prototype_selection(self, enabled):
         """Enable (True, the default) or disable (False) use of prototype for solution selection"""
         self.use_prototype = enabled
-        self.dr.set_prototype_selection(self.use_prototype)
         self.send_notify(("set_prototype_selection", self.use_prototype))
 
     def get_prototype_selection(self):
         """Return True if prototype selection has been enabled (the default) or False otherwise"""
         return self.use_prototype
 
+    def set_solution_beam(self, width):
+        """Keep only the width solutions of each cluster that are nearest to the prototype, 
+           i.e. with the smallest root mean square distance after the best rigid alignment.
+           Solutions are then ranked by this distance. If width is None (the default), 
+           all solutions are kept."""
+        self.solution_beam = width
+        self.send_notify(("set_solution_beam", width))
+
+    def get_solution_beam(self):
+        """Return the width set with set_solution_beam, or None"""
+        return self.solution_beam
+
     # ---------------- variables -----------
 
     def add_variable(self, variable, prototype):
@@ -129,6 +143,39 @@ class GeometricProblem (Notifier, Listener):
         """depricated - use get_prototype"""
         return self.get_prototype(variable)
     
+    # ----------- batch editing --------
+
+    def begin_batch(self):
+        """Start a batch of edits. Until the matching commit, solvers only record 
+           added and removed variables and constraints, and do not solve the problem."""
+        self._batch_depth += 1
+        if self._batch_depth == 1:
+            self.send_notify(("begin_batch", None))
+
+    def commit(self):
+        """End a batch of edits started with begin_batch. Solvers solve all changes at once."""
+        if self._batch_depth == 0:
+            raise StandardError, "commit without begin_batch"
+        self._batch_depth -= 1
+        if self._batch_depth == 0:
+            self.send_notify(("commit", None))
+
+    def in_batch(self):
+        """Returns True iff begin_batch was called without matching commit"""
+        return self._batch_depth > 0
+
+    @contextmanager
+    def batch(self):
+        """Context manager for batch editing, e.g.
+               with problem.batch():
+                   problem.add_constraint(...)
+        """
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.commit()
+
     # ----------- constraints --------
  
     def add_constraint(self, con):
@@ -161,7 +208,7 @@ class GeometricProblem (Notifier, Listener):
         else:
             raise StandardError, "unsupported constraint type"
         # passed tests, add to poblem
-        if isinstance(self, ParametricConstraint):
+        if isinstance(con, ParametricConstraint):
             con.add_listener(self)
         self.cg.add_constraint(con)
 
@@ -272,6 +319,8 @@ class GeometricProblem (Notifier, Listener):
         if con in self.cg.constraints():
             if isinstance(con, SelectionConstraint): 
                 self.send_notify(("rem_selection_constraint", con))
+            if isinstance(con, ParametricConstraint):
+                con.rem_listener(self)
             self.cg.rem_constraint(con)
         else:
             raise StandardError, "no constraint "+str(con)+" in problem."
@@ -305,11 +354,21 @@ class GeometricSolver (Listener):
     """
 
     # public methods
-    def __init__(self, problem):
+    def __init__(self, problem, scheduler=None, lazy=False, executor=None, fused_selection=False):
         """Create a new GeometricSolver instance
         
            keyword args
             problem        - the GeometricProblem instance to be monitored for changes
+            scheduler      - chooses the order in which clusters are merged 
+                             (see clsolver.CostScheduler), or None to merge in the 
+                             order found
+            lazy           - if True, solutions of clusters are only computed when 
+                             requested (see set_lazy)
+            executor       - executes the merges of independent clusters at the 
+                             same time (see set_executor), or None to execute
+                             merges one after another
+            fused_selection - if True, merges select their solutions themselves
+                             (see clsolver.ClusterSolver.set_fused_selection)
         """
         # init superclasses
         Listener.__init__(self)
@@ -328,6 +387,11 @@ class GeometricSolver (Listener):
             self.dr = ClusterSolver3D()
         else:
             raise StandardError, "Sorry, can't solve problems of dimension < 2 or > 3."
+        self.dr.set_scheduler(scheduler)
+        self.dr.set_lazy(lazy)
+        self.dr.set_executor(executor)
+        self.dr.set_fused_selection(fused_selection)
+        self.dr.set_solution_beam(problem.get_solution_beam())
         
         # a map from problem variables and constraints to clusters, and vice versa
         self._map = {}
@@ -338,10 +402,15 @@ class GeometricSolver (Listener):
         # register 
         self.cg.add_listener(self)
         self.dr.add_listener(self)
+        self.problem.add_listener(self)
+
+        # solve initial problem in one batch
+        self.dr.begin_batch()
 
         # create an initial fix cluster
         self.fixvars = []
         self.fixcluster = None
+        self._fix_changed = False
 
         # add variables
         for var in self.cg.variables():
@@ -372,6 +441,33 @@ class GeometricSolver (Listener):
         for con in toadd:
             self._add_constraint(con)
 
+        # solve, unless the problem is being edited in a batch
+        if not self.problem.in_batch():
+            self._commit()
+
+    def set_lazy(self, lazy):
+        """Enable (True) or disable (False) lazy evaluation. In lazy mode, 
+           changes are not propagated through the whole decomposition. 
+           Instead, the solutions of a cluster in the decomposition are 
+           computed when they, or its flag, are first used."""
+        self.dr.set_lazy(lazy)
+
+    def is_lazy(self):
+        """True iff lazy evaluation is enabled (see set_lazy)"""
+        return self.dr.is_lazy()
+
+    def set_executor(self, executor):
+        """Set the executor used to compute the solutions of clusters that do
+           not depend on each other (see ClusterSolver.set_executor)."""
+        self.dr.set_executor(executor)
+
+    def set_memory_budget(self, budget):
+        """Bound the memory used by the solutions of intermediate clusters in 
+           the decomposition to approximately budget bytes, or None for no bound. 
+           Dropped solutions are computed again when used 
+           (see ClusterSolver.set_memory_budget)."""
+        self.dr.set_memory_budget(budget)
+
     def get_constrainedness(self):
         """Depricated. Use get_status instead"""
         return self.get_status()
@@ -407,35 +503,19 @@ class GeometricSolver (Listener):
             # pick newest drcluster 
             drclusters = map[geocluster]
             drcluster = max(drclusters, key=lambda c: c.creationtime)
-            # determine solutions
-            geocluster.solutions = self._map_cluster_solutions(drcluster)
-            # determine incidental underconstrainedness
-            underconstrained = False
-            configurations = self.dr.get(drcluster)
-            if configurations != None:
-                for config in configurations:
-                    if config.underconstrained:
-                        underconstrained = True
-            # determine flag
-            if drcluster.overconstrained:
-                geocluster.flag = GeometricDecomposition.OVERCONSTRAINED
-            elif geocluster.solutions == None:
-                geocluster.flag = GeometricDecomposition.UNSOLVED
-            elif len(geocluster.solutions) == 0:
-                geocluster.flag = GeometricDecomposition.INCONSISTENT
-            elif underconstrained:
-                geocluster.flag = GeometricDecomposition.DEGENERTE
+            if self.dr.is_lazy():
+                # determine solutions and flag when first used
+                geocluster._defer(self._determine_solutions, drcluster)
             else:
-                geocluster.flag = GeometricDecomposition.OK
-
+                self._determine_solutions(geocluster, drcluster)
 
         # determine subclusters
         for method in self.dr.methods():
-            if not isinstance(method, PrototypeMethod) and not isinstance(method, SelectionMethod):
+            if isinstance(method, ClusterMethod):
                 for out in method.outputs():
                     if isinstance(out, Rigid):
                         parent = map[out]
-                        for inp in method.inputs():
+                        for inp in method.input_clusters():
                             if isinstance(inp, Rigid):
                                 sub = map[inp]
                                 if sub != parent and sub not in parent.subs:
@@ -464,6 +544,29 @@ class GeometricSolver (Listener):
         return result 
 
     
+    def _determine_solutions(self, geocluster, drcluster):
+        """Determine the solutions and flag of a GeometricDecomposition from a drcluster"""
+        # determine solutions
+        geocluster.solutions = self._map_cluster_solutions(drcluster)
+        # determine incidental underconstrainedness
+        underconstrained = False
+        configurations = self.dr.get(drcluster)
+        if configurations != None:
+            for config in configurations:
+                if config.underconstrained:
+                    underconstrained = True
+        # determine flag
+        if drcluster.overconstrained:
+            geocluster.flag = GeometricDecomposition.OVERCONSTRAINED
+        elif geocluster.solutions == None:
+            geocluster.flag = GeometricDecomposition.UNSOLVED
+        elif len(geocluster.solutions) == 0:
+            geocluster.flag = GeometricDecomposition.INCONSISTENT
+        elif underconstrained:
+            geocluster.flag = GeometricDecomposition.DEGENERTE
+        else:
+            geocluster.flag = GeometricDecomposition.OK
+
     def get_solutions(self):
         """Returns a list of Configurations, which will be empty if the
            problem has no solutions. Note: this method is
@@ -474,7 +577,7 @@ class GeometricSolver (Listener):
         # find top level rigid and all its configurations
         rigids = filter(lambda c: isinstance(c, Rigid), self.dr.top_level())
         if len(rigids) != 0:   
-            solutions = self._map_cluster_solutions(drcluster)
+            solutions = self._map_cluster_solutions(rigids[0])
         else:
             solutions = []
         return solutions
@@ -482,6 +585,9 @@ class GeometricSolver (Listener):
     def _map_cluster_solutions(self, drcluster):
         # map dr-cluster configurations to solutions, i.e. a map from problem variables to values           
         configurations = self.dr.get(drcluster)
+        if configurations != None and self.dr.get_solution_beam() != None:
+            # nearest to prototype first
+            configurations = sorted(configurations, key=self.dr.prototype_distance)
         solutions = []
         diag_print("mapping cluster "+str(drcluster)+" #configurations="+str(len(configurations)),"GeometricSolver")
         for configuration in configurations:
@@ -575,17 +681,28 @@ class GeometricSolver (Listener):
             elif type == "rem_variable":
                 self._rem_variable(data)
             elif type == "set_prototype_selection":
-                self.set_prototype_selection(data)
+                self._set_prototype_selection(data)
             else:
                 raise StandardError, "unknown message type"+str(type)
         elif object == self.problem:
             (type, data) = message
-            if type == "set_point":
+            if type == "set_point" or type == "set_prototype":
                 (variable, point) = data
                 self._update_variable(variable) 
             elif type == "set_parameter":
                 (constraint, value) = data
                 self._update_constraint(constraint)
+            elif type == "set_solution_beam":
+                self.dr.set_solution_beam(data)
+            elif type == "begin_batch":
+                self.dr.begin_batch()
+            elif type == "commit":
+                self._commit()
+            elif type == "rem_selection_constraint":
+                # removed from the decomposition on rem_constraint from self.cg
+                pass
+            elif type == "set_prototype_selection":
+                self._set_prototype_selection(data)
             else:
                 raise StandardError, "unknown message type"+str(type)
         elif object == self.dr:
@@ -781,15 +898,8 @@ class GeometricSolver (Listener):
             # set configuration
             self._update_constraint(con)
         elif isinstance(con, FixConstraint):
-            if self.fixcluster != None:
-                self.dr.remove(self.fixcluster)
             self.fixvars.append(con.variables()[0])
-            if len(self.fixvars) >= 1:
-            #if len(self.fixvars) >= self.problem.dimension:
-                self.fixcluster = Rigid(self.fixvars)
-                self.dr.add(self.fixcluster)
-                self.dr.set_root(self.fixcluster)
-                self._update_fix()
+            self._map_fix()
         elif isinstance(con, SelectionConstraint):
             # add directly to clustersolver
             self.dr.add_selection_constraint(con)
@@ -837,18 +947,10 @@ class GeometricSolver (Listener):
     def _rem_constraint(self, con):
         diag_print("GeometricSolver._rem_constraint","GeometricSolver")
         if isinstance(con,FixConstraint):
-            if self.fixcluster != None:
-                self.dr.remove(self.fixcluster)
             var = con.variables()[0]
             if var in self.fixvars:
                 self.fixvars.remove(var)
-            #if len(self.fixvars) < self.problem.dimension:
-            if len(self.fixvars) == 0:
-                self.fixcluster = None
-            else:
-                self.fixcluster = Rigid(self.fixvars)
-                self.dr.add(self.fixcluster)
-                self.dr.set_root(self.fixcluster)
+            self._map_fix()
         elif isinstance(con, SelectionConstraint):
             # remove directly from clustersolver
             self.dr.rem_selection_constraint(con)
@@ -875,7 +977,7 @@ class GeometricSolver (Listener):
                 p0.append(0.0)
                 p1.append(0.0)
                 p2.append(0.0)
-            conf = Configuration({v0:p0,v1:p1,v2:p2})
+            conf = make_configuration({v0:p0,v1:p1,v2:p2})
             self.dr.set(hog, [conf])
             assert con.satisfied(conf.map)
         elif isinstance(con, DistanceConstraint):
@@ -896,7 +998,7 @@ class GeometricSolver (Listener):
                 v = vector.vector([0.0 for i in range(self.dimension)])
                 v[0] = 1.0
             p1 = p0+v*dist
-            conf = Configuration({v0:p0,v1:p1})
+            conf = make_configuration({v0:p0,v1:p1})
             self.dr.set(rig, [conf])
             assert con.satisfied(conf.map)
         elif isinstance(con, MateConstraint):
@@ -918,7 +1020,7 @@ class GeometricSolver (Listener):
             po2 = transform_point(po1, trans)
             px2 = transform_point(px1, trans)
             py2 = transform_point(py1, trans)
-            conf = Configuration({
+            conf = make_configuration({
                 vo1:po1,
                 vx1:px1,
                 vy1:py1,
@@ -954,8 +1056,8 @@ class GeometricSolver (Listener):
                     pv = vector.vector([1.0,0.0])
                     lv = vector.vector([0.0,0.0])
                     ln = vector.vector([0.0,1.0])
-                    conf1 = Configuration({line_vertex:lv, line_normal:ln, point_vertex: 1.0*pv})
-                    conf2 = Configuration({line_vertex:lv, line_normal:ln, point_vertex:-1.0*pv})
+                    conf1 = make_configuration({line_vertex:lv, line_normal:ln, point_vertex: 1.0*pv})
+                    conf2 = make_configuration({line_vertex:lv, line_normal:ln, point_vertex:-1.0*pv})
                     self.dr.set(angle_hog, [conf1,conf2])
                     diag_print("set "+str(angle_hog)+" to "+str(conf1),"GeometricSolver")
                     diag_print("set "+str(angle_hog)+" to "+str(conf2),"GeometricSolver")
@@ -972,8 +1074,8 @@ class GeometricSolver (Listener):
                     pv = vector.vector([1.0,0.0,0.0])
                     ln1 = vector.vector([0.0,1.0,0.0])
                     ln2 = vector.vector([0.0,0.0,1.0])
-                    conf1 = Configuration({line_vertex:lv, line_normal1:ln1, line_normal2:ln2, point_vertex: 1.0*pv})
-                    conf2 = Configuration({line_vertex:lv, line_normal1:ln1, line_normal2:ln2, point_vertex:-1.0*pv})
+                    conf1 = make_configuration({line_vertex:lv, line_normal1:ln1, line_normal2:ln2, point_vertex: 1.0*pv})
+                    conf2 = make_configuration({line_vertex:lv, line_normal1:ln1, line_normal2:ln2, point_vertex:-1.0*pv})
                     self.dr.set(angle_hog, [conf1,conf2])
                     diag_print("set "+str(angle_hog)+" to "+str(conf1),"GeometricSolver")
                     diag_print("set "+str(angle_hog)+" to "+str(conf2),"GeometricSolver")
@@ -995,7 +1097,7 @@ class GeometricSolver (Listener):
     def _update_point(self, variable):
         cluster = self._map[variable]
         proto = self.problem.get_prototype(variable)
-        conf = Configuration({variable:proto})
+        conf = make_configuration({variable:proto})
         self.dr.set(cluster, [conf])
 
     def _update_line(self, variable):
@@ -1012,16 +1114,16 @@ class GeometricSolver (Listener):
             # update prototypes of created point variables
             if line_vertex in self._map:
                 vertex_rigid = self._map[line_vertex]
-                conf = Configuration({line_vertex: v})
+                conf = make_configuration({line_vertex: v})
                 self.dr.set(vertex_rigid, [conf])
                 diag_print("set "+str(vertex_rigid)+" to "+str(conf),"GeometricSolver")
             if line_normal in self._map:
                 normal_rigid = self._map[line_normal]
-                conf = Configuration({line_normal: n})
+                conf = make_configuration({line_normal: n})
                 self.dr.set(normal_rigid, [conf])
                 diag_print("set "+str(normal_rigid)+" to "+str(conf),"GeometricSolver")
             # update line configuration
-            conf = Configuration({line_vertex:v, line_normal:n})
+            conf = make_configuration({line_vertex:v, line_normal:n})
             self.dr.set(cluster, [conf])
             diag_print("set "+str(cluster)+" to "+str(conf),"GeometricSolver")
         elif self.dimension == 3:
@@ -1039,33 +1141,60 @@ class GeometricSolver (Listener):
             # update prototypes of created point variables
             if line_vertex in self._map:
                 vertex_rigid = self._map[line_vertex]
-                conf = Configuration({line_vertex: v})
+                conf = make_configuration({line_vertex: v})
                 self.dr.set(vertex_rigid, [conf])
                 diag_print("set "+str(vertex_rigid)+" to "+str(conf),"GeometricSolver")
             if line_normal1 in self._map:
                 normal1_rigid = self._map[line_normal1]
-                conf = Configuration({line_normal1: n1})
+                conf = make_configuration({line_normal1: n1})
                 self.dr.set(normal1_rigid, [conf])
                 diag_print("set "+str(normal1_rigid)+" to "+str(conf),"GeometricSolver")
             if line_normal2 in self._map:
                 normal2_rigid = self._map[line_normal2]
-                conf = Configuration({line_normal2: n2})
+                conf = make_configuration({line_normal2: n2})
                 self.dr.set(normal2_rigid, [conf])
                 diag_print("set "+str(normal2_rigid)+" to "+str(conf),"GeometricSolver")
             # update line configuration
-            conf = Configuration({line_vertex:v, line_normal1:n1, line_normal2:n2})
+            conf = make_configuration({line_vertex:v, line_normal1:n1, line_normal2:n2})
             self.dr.set(cluster, [conf])
             diag_print("set "+str(cluster)+" to "+str(conf),"GeometricSolver")
         #endif dimension
     #fed _update_line
 
+    def _map_fix(self):
+        # map fixed variables to a new fix cluster, which becomes the root cluster.
+        # In a batch, this is postponed until commit, so fixed points are added after
+        # all other clusters have been merged (as when fixes are added one at a time)
+        if self.dr.in_batch():
+            self._fix_changed = True
+            return
+        self._fix_changed = False
+        if self.fixcluster != None:
+            self.dr.remove(self.fixcluster)
+        #if len(self.fixvars) < self.problem.dimension:
+        if len(self.fixvars) == 0:
+            self.fixcluster = None
+        else:
+            self.fixcluster = Rigid(self.fixvars)
+            self.dr.add(self.fixcluster)
+            self.dr.set_root(self.fixcluster)
+            self._update_fix()
+
+    def _commit(self):
+        # solve all changes since dr.begin_batch
+        self.dr.commit()
+        if self._fix_changed:
+            self._map_fix()
+
     def _update_fix(self):
-        if self.fixcluster:
+        if self._fix_changed:
+            diag_print("fixcluster will be updated at commit","geometric")
+        elif self.fixcluster:
             vars = self.fixcluster.vars
             map = {}
             for var in vars:
                 map[var] = self.problem.get_fix(var).get_parameter()
-            conf = Configuration(map)
+            conf = make_configuration(map)
             self.dr.set(self.fixcluster, [conf])
         else:
             diag_print("no fixcluster to update","geometric")
@@ -1119,6 +1248,19 @@ class GeometricDecomposition:
         self.subs = []
         self.flag = GeometricDecomposition.OK
 
+    def _defer(self, function, *args):
+        """Determine solutions and flag by calling function(self, *args) when first used"""
+        del self.solutions
+        del self.flag
+        self._deferred = (function, args)
+
+    def __getattr__(self, name):
+        if name in ("solutions", "flag") and "_deferred" in self.__dict__:
+            (function, args) = self.__dict__.pop("_deferred")
+            function(self, *args)
+            return getattr(self, name)
+        raise AttributeError, name
+
     def __eq__(self, other):
         if isinstance(other, GeometricDecomposition): 
             return self.variables == other.variables
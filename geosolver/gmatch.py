@@ -82,6 +82,134 @@ def gmatch(pattern, reference):
 #gmatch
 
 
+class CompiledPattern:
+    """A pattern graph, compiled into search plans for imatch.
+
+       A search plan is an ordering of the pattern vertices, such that the 
+       most constrained vertex (the vertex with the most edges to vertices 
+       earlier in the plan) comes first. Candidates for a vertex are taken 
+       from the neighbours of a matched vertex, if possible.
+       Plans depend on which pattern vertices are in the reference graph 
+       (these are matched exactly), so plans are made and stored on demand. 
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self._plans = {}
+
+    def plan(self, reference):
+        """returns the search plan for the given reference graph, a list 
+           of tuples (patvar, fixed, fanin, fanout, loop, anchor, checks), 
+           where loop is True iff patvar has an edge to itself, anchor is 
+           None or a pair (patvar, outgoing) and checks is a list of pairs
+           (patvar, outgoing) for edges to pattern vertices earlier in the plan.
+        """
+        fixed = frozenset(filter(reference.has_vertex, self.pattern.vertices()))
+        if fixed not in self._plans:
+            self._plans[fixed] = self._make_plan(fixed)
+        return self._plans[fixed]
+
+    def _make_plan(self, fixed):
+        pattern = self.pattern
+        order = list(fixed)
+        order.sort()
+        todo = set(pattern.vertices()) - fixed
+        while len(todo) > 0:
+            def rank(v):
+                nordered = len(filter(lambda w: w in ordered, pattern.adjacent_vertices(v)))
+                return (nordered, len(pattern.adjacent_vertices(v)), str(v))
+            ordered = set(order)
+            best = max(todo, key=rank)
+            order.append(best)
+            todo.remove(best)
+        plan = []
+        for i in range(len(order)):
+            patvar = order[i]
+            earlier = set(order[:i])
+            checks = []
+            for v in pattern.ingoing_vertices(patvar):
+                if v in earlier:
+                    checks.append((v, True))
+            for v in pattern.outgoing_vertices(patvar):
+                if v in earlier:
+                    checks.append((v, False))
+            if len(checks) > 0:
+                anchor = checks[0]
+            else:
+                anchor = None
+            fanin = len(pattern.ingoing_vertices(patvar))
+            fanout = len(pattern.outgoing_vertices(patvar))
+            loop = pattern.has_edge(patvar, patvar)
+            plan.append((patvar, patvar in fixed, fanin, fanout, loop, anchor, checks))
+        return plan
+
+# end class CompiledPattern
+
+
+def compile_pattern(pattern):
+    """Compile a pattern graph for matching with imatch"""
+    return CompiledPattern(pattern)
+
+def imatch(pattern, reference):
+    """Match pattern graph to reference graph, like gmatch, but generates
+       the solutions one at a time, so the caller may stop after any solution.
+       The pattern may be a graph or a CompiledPattern. 
+    """
+    if not isinstance(pattern, CompiledPattern):
+        pattern = CompiledPattern(pattern)
+    plan = pattern.plan(reference)
+    return _imatch_search(plan, 0, reference, {})
+
+def _imatch_search(plan, i, reference, match):
+    if i == len(plan):
+        yield dict(match)
+        return
+    (patvar, fixed, fanin, fanout, loop, anchor, checks) = plan[i]
+    if fixed:
+        candidates = [patvar]
+    elif anchor == None:
+        candidates = reference.vertices()
+    else:
+        (v, outgoing) = anchor
+        if outgoing:
+            candidates = reference.outgoing_vertices(match[v])
+        else:
+            candidates = reference.ingoing_vertices(match[v])
+    for refvar in candidates:
+        # check no double assignments
+        if patvar in match and match[patvar] != refvar:
+            continue
+        if refvar in match and match[refvar] != patvar:
+            continue
+        # check fan-in and fan-out
+        if not fixed:
+            if len(reference.ingoing_vertices(refvar)) < fanin:
+                continue
+            if len(reference.outgoing_vertices(refvar)) < fanout:
+                continue
+        # check edges
+        if loop and not reference.has_edge(refvar, refvar):
+            continue
+        consistent = True
+        for (v, outgoing) in checks:
+            if outgoing:
+                consistent = reference.has_edge(match[v], refvar)
+            else:
+                consistent = reference.has_edge(refvar, match[v])
+            if not consistent:
+                break
+        if not consistent:
+            continue
+        added = filter(lambda x: x not in match, set([patvar, refvar]))
+        match[patvar] = refvar
+        match[refvar] = patvar
+        for solution in _imatch_search(plan, i+1, reference, match):
+            yield solution
+        for x in added:
+            del match[x]
+    #for
+
+
 def test():
     print "matching a triangle" 
     pattern = Graph()
@@ -121,6 +249,15 @@ def test():
     print s
     print len(s),"solutions"
 
+    print "generating matches of random pattern in random graph"
+    s2 = list(imatch(pattern, reference))
+    print len(s2),"solutions"
+    # note: gmatch does not check edges from a vertex to itself
+    valid = lambda m: reduce(lambda x,e: x and reference.has_edge(m[e[0]],m[e[1]]), pattern.edges(), True)
+    s = filter(valid, s)
+    if set(map(lambda m: frozenset(m.items()), s)) != set(map(lambda m: frozenset(m.items()), s2)):
+        print "ERROR: solutions differ from gmatch"
+
 
 if __name__ == "__main__": test()
 
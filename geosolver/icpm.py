@@ -1,6 +1,5 @@
 """Incremental Cluster Pattern Matching"""
 
-from clsolver import ClusterSolver
 from diagnostic import diag_print
 from cluster import Rigid, Hedgehog, Balloon
 from incremental import IncrementalSet,MutableSet,Filter
@@ -11,15 +10,25 @@ class KindFilter(Filter):
         kind2class = {}
         kind2class["rigid"]=Rigid
         kind2class["hog"]=Hedgehog
+        kind2class["hedgehog"]=Hedgehog
         kind2class["balloon"]=Balloon
         kind2class["distance"]=Rigid
         kind2class["point"]=Rigid
         kind2maxpoints = {}
         kind2maxpoints["rigid"]=0
         kind2maxpoints["hog"]=0
+        kind2maxpoints["hedgehog"]=0
         kind2maxpoints["balloon"]=0
         kind2maxpoints["distance"]=2
         kind2maxpoints["point"]=1
+        kind2indexkinds = {}
+        kind2indexkinds["rigid"]=("point","rigid")
+        kind2indexkinds["hog"]=("hedgehog",)
+        kind2indexkinds["hedgehog"]=("hedgehog",)
+        kind2indexkinds["balloon"]=("balloon",)
+        kind2indexkinds["distance"]=("point","rigid")
+        kind2indexkinds["point"]=("point",)
+        self.kinds = kind2indexkinds[kind]
         self._kind = kind
         self._classobj = kind2class[kind]
         self._maxpoints = kind2maxpoints[kind]
@@ -38,7 +47,7 @@ class KindFilter(Filter):
     
     def __eq__(self, other):
         if isinstance(other, KindFilter):
-            return (self._input, self._kind, self._minpoints)==(other._input,other._kind, self._minpoints)
+            return (self._input, self._kind, self._minpoints)==(other._input,other._kind, other._minpoints)
         else:
             return False 
 
@@ -69,12 +78,11 @@ class NConnectedPairs(IncrementalSet):
         # determine 1-connected objects 
         connected = set()
         for var in obj.vars:
-            dependend = self._solver.find_dependend(var)
             # check that connected objects in both sets
             if source == self._incrset1:
-                dependend = filter(lambda x: x in self._incrset2, dependend)
+                dependend = self._solver.find_top_level_in(var, self._incrset2)
             elif source == self._incrset2:
-                dependend = filter(lambda x: x in self._incrset1, dependend)
+                dependend = self._solver.find_top_level_in(var, self._incrset1)
             connected.update(dependend)
         # dont pair (obj,obj)
         if obj in connected:
@@ -96,11 +104,13 @@ class NConnectedPairs(IncrementalSet):
 
     def _receive_remove(self,source, obj):
         # remove all pairs that contain obj
-        for pair in self._map[obj]:
+        if obj not in self._map:
+            return
+        for pair in list(self._map[obj]):
             (obj1,obj2) = pair
             self._remove(pair)
             # remove pair from mapping
-            self._map[obj1].remove(par)
+            self._map[obj1].remove(pair)
             self._map[obj2].remove(pair)
             # clean up mapping 
             if len(self._map[obj1]) == 0: 
@@ -122,74 +132,222 @@ class NConnectedPairs(IncrementalSet):
 
 
 class PatternMatches(IncrementalSet):
-    """Incrementally matches patterns of clusters"""
-    def __init__(self, pattern, solver):
+    """Incrementally matches patterns of clusters.
+
+       A pattern is a list of tuples (kind, clustername, pointnames), as in
+       clsolver.pattern2graph. A match maps each clustername to a top-level 
+       cluster of the solver and each pointname to a point variable, 
+       such that the clusters are distinct and of the right kind, the point 
+       variables are distinct and in the clusters (for a hedgehog, the first
+       point is the center), like a match found by gmatch. Only one 
+       match is kept for each set of clusters, so matches that only differ
+       by a symmetry of the pattern (or by the choice of point variables)
+       are not repeated.
+
+       Matching is done by a Rete-style network. For each cluster in the pattern
+       there is a KindFilter on the top-level clusters (alpha memory) and a 
+       memory of partial matches, i.e. tuples of clusters for the pattern up 
+       to and including that cluster (beta memory). A new cluster is joined 
+       with partial matches in the previous beta memory that share variables 
+       with it, and each new partial match is joined with the clusters in the 
+       next alpha memory, and so on. When a cluster is removed, all partial
+       matches containing it are removed.
+
+       If a methodclass is given, the set contains instances of methodclass, 
+       created with the matches, else the set contains the matches, as 
+       frozensets of (name, variable or cluster) pairs.
+    """
+
+    def __init__(self, pattern, solver, methodclass=None):
         self._solver = solver
+        self._methodclass = methodclass
         # convert pattern to a set of tuples
         listoftuples = []
         for clusterpattern in pattern:
             (kind, clustername, pointnames) = clusterpattern
             listoftuples.append(tuple([kind, clustername, tuple(pointnames)]))
-        setoftuples = frozenset(listoftuples)
-        self._pattern = setoftuples
-        # create sub-sets for correct type of input clusters
-        self._subs = []
-        # NOTE: we cannot use source like this to link it to a pattern, because sources may be equal!
-        self._source2pattern = {}
-        for clusterpattern in self._pattern:
-            (kind, clustername, pointnames) = clusterpattern
-            sub = KindFilter(kind, len(pointnames),self._solver.top_level())
-            self._subs.append(sub)
-            # NOTE: we cannot use source like this to link it to a pattern, because sources may be equal!
-            self._source2pattern[sub]=[clusterpattern]
-            print "creating",sub,"for",self._source2pattern[sub]
-        #rof
-        # create sub-sets for all pairs of clusters
-        listoftuples = list(setoftuples)
-        l = len(listoftuples) 
-        for i in range(l):
-            for j in range(i+1,l):
-                cp1 = listoftuples[i]
-                cp2 = listoftuples[j]
-                (kind1, clustername1, pointnames1) = cp1
-                (kind2, clustername2, pointnames2) = cp2
-                shared = set(pointnames1).intersection(set(pointnames2))
-                n = len(shared)
-                if n > 0:
-                    kindfilter1 = KindFilter(kind1, len(pointnames1),self._solver.top_level())
-                    kindfilter2 = KindFilter(kind2, len(pointnames2),self._solver.top_level())
-                    sub = NConnectedPairs(solver, n, kindfilter1,kindfilter2)
-                    self._subs.append(sub)
-                    # NOTE: we cannot use source like this to link it to a pattern, because sources may be equal!
-                    self._source2pattern[sub]=[cp1,cp2]
-                    print "creating",sub,"for",self._source2pattern[sub]
-
-        IncrementalSet.__init__(self, self._subs)
-            
+        self._pattern = frozenset(listoftuples)
+        # order cluster patterns such that each shares points with previous ones, if possible
+        self._clusterpatterns = [listoftuples.pop(0)]
+        while len(listoftuples) > 0:
+            def nshared(cp):
+                return len(filter(lambda p: p in cp[2], self._points(len(self._clusterpatterns))))
+            best = max(listoftuples, key=nshared)
+            listoftuples.remove(best)
+            self._clusterpatterns.append(best)
+        # for each cluster pattern, a point shared with previous cluster patterns, or None
+        self._joinpoints = [None]
+        for i in range(1,len(self._clusterpatterns)):
+            shared = filter(lambda p: p in self._clusterpatterns[i][2], self._points(i))
+            if len(shared) > 0:
+                self._joinpoints.append(shared[0])
+            else:
+                self._joinpoints.append(None)
+        # alpha memories; equal KindFilters are shared, so map each to a list of cluster patterns
+        self._alphas = []
+        self._source2patterns = {}
+        for i in range(len(self._clusterpatterns)):
+            (kind, clustername, pointnames) = self._clusterpatterns[i]
+            alpha = KindFilter(kind, len(pointnames), self._solver.top_level())
+            self._alphas.append(alpha)
+            if alpha not in self._source2patterns:
+                self._source2patterns[alpha] = []
+            self._source2patterns[alpha].append(i)
+        # beta memories; for each cluster pattern, a map from clusters to partial matches with that cluster
+        self._betas = map(lambda i: {}, self._clusterpatterns)
+        # map from sets of clusters of complete matches to objects in this set
+        self._complete = {}
+        IncrementalSet.__init__(self, self._alphas)
+
+    def _points(self, n):
+        """the point names in the first n cluster patterns"""
+        points = set()
+        for (kind, clustername, pointnames) in self._clusterpatterns[:n]:
+            points.update(pointnames)
+        return points
+
     def _receive_add(self, source, object):
-        # NOTE: we cannot use source like this to link it to a pattern, because sources may be equal!
-        print "receive",object
-        pattern = self._source2pattern[source]
-        print "matching sub-pattern", pattern
-        #raise NotImplementedError
+        for i in self._source2patterns[source]:
+            # right activation: join with partial matches in the previous beta memory
+            if i == 0:
+                partials = [()]
+            else:
+                partials = set()
+                neighbours = set()
+                for var in object.vars:
+                    neighbours.update(self._solver.find_top_level(var))
+                for cluster in neighbours:
+                    partials.update(self._betas[i-1].get(cluster, []))
+                if self._joinpoints[i] == None:
+                    partials = self._all_partials(i-1)
+            for partial in list(partials):
+                self._join(partial, object)
                 
     def _receive_remove(self, source, object):        
-        raise NotImplementedError
+        for beta in self._betas:
+            if object not in beta:
+                continue
+            for partial in list(beta[object]):
+                for cluster in partial:
+                    beta[cluster].discard(partial)
+                    if len(beta[cluster]) == 0:
+                        del beta[cluster]
+                key = frozenset(partial)
+                if key in self._complete:
+                    self._remove(self._complete[key])
+                    del self._complete[key]
+
+    def _all_partials(self, i):
+        partials = set()
+        for clusterpartials in self._betas[i].values():
+            partials.update(clusterpartials)
+        return partials
+
+    def _join(self, partial, cluster):
+        """Extend a partial match with a cluster, store and propagate it"""
+        if cluster in partial:
+            return
+        partial = partial + (cluster,)
+        i = len(partial) - 1
+        beta = self._betas[i]
+        if cluster in beta and partial in beta[cluster]:
+            return
+        assignment = self._assign_points(partial)
+        if assignment == None:
+            return
+        # store partial match
+        for c in partial:
+            if c not in beta:
+                beta[c] = set()
+            beta[c].add(partial)
+        if i == len(self._clusterpatterns) - 1:
+            # complete match, unless there is a match with the same clusters
+            key = frozenset(partial)
+            if key in self._complete:
+                return
+            match = dict(assignment)
+            for j in range(len(partial)):
+                match[self._clusterpatterns[j][1]] = partial[j]
+            if self._methodclass != None:
+                result = self._methodclass(match)
+            else:
+                result = frozenset(match.items())
+            self._complete[key] = result
+            diag_print("pattern match: "+str(match),"icpm")
+            self._add(result)
+        else:
+            # left activation: join with clusters in the next alpha memory
+            joinpoint = self._joinpoints[i+1]
+            alpha = self._alphas[i+1]
+            if joinpoint == None:
+                candidates = set(alpha)
+            else:
+                candidates = set()
+                for var in self._domain(partial, joinpoint):
+                    candidates.update(self._solver.find_top_level_in(var, alpha))
+            for candidate in candidates:
+                self._join(partial, candidate)
+
+    def _domain(self, partial, point):
+        """the point variables that a point name can be assigned in a partial match"""
+        domain = None
+        for j in range(len(partial)):
+            (kind, clustername, pointnames) = self._clusterpatterns[j]
+            if point not in pointnames:
+                continue
+            cluster = partial[j]
+            if isinstance(cluster, Hedgehog):
+                if point == pointnames[0]:
+                    vars = set([cluster.cvar])
+                else:
+                    vars = cluster.xvars
+            else:
+                vars = cluster.vars
+            if domain == None:
+                domain = set(vars)
+            else:
+                domain.intersection_update(vars)
+        return domain
+
+    def _assign_points(self, partial):
+        """Returns an assignment of distinct point variables to the point names
+           in a partial match, or None if there is no such assignment."""
+        points = self._points(len(partial))
+        domains = map(lambda p: (p, self._domain(partial, p)), points)
+        domains.sort(key=lambda (p, domain): len(domain))
+        return self._assign_domains(domains, {}, set())
+
+    def _assign_domains(self, domains, assignment, used):
+        if len(domains) == 0:
+            return dict(assignment)
+        (point, domain) = domains[0]
+        for var in domain:
+            if var in used:
+                continue
+            assignment[point] = var
+            used.add(var)
+            result = self._assign_domains(domains[1:], assignment, used)
+            used.remove(var)
+            del assignment[point]
+            if result != None:
+                return result
+        return None
  
     def __eq__(self, other):
         if isinstance(other, PatternMatches):
-            return (self._solver, self._pattern)==(other._solver,other._pattern)
+            return (self._solver, self._pattern, self._methodclass)==(other._solver,other._pattern, other._methodclass)
         else:
             return False 
 
     def __hash__(self):
-        return hash((self._solver, self._pattern))
+        return hash((self._solver, self._pattern, self._methodclass))
 
     def __repr__(self):
         return "PatternMatches(%s,%s)"%(str(self._pattern),str(self._solver))
 
 
 def test_icpm():
+    from clsolver import ClusterSolver
     solver = ClusterSolver([])
     solver.add(Rigid(["p5"]))
     solver.add(Rigid(["p1","p2"]))
@@ -200,6 +358,13 @@ def test_icpm():
             ["rigid", "$d_bc",["$b","$c"]]]
     matches = PatternMatches(pattern, solver)
     print list(matches)
+    print "add", Rigid(["p3","p6"]), Rigid(["p1","p6"])
+    solver.add(Rigid(["p3","p6"]))
+    solver.add(Rigid(["p1","p6"]))
+    print len(matches), "matches"
+    print "remove", Rigid(["p1","p2"])
+    solver.remove(filter(lambda c: c.vars == frozenset(["p1","p2"]), solver.top_level())[0])
+    print len(matches), "matches"
 
 if __name__ == "__main__":
     test_icpm()
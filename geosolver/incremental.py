@@ -261,6 +261,47 @@ class Map(IncrementalSet):
         return "Map(%s,%s)"%(str(self._incrset),str(self._mapfunction))
 
 
+class FlatMap(IncrementalSet):
+    """A set-like container that incrementally maps its input through a function returning
+       a list of outputs, and contains all these outputs.
+       Note that the mapping function must always return the same outputs for the same input."""
+
+    def __init__(self, mapfunction, incrset):
+        self._incrset = incrset
+        self._mapfunction = mapfunction
+        self._localmap = {}     # ensure we don't have to evalute mapfunction on removal
+        self._count = {}        # number of inputs mapped to each output
+        IncrementalSet.__init__(self, [incrset])
+
+    def _receive_add(self, source, object):
+        if object not in self._localmap:
+            mapped = self._mapfunction(object)
+            self._localmap[object] = mapped
+            for obj in mapped:
+                self._count[obj] = self._count.get(obj, 0) + 1
+                self._add(obj)
+
+    def _receive_remove(self, source, object):
+        if object in self._localmap:
+            for obj in self._localmap.pop(object):
+                self._count[obj] -= 1
+                if self._count[obj] == 0:
+                    del self._count[obj]
+                    self._remove(obj)
+
+    def __eq__(self, other):
+        if isinstance(other, FlatMap):
+            return (self._incrset, self._mapfunction)==(other._incrset,other._mapfunction)
+        else:
+            return False
+
+    def __hash__(self):
+        return hash((self._incrset, self._mapfunction))
+
+    def __repr__(self):
+        return "FlatMap(%s,%s)"%(str(self._incrset),str(self._mapfunction))
+
+
 class Permutations(IncrementalSet):
     """A set-like container that incrementally determines all permutations of its inputs (IncrementalSets)"""
 
@@ -447,6 +488,10 @@ def test2():
     sq1 = Map(square,odds1)
     sq2 = Map(square,odds2)
     print set(sq1), set(sq2)
+    divisors = FlatMap(lambda x: filter(lambda d: x % d == 0, range(2,x)), integers)
+    print set(divisors)
+    integers.remove(10)
+    print set(divisors)
     print list(IncrementalSet._all)
 
 def test3():
@@ -4,6 +4,10 @@ import random
 from matfunc import Mat,Vec,eye
 from tolerance import *
 from diagnostic import *
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # ------ misc fucntions ----------
 
@@ -423,12 +427,32 @@ def make_hcs_2d_scaled (a, b):
 def cs_transform_matrix(from_cs, to_cs):
     """returns a transform matrix from from_cs to to_cs"""
     try:
-        transform = to_cs.mmul(from_cs.inverse())
+        transform = to_cs.mmul(hcs_inverse(from_cs))
     except Exception, e:
         print "from_cs=",from_cs
         raise Exception, "from_cs is not a valid coodinate system."
     return transform
 
+def hcs_inverse(hcs):
+    """returns the inverse of a homogeneous coordinate system (or transformation). 
+       If the axes are orthogonal, as for all make_hcs functions and rigid 
+       transformations, the inverse is computed in closed form: the transposed 
+       axes, divided by their squared lengths, and the negated translation. 
+       Other matrices are inverted with Mat.inverse."""
+    d = len(hcs) - 1
+    axes = map(lambda j: map(lambda i: hcs[i][j], range(d)), range(d))
+    lengths = map(lambda axis: sum(map(lambda x: x*x, axis)), axes)
+    orthogonal = hcs[d][d] == 1.0 and max(map(abs, hcs[d][:d])) == 0.0
+    for i in range(d):
+        for j in range(i):
+            dot = sum(map(lambda x, y: x*y, axes[i], axes[j]))
+            orthogonal = orthogonal and tol_eq(dot * dot, 0.0, default_tol * lengths[i] * lengths[j])
+    if not orthogonal or min(lengths) == 0.0:
+        return hcs.inverse()
+    rows = map(lambda axis, length: map(lambda x: x / length, axis), axes, lengths)
+    translation = map(lambda row: -sum(map(lambda x, i: x * hcs[i][d], row, range(d))), rows)
+    return Mat(map(lambda row, t: row + [t], rows, translation) + [[0.0] * d + [1.0]])
+
 # ------- rigid transformations ----------
 
 #--- 2D
@@ -524,6 +548,105 @@ def pivot_scale_3D(pivot,scale):
                 translate_3D(-x, -y, -z)))
 
 
+# ---- rigid alignment 
+
+def _cross_covariance(points1, points2):
+    """Returns the centroids of two lists of corresponding points, the sum of the 
+       squared norms of the centered points and their cross-covariance matrix"""
+    n = len(points1)
+    dim = len(points1[0])
+    c1 = map(lambda i: sum(map(lambda p: p[i], points1)) / n, range(dim))
+    c2 = map(lambda i: sum(map(lambda p: p[i], points2)) / n, range(dim))
+    a = map(lambda p: map(lambda i: p[i] - c1[i], range(dim)), points1)
+    b = map(lambda p: map(lambda i: p[i] - c2[i], range(dim)), points2)
+    norms = sum(map(lambda p: sum(map(lambda x: x*x, p)), a + b))
+    s = map(lambda i: map(lambda j: sum(map(lambda k: a[k][i] * b[k][j], range(n))), range(dim)), range(dim))
+    return (c1, c2, norms, s)
+
+def _horn_matrix(s):
+    """Horn's symmetric matrix for a 3D cross-covariance matrix. Its eigenvector 
+       with the largest eigenvalue is the unit quaternion of the best rotation."""
+    ((sxx, sxy, sxz), (syx, syy, syz), (szx, szy, szz)) = s
+    return [
+        [sxx+syy+szz, syz-szy, szx-sxz, sxy-syx], 
+        [syz-szy, sxx-syy-szz, sxy+syx, szx+sxz], 
+        [szx-sxz, sxy+syx, -sxx+syy-szz, syz+szy], 
+        [sxy-syx, szx+sxz, syz+szy, -sxx-syy+szz]]
+
+def rms_rigid(points1, points2):
+    """Returns the root mean square distance between two lists of corresponding 
+       2D or 3D points, after the rigid transformation (rotation and translation, 
+       no reflection) of the first points that best aligns them with the second 
+       points (Horn, 1987)."""
+    n = len(points1)
+    if n == 0:
+        return 0.0
+    (c1, c2, norms, s) = _cross_covariance(points1, points2)
+    if len(s) == 2:
+        # best rotation angle in closed form
+        best = math.sqrt((s[0][0] + s[1][1])**2 + (s[0][1] - s[1][0])**2)
+    else:
+        # largest eigenvalue of Horn's symmetric matrix, for the best unit quaternion
+        best = max(symmetric_eigenvalues(_horn_matrix(s)))
+    return math.sqrt(max(norms - 2.0 * best, 0.0) / n)
+
+def rigid_fit(points1, points2):
+    """Returns the homogeneous matrix of the rigid transformation (rotation and 
+       translation, no reflection) that maps a list of 2D or 3D points onto a list 
+       of corresponding points with the least sum of squared distances (Horn, 1987)."""
+    (c1, c2, norms, s) = _cross_covariance(points1, points2)
+    if len(s) == 2:
+        angle = math.atan2(s[0][1] - s[1][0], s[0][0] + s[1][1])
+        (c, si) = (math.cos(angle), math.sin(angle))
+        r = [[c, -si], [si, c]]
+    else:
+        (values, vectors) = symmetric_eigen(_horn_matrix(s))
+        k = values.index(max(values))
+        (q0, qx, qy, qz) = map(lambda i: vectors[i][k], range(4))
+        r = [[q0*q0+qx*qx-qy*qy-qz*qz, 2*(qx*qy-q0*qz), 2*(qx*qz+q0*qy)],
+             [2*(qx*qy+q0*qz), q0*q0-qx*qx+qy*qy-qz*qz, 2*(qy*qz-q0*qx)],
+             [2*(qx*qz-q0*qy), 2*(qy*qz+q0*qx), q0*q0-qx*qx-qy*qy+qz*qz]]
+    dim = len(r)
+    t = map(lambda i: c2[i] - sum(map(lambda x, y: x*y, r[i], c1)), range(dim))
+    return Mat(map(lambda row, ti: row + [ti], r, t) + [[0.0] * dim + [1.0]])
+
+def symmetric_eigenvalues(matrix, sweeps=50):
+    """Returns the eigenvalues of a symmetric matrix (a list of rows), 
+       by Jacobi rotations"""
+    return symmetric_eigen(matrix, sweeps)[0]
+
+def symmetric_eigen(matrix, sweeps=50):
+    """Returns the eigenvalues of a symmetric matrix (a list of rows) and a matrix 
+       with the corresponding eigenvectors as columns, by Jacobi rotations"""
+    m = map(list, matrix)
+    n = len(m)
+    v = map(lambda i: map(lambda j: float(i == j), range(n)), range(n))
+    for sweep in range(sweeps):
+        off = sum(map(lambda i: sum(map(lambda j: m[i][j]**2, range(i+1, n))), range(n)))
+        if off < 1e-24 * max(1.0, sum(map(lambda i: m[i][i]**2, range(n)))):
+            break
+        for p in range(n):
+            for q in range(p+1, n):
+                if m[p][q] == 0.0:
+                    continue
+                theta = (m[q][q] - m[p][p]) / (2.0 * m[p][q])
+                t = sign2(theta) / (abs(theta) + math.sqrt(theta**2 + 1.0))
+                c = 1.0 / math.sqrt(t**2 + 1.0)
+                s = t * c
+                for k in range(n):
+                    (mkp, mkq) = (m[k][p], m[k][q])
+                    m[k][p] = c * mkp - s * mkq
+                    m[k][q] = s * mkp + c * mkq
+                for k in range(n):
+                    (mpk, mqk) = (m[p][k], m[q][k])
+                    m[p][k] = c * mpk - s * mqk
+                    m[q][k] = s * mpk + c * mqk
+                for k in range(n):
+                    (vkp, vkq) = (v[k][p], v[k][q])
+                    v[k][p] = c * vkp - s * vkq
+                    v[k][q] = s * vkp + c * vkq
+    return (map(lambda i: m[i][i], range(n)), v)
+
 # ---- applyign transformations
 
 def transform_point(point, transform):
@@ -557,8 +680,283 @@ def normalised(v):
     else:
         return v / n
 
+# ---- batched intersections
+#
+# The functions below solve N problems at once. They take numpy arrays with 
+# one row per problem (points as (N, dim) arrays, scalars as (N,) arrays) and 
+# return an array of solutions of shape (N, k, dim) with a boolean mask of 
+# shape (N, k), where k is the maximum number of solutions. The valid solutions 
+# of a row are those of the corresponding function above, in the same order,
+# using the same toleranced comparisons. Problems for which those functions 
+# raise ZeroDivisionError have no valid solutions. Requires numpy.
+
+def _check_numpy():
+    if numpy == None:
+        raise Exception("batched intersections require numpy")
+
+def _array_tol_gt(a, b, tol=default_tol):
+    """array version of tol_gt"""
+    return a - b > tol
+
+def _array_tol_lt(a, b, tol=default_tol):
+    """array version of tol_lt"""
+    return b - a > tol
+
+def _array_tol_eq(a, b, tol=default_tol):
+    """array version of tol_eq"""
+    return abs(a - b) <= tol
+
+def _array_norm(a):
+    """norms of the rows of a"""
+    return numpy.sqrt(numpy.sum(a * a, axis=-1))
+
+def _array_dot(a, b):
+    """dot products of the rows of a and b"""
+    return numpy.sum(a * b, axis=-1)
+
+def _array_div(a, b):
+    """a / b, with zero where b is zero (the result is masked there)"""
+    safe = numpy.where(b == 0.0, 1.0, b)
+    return numpy.where(b == 0.0, 0.0, a / safe)
+
+def _array_normalised(v):
+    """array version of normalised"""
+    n = _array_norm(v)
+    zero = _array_tol_eq(n, 0.0)
+    return numpy.where(zero[:,None], v, v / numpy.where(zero, 1.0, n)[:,None])
+
+def _array_perp_2d(v, sign=1.0):
+    """the rows of v rotated a quarter turn: (-y, x) for sign 1, (y, -x) for sign -1"""
+    return numpy.column_stack((-v[:,1], v[:,0])) * sign
+
+def _array_sign2(x):
+    """array version of sign2"""
+    return numpy.where(_array_tol_gt(x, 0.0), 1.0, -1.0)
+
+def _batch_args(*args):
+    """converts arguments to float arrays"""
+    _check_numpy()
+    return map(lambda a: numpy.asarray(a, dtype=numpy.float64), args)
+
+def cc_int_batch(p1, r1, p2, r2):
+    """Intersect circles (p1,r1) with circles (p2,r2), where p1 and p2 are 
+       (N,2) arrays and r1 and r2 are (N,) arrays. 
+       Returns solutions (N,2,2) and mask (N,2) (see cc_int)."""
+    (p1, r1, p2, r2) = _batch_args(p1, r1, p2, r2)
+    d = _array_norm(p2-p1)
+    valid = _array_tol_gt(d, 0.0)
+    d = numpy.where(valid, d, 1.0)
+    u = ((r1*r1 - r2*r2)/d + d)/2
+    valid &= ~_array_tol_lt(r1*r1, u*u)
+    v = numpy.sqrt(numpy.maximum(r1*r1 - u*u, 0.0))
+    s = (p2-p1) * (u/d)[:,None]
+    ns = _array_norm(s)
+    centered = _array_tol_eq(ns, 0.0)
+    # s is zero: solutions perpendicular to p1-p2 at distance r1
+    qa = p1 + _array_perp_2d(p1-p2) * (r1/d)[:,None]
+    qb = p1 + _array_perp_2d(p2-p1) * (r1/d)[:,None]
+    qsingle = _array_tol_eq(r1/d, 0.0)
+    # otherwise: solutions at distance v from p1+s
+    f = _array_div(v, ns)
+    pa = p1 + s + _array_perp_2d(s, -1.0) * f[:,None]
+    pb = p1 + s + _array_perp_2d(s) * f[:,None]
+    psingle = _array_tol_eq(f, 0.0)
+    solutions = numpy.empty((len(d), 2, 2))
+    solutions[:,0] = numpy.where(centered[:,None], qa, pa)
+    solutions[:,1] = numpy.where(centered[:,None], qb, pb)
+    single = numpy.where(centered, qsingle, psingle)
+    mask = numpy.column_stack((valid, valid & ~single))
+    return (solutions, mask)
+
+def cl_int_batch(p1, r, p2, v):
+    """Intersect circles (p1,r) with lines (p2,v), where p1, p2 and v are 
+       (N,2) arrays and r is an (N,) array. 
+       Returns solutions (N,2,2) and mask (N,2) (see cl_int)."""
+    (p1, r, p2, v) = _batch_args(p1, r, p2, v)
+    p = p2 - p1
+    d2 = v[:,0]*v[:,0] + v[:,1]*v[:,1]
+    D = p[:,0]*v[:,1] - v[:,0]*p[:,1]
+    E = r*r*d2 - D*D
+    two = _array_tol_gt(d2, 0.0) & _array_tol_gt(E, 0.0)
+    one = ~two & _array_tol_eq(E, 0.0) & (d2 != 0.0)
+    d2 = numpy.where(d2 == 0.0, 1.0, d2)
+    sE = numpy.where(two, numpy.sqrt(numpy.maximum(E, 0.0)), 0.0)
+    x = D * v[:,1]
+    y = -D * v[:,0]
+    dx = _array_sign2(v[:,1]) * v[:,0] * sE
+    dy = abs(v[:,1]) * sE
+    solutions = numpy.empty((len(r), 2, 2))
+    solutions[:,0] = p1 + numpy.column_stack((x + dx, y + dy)) / d2[:,None]
+    solutions[:,1] = p1 + numpy.column_stack((x - dx, y - dy)) / d2[:,None]
+    mask = numpy.column_stack((two | one, two))
+    return (solutions, mask)
+
+def cr_int_batch(p1, r, p2, v):
+    """Intersect circles (p1,r) with rays (p2,v), where p1, p2 and v are 
+       (N,2) arrays and r is an (N,) array. 
+       Returns solutions (N,2,2) and mask (N,2) (see cr_int). Solutions 
+       are in the same positions as for cl_int_batch."""
+    (p1, r, p2, v) = _batch_args(p1, r, p2, v)
+    (solutions, mask) = cl_int_batch(p1, r, p2, v)
+    for k in range(2):
+        mask[:,k] &= ~_array_tol_lt(_array_dot(solutions[:,k]-p2, v), 0.0)
+    return (solutions, mask)
+
+def ll_int_batch(p1, v1, p2, v2):
+    """Intersect lines through p1 with direction v1 with lines through p2 with
+       direction v2, where all arguments are (N,2) arrays.
+       Returns solutions (N,1,2) and mask (N,1) (see ll_int)."""
+    (p1, v1, p2, v2) = _batch_args(p1, v1, p2, v2)
+    valid = ~_array_tol_eq(v1[:,0]*v2[:,1] - v1[:,1]*v2[:,0], 0.0)
+    d = p2 - p1
+    general = ~_array_tol_eq(v2[:,1], 0.0)
+    r2 = _array_div(-v2[:,0], v2[:,1])
+    f = v1[:,0] + v1[:,1]*r2
+    t1 = numpy.where(general, _array_div(d[:,0] + d[:,1]*r2, f), _array_div(d[:,1], v1[:,1]))
+    solutions = (p1 + v1 * t1[:,None])[:,None,:]
+    return (solutions, valid[:,None])
+
+def rr_int_batch(p1, v1, p2, v2):
+    """Intersect rays through p1 with direction v1 with rays through p2 with
+       direction v2, where all arguments are (N,2) arrays.
+       Returns solutions (N,1,2) and mask (N,1) (see rr_int)."""
+    (p1, v1, p2, v2) = _batch_args(p1, v1, p2, v2)
+    (solutions, mask) = ll_int_batch(p1, v1, p2, v2)
+    s = solutions[:,0]
+    mask[:,0] &= ~_array_tol_lt(_array_dot(s-p2, v2), 0.0) 
+    mask[:,0] &= ~_array_tol_lt(_array_dot(s-p1, v1), 0.0)
+    return (solutions, mask)
+
+def sss_int_batch(p1, r1, p2, r2, p3, r3):
+    """Intersect spheres centered in p1, p2, p3 with radius r1, r2, r3, where 
+       p1, p2 and p3 are (N,3) arrays and r1, r2 and r3 are (N,) arrays. 
+       Returns solutions (N,2,3) and mask (N,2) (see sss_int)."""
+    (p1, r1, p2, r2, p3, r3) = _batch_args(p1, r1, p2, r2, p3, r3)
+    count = len(r1)
+    origin = numpy.zeros((count, 2))
+    # intersect circles in plane
+    d12 = _array_norm(p2-p1)
+    (cpxs, cpmask) = cc_int_batch(origin, r1, numpy.column_stack((d12, numpy.zeros(count))), r2)
+    valid = cpmask[:,0]
+    d12 = numpy.where(d12 == 0.0, 1.0, d12)
+    cp = cpxs[:,0]
+    # determine normal of plane though p1, p2, p3
+    n = numpy.cross(p2-p1, p3-p1)
+    nn = _array_norm(n)
+    degenerate = _array_tol_eq(nn, 0.0)
+    n = n / numpy.where(degenerate, 1.0, nn)[:,None]
+    # degenerate triangles: project cp back to 3d and check radius r3 
+    u = _array_normalised(p2-p1)
+    t = numpy.dot(u, numpy.array(perp_matrix)[:3,:3].T)
+    v = _array_normalised(numpy.cross(u, t))
+    p4 = p1 + u * cp[:,0:1] + v * cp[:,1:2]
+    degenerate_valid = valid & degenerate & _array_tol_eq(_array_norm(p4-p3), r3)
+    # px, rx, nx is circle 
+    nx = (p2-p1) / d12[:,None]
+    px = p1 + nx * cp[:,0:1]
+    rx = abs(cp[:,1])
+    # py is projection of p3 on px,nx
+    dy3 = _array_dot(p3-px, nx)
+    py = p3 - nx * dy3[:,None]
+    valid &= ~degenerate & ~_array_tol_gt(dy3, r3)
+    # ry is radius of circle in py
+    ry = numpy.sin(numpy.arccos(numpy.minimum(1.0, abs(_array_div(dy3, r3))))) * r3
+    ry = numpy.where(_array_tol_eq(r3, 0.0), 0.0, ry)
+    # intersect circle px, rx and circle py, ry, relative to line py-px 
+    dxy = _array_norm(py-px)
+    (cp4s, cp4mask) = cc_int_batch(origin, rx, numpy.column_stack((dxy, numpy.zeros(count))), ry)
+    dxy = numpy.where(dxy == 0.0, 1.0, dxy)
+    solutions = numpy.empty((count, 2, 3))
+    for k in range(2):
+        solutions[:,k] = px + (py-px) * (cp4s[:,k,0] / dxy)[:,None] + n * cp4s[:,k,1:2]
+    solutions[:,0] = numpy.where(degenerate[:,None], p4, solutions[:,0])
+    mask = cp4mask & valid[:,None]
+    mask[:,0] |= degenerate_valid
+    return (solutions, mask)
+
+def angle_3p_batch(p1, p2, p3):
+    """Returns the angles, in radians, rotating vectors p2p1 to vectors p2p3, 
+       where p1, p2 and p3 are (N,dim) arrays, and a mask that is False for
+       degenerate (indeterminate) angles (see angle_3p)."""
+    (p1, p2, p3) = _batch_args(p1, p2, p3)
+    d21 = _array_norm(p2-p1)
+    d23 = _array_norm(p3-p2)
+    valid = ~_array_tol_eq(d21, 0.0) & ~_array_tol_eq(d23, 0.0)
+    t = _array_dot(p1-p2, p3-p2) / numpy.where(valid, d21 * d23, 1.0)
+    angle = numpy.arccos(numpy.clip(t, -1.0, 1.0))
+    if p1.shape[1] == 2:
+        # 2D case, negative if counterclockwise
+        u = p2 - p1
+        counterclockwise = _array_tol_gt(_array_dot(_array_perp_2d(u), p3 - p2), 0.0)
+        angle = numpy.where(counterclockwise, -angle, angle)
+    return (angle, valid)
+
 # -------------------------test code -----------------
 
+def test_rms_rigid():
+    points = [vector.vector([0.0,0.0,0.0]), vector.vector([1.0,0.0,0.0]), 
+              vector.vector([0.0,2.0,0.0]), vector.vector([0.0,0.0,3.0])]
+    t = translate_3D(1.0,2.0,3.0).mmul(rotate_3D_x(0.5).mmul(rotate_3D_z(1.0)))
+    moved = map(lambda p: transform_point(p, t), points)
+    print "rms of rotated and translated points (0):", rms_rigid(points, moved)
+    mirrored = map(lambda p: vector.vector([p[0],p[1],-p[2]]), moved)
+    print "rms of mirrored points (>0):", rms_rigid(points, mirrored)
+    print "rms of 2D points rotated (0):", rms_rigid(map(lambda p: p[0:2], points), 
+        map(lambda p: transform_point(p, rotate_2D(2.0)), map(lambda p: p[0:2], points)))
+
+def test_rigid_fit():
+    points = [vector.vector([0.0,0.0,0.0]), vector.vector([1.0,0.0,0.0]), 
+              vector.vector([0.0,2.0,0.0]), vector.vector([0.0,0.0,3.0])]
+    t = translate_3D(1.0,2.0,3.0).mmul(rotate_3D_x(0.5).mmul(rotate_3D_z(1.0)))
+    moved = map(lambda p: transform_point(p, t), points)
+    fit = rigid_fit(points, moved)
+    print "difference fitted and actual transformation (0):", max(map(lambda i: 
+        max(map(lambda j: abs(fit[i][j] - t[i][j]), range(4))), range(4)))
+    inverse = hcs_inverse(t)
+    print "difference closed form and generic inverse (0):", max(map(lambda i: 
+        max(map(lambda j: abs(inverse[i][j] - t.inverse()[i][j]), range(4))), range(4)))
+
+
+def test_batch_intersections(count=1000):
+    """compare batched intersections with the functions they batch, 
+       for random and for degenerate problems"""
+    def random_points(dim):
+        # a few points coincide, to test degenerate cases
+        return map(lambda i: vector.vector(map(lambda j: float(random.randint(-3,3)), range(dim))) 
+            if random.random() < 0.2 else vector.randvec(dim, -3.0, 3.0), range(count))
+    def random_scalars():
+        return map(lambda i: float(random.randint(0,3)) if random.random() < 0.2 
+            else random.uniform(0.0, 4.0), range(count))
+    def compare(name, function, batch, args):
+        (solutions, mask) = batch(*args)
+        errors = 0
+        for i in range(count):
+            try:
+                expected = function(*map(lambda arg: arg[i], args))
+            except ZeroDivisionError:
+                # batched functions mask these problems 
+                expected = []
+            found = map(lambda k: solutions[i][k], filter(lambda k: mask[i][k], range(len(mask[i]))))
+            if len(found) != len(expected):
+                errors += 1
+            elif max([0.0] + map(lambda (p, q): vector.norm(p - vector.vector(list(q))), zip(expected, found))) > 1e-6:
+                errors += 1
+        print name, "batched vs single:", errors, "differences in", count, "problems"
+    compare("cc_int", cc_int, cc_int_batch, [random_points(2), random_scalars(), random_points(2), random_scalars()])
+    compare("cl_int", cl_int, cl_int_batch, [random_points(2), random_scalars(), random_points(2), random_points(2)])
+    compare("cr_int", cr_int, cr_int_batch, [random_points(2), random_scalars(), random_points(2), random_points(2)])
+    compare("rr_int", rr_int, rr_int_batch, [random_points(2), random_points(2), random_points(2), random_points(2)])
+    compare("sss_int", sss_int, sss_int_batch, [random_points(3), random_scalars(), random_points(3), random_scalars(), random_points(3), random_scalars()])
+    for dim in [2, 3]:
+        (p1, p2, p3) = (random_points(dim), random_points(dim), random_points(dim))
+        (angles, mask) = angle_3p_batch(p1, p2, p3)
+        errors = 0
+        for i in range(count):
+            angle = angle_3p(p1[i], p2[i], p3[i])
+            if (angle == None) == mask[i] or (angle != None and abs(angle - angles[i]) > 1e-6):
+                errors += 1
+        print "angle_3p", str(dim)+"D", "batched vs single:", errors, "differences in", count, "problems"
+
 def test_ll_int():
     """test random line-line intersection. returns True iff succesful"""
     # generate tree points A,B,C an two lines AC, BC. 
@@ -842,3 +1240,6 @@ if __name__ == '__main__':
     #test_perp_3d()
     #test_sss_degen()
     #test_hcs_degen()
+    #test_rms_rigid()
+    #test_rigid_fit()
+    #test_batch_intersections()
@@ -12,6 +12,11 @@ Changes:
 23 Nov 2004 - added Error classes, updated naming and doc conventions (PEP 8, 257)
 """
 
+import sys
+import cPickle
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from graph import Graph
 
 # ----------- misc stuff -----------
@@ -114,7 +119,12 @@ class MethodGraph:
     If no value is explicitly associated with a variable, it defaults to None.
     """
 
-    def __init__(self):
+    def __init__(self, equal = None):
+        """Create a method graph. 
+           
+           Optionally, a function equal(oldvalue, newvalue) may be given to 
+           compare the values of variables (default ==). 
+        """
         self._map = {}
         """A map from variable names to values"""
         self._methods = {}
@@ -123,6 +133,37 @@ class MethodGraph:
         """A graph for fast navigation"""
         self._changed = {}
         """Set of changed variables since last propagation"""
+        self._pending = {}
+        """Set of methods to be executed at next propagation"""
+        self._stale = {}
+        """Set of variables whose value is to be computed (see set_lazy)"""
+        self._lazy = False
+        """Flag for lazy evaluation (see set_lazy)"""
+        self._propagation_stats = {"propagations":0, "executed":0, "last":0, "skipped":0, "last_skipped":0}
+        """Number of propagations and method executions (see propagation_stats)"""
+        if equal == None:
+            equal = lambda oldvalue, newvalue: oldvalue == newvalue
+        self._equal = equal
+        """Function to determine if the value of a variable changed"""
+        self._order = {}
+        """A topological order of variables and methods (see _reorder)"""
+        self._next_order = 0
+        """Order given to the next variable or method added"""
+        self._store = None
+        """A map from computed variables to the size of their values, least 
+           recently used first, or None if sizes are not tracked (see set_budget)"""
+        self._evicted = {}
+        """Set of variables whose value was evicted (see set_budget)"""
+        self._budget = None
+        """Maximum total size of the values in the store (see set_budget)"""
+        self._sizeof = None
+        """Function to determine the size of a value (see set_budget)"""
+        self._evictable = None
+        """Function to determine if a variable may be evicted (see set_budget)"""
+        self._store_stats = {"size":0, "peak":0, "evicted":0, "restored":0}
+        """Size of the values in the store and number of evictions (see store_stats)"""
+        self._executor = None
+        """Executor for methods that do not depend on each other (see set_executor)"""
 
     def variables(self):
         """return a list of variables"""
@@ -140,6 +181,7 @@ class MethodGraph:
         if not varname in self._map:
             self._map[varname] = value
             self._graph.add_vertex(varname)
+            self._add_order(varname)
     
     def rem_variable(self, varname):
         """Remove a variable and all methods on that variable"""
@@ -147,6 +189,11 @@ class MethodGraph:
             del self._map[varname]
             if varname in self._changed:
                 del self._changed[varname]
+            if varname in self._stale:
+                del self._stale[varname]
+            if varname in self._evicted:
+                del self._evicted[varname]
+            self._unstore(varname)
             # delete al methods on it
             for met in self._graph.ingoing_vertices(varname):
                 self.rem_method(met)
@@ -154,13 +201,110 @@ class MethodGraph:
                 self.rem_method(met)
             # remove it from graph
             self._graph.rem_vertex(varname)
+            del self._order[varname]
         else:
             raise StandardError, "variable not in graph"
     # end rem variable
 
     def get(self,varname):
-        """get the value of a variable"""
-        return self._map[varname]
+        """get the value of a variable. 
+        
+           In lazy mode, a stale value is computed first (see set_lazy). 
+           An evicted value is computed again (see set_budget). 
+        """
+        if varname in self._stale or varname in self._evicted:
+            self._evaluate([varname])
+        value = self._map[varname]
+        if self._store != None and varname in self._store:
+            # most recently used
+            self._store[varname] = self._store.pop(varname)
+            self._evict()
+        return value
+
+    def is_stale(self, varname):
+        """True iff the value of the variable will be computed when requested
+           with get (in lazy mode, see set_lazy, or if evicted, see set_budget)"""
+        return varname in self._stale or varname in self._evicted
+
+    def set_lazy(self, lazy, prop = True):
+        """Enable (True) or disable (False) lazy evaluation.
+        
+           In lazy mode, propagation only marks the variables downstream 
+           of changes as stale. The value of a stale variable is computed 
+           when requested with get, by executing only the methods it depends 
+           on. Computed values are kept until they become stale again. 
+           When lazy evaluation is disabled, stale values are computed
+           at the next propagation, immediately iff prop is true. 
+        """
+        self._lazy = lazy
+        if not lazy and prop:
+            self.propagate()
+
+    def is_lazy(self):
+        """True iff lazy evaluation is enabled (see set_lazy)"""
+        return self._lazy
+
+    def set_budget(self, budget, sizeof = None, evictable = None):
+        """Bound the memory used by computed values. 
+
+           The values of variables determined by a method are kept in a 
+           store. When the total size of the values in the store exceeds 
+           the budget, the least recently used values are evicted, i.e. set 
+           to None, and computed again by their method when requested with 
+           get. During propagation, the inputs of methods still to be 
+           executed are not evicted. 
+
+           keyword args:
+            budget    - the maximum total size of the values in the store, or 
+                        None to only keep track of the size (see store_stats)
+            sizeof    - a function returning the size of a value (default 
+                        sys.getsizeof)
+            evictable - a function returning False for variables that must 
+                        not be evicted (default all variables may be evicted)
+        """
+        if sizeof == None:
+            sizeof = sys.getsizeof
+        if evictable == None:
+            evictable = lambda var: True
+        self._budget = budget
+        self._sizeof = sizeof
+        self._evictable = evictable
+        # (re)compute the sizes of all computed values 
+        self._store = OrderedDict()
+        self._store_stats["size"] = 0
+        for met in self._methods:
+            for var in met.outputs():
+                self._unstore(var)
+                self._restore(var)
+        self._evict()
+        self._store_stats["peak"] = self._store_stats["size"]
+
+    def set_executor(self, executor):
+        """Set the executor used to execute methods that do not depend on 
+           each other (see ThreadExecutor and ProcessExecutor). 
+
+           Propagation proceeds in levels. Methods in the same level only 
+           depend on methods in previous levels, and the methods to be 
+           executed in a level are given to the executor at once. 
+           If executor is None (the default), methods are executed one 
+           after another. 
+        """
+        self._executor = executor
+
+    def get_executor(self):
+        """Returns the executor set with set_executor, or None"""
+        return self._executor
+
+    def get_budget(self):
+        """Returns the budget set with set_budget, or None"""
+        return self._budget
+
+    def store_stats(self):
+        """Return a dictionary with the total size of the values in the store 
+           ("size"), the maximum total size since set_budget ("peak"), the number 
+           of values evicted ("evicted") and the number of evicted values computed 
+           again ("restored"). Sizes are only known after set_budget."""
+        return dict(self._store_stats)
 
     def set(self, varname, value, prop = True):
         """Set the value of a variable.
@@ -186,30 +330,41 @@ class MethodGraph:
         # update graph    
         for var in met.inputs():
             self.add_variable(var)
-            self._graph.add_edge(var, met)
+        self._add_order(met)
         for var in met.outputs():
             self.add_variable(var)
+        for var in met.inputs():
+            self._graph.add_edge(var, met)
+        for var in met.outputs():
             self._graph.add_edge(met, var)
         
-        # check validity of graph
+        # check validity of graph and update topological order
         for var in met.outputs():
             if len(self._graph.ingoing_vertices(var)) > 1: 
                 self.rem_method(met)
                 raise ValidityError, "variable "+str(var)+" determined by multiple methods"
-            elif len(self._graph.path(var, var)) != 0:
+            elif not self._reorder(met, var):
                 self.rem_method(met)
                 raise ValidityError, "cylce in graph not allowed (variable "+str(var)+")"
         # end for    
         
+        self._pending[met] = 1
         if prop:
-            self._execute(met)
             self.propagate()
         
     def rem_method(self, met):
         """Remove a method"""
         if met in self._methods:
             del self._methods[met]
+            if met in self._pending:
+                del self._pending[met]
+            # values of outputs can no longer be computed
+            for var in met.outputs():
+                if var in self._evicted:
+                    del self._evicted[var]
+                self._unstore(var)
             self._graph.rem_vertex(met)
+            del self._order[met]
         else:
             raise StandardError, "method not in graph"
 
@@ -221,17 +376,208 @@ class MethodGraph:
         from set() and add_method() by default. However, if the
         user so chooses, the methods will not call propagate, and
         the user should call this fucntion at a convenient time. 
+        Methods added or executed without propagation are also executed.
+
+        All methods downstream of the changed variables and pending 
+        methods are determined first and then executed at most once, 
+        in the topological order maintained by add_method. A method
+        is skipped if none of its inputs changed value (see __init__) 
+        and it is not pending. In lazy mode, values are only computed 
+        when requested (see set_lazy). 
         """
-        while len(self._changed) != 0:
-            pick = self._changed.keys()[0]
-            methods = self._graph.outgoing_vertices(pick)
-            for met in methods:
-                self._execute(met)
-            #end for
-            if pick in self._changed:
-                del self._changed[pick]
-        #end while
+        self._mark_stale()
+        if not self._lazy:
+            self._evaluate(self._stale.keys())
+        self._evict()
     #end def propagate
+
+    def _mark_stale(self):
+        """Mark all variables downstream of the changed variables and pending 
+           methods as stale. Methods with changed inputs become pending."""
+        front = self._pending.keys()
+        for var in self._changed:
+            methods = self._graph.outgoing_vertices(var)
+            for met in methods:
+                self._pending[met] = 1
+            front += methods
+        self._changed = {}
+        # downstream of a stale variable, all variables are already stale 
+        while len(front) > 0:
+            met = front.pop()
+            for var in met.outputs():
+                if var not in self._stale:
+                    self._stale[var] = 1
+                    front += self._graph.outgoing_vertices(var)
+
+    def _evaluate(self, variables):
+        """Compute the values of the given stale or evicted variables. 
+
+           The methods that the variables depend on are visited in topological 
+           order and executed only if pending or if an output was evicted. 
+           Methods downstream of variables whose value changed become pending. 
+        """
+        # determine methods upstream of stale and evicted variables
+        region = {}
+        front = list(variables)
+        while len(front) > 0:
+            var = front.pop()
+            if var in self._stale or var in self._evicted:
+                if var in self._stale:
+                    del self._stale[var]
+                for met in self._graph.ingoing_vertices(var):
+                    if met not in region:
+                        region[met] = 1
+                        front += met.inputs()
+        # sort topologically 
+        order = region.keys()
+        order.sort(key=self._order.get)
+        # number of remaining uses of variables, which must not be evicted 
+        needed = dict.fromkeys(variables, 1)
+        for met in order:
+            for var in met.inputs():
+                needed[var] = needed.get(var, 0) + 1
+        # execute, level by level
+        executed = 0
+        skipped = 0
+        for level in self._levels(order):
+            methods = []
+            restored = {}
+            for met in level:
+                if met in self._pending:
+                    methods.append(met)
+                elif len(filter(lambda var: var in self._evicted, met.outputs())) > 0:
+                    methods.append(met)
+                    restored[met] = 1
+                else:
+                    skipped += 1
+            outmaps = self._execute_all(methods)
+            for (met, outmap) in zip(methods, outmaps):
+                changed = self._update(met, outmap)
+                if met in restored:
+                    # inputs did not change, so neither do the evicted values 
+                    self._store_stats["restored"] += 1
+                else:
+                    for var in changed:
+                        for down in self._graph.outgoing_vertices(var):
+                            self._pending[down] = 1
+                executed += 1
+            for met in level:
+                for var in met.inputs():
+                    needed[var] -= 1
+            self._evict(needed)
+        self._propagation_stats["propagations"] += 1
+        self._propagation_stats["executed"] += executed
+        self._propagation_stats["last"] = executed
+        self._propagation_stats["skipped"] += skipped
+        self._propagation_stats["last_skipped"] = skipped
+
+    def _levels(self, order):
+        """Returns a list of levels, given a list of methods in topological order. 
+           Each level is a list of methods whose inputs are determined by methods 
+           in previous levels only, in topological order."""
+        level = {}
+        levels = []
+        for met in order:
+            number = 0
+            for var in met.inputs():
+                for prev in self._graph.ingoing_vertices(var):
+                    if prev in level:
+                        number = max(number, level[prev] + 1)
+            level[met] = number
+            if number == len(levels):
+                levels.append([])
+            levels[number].append(met)
+        return levels
+
+    def _restore(self, var):
+        """Put the value of a computed variable in the store, as most recently used"""
+        if self._store != None and self._map[var] != None:
+            size = self._sizeof(self._map[var])
+            self._store[var] = size
+            self._store_stats["size"] += size
+            self._store_stats["peak"] = max(self._store_stats["peak"], self._store_stats["size"])
+
+    def _unstore(self, var):
+        """Remove a variable from the store"""
+        if self._store != None and var in self._store:
+            self._store_stats["size"] -= self._store.pop(var)
+
+    def _evict(self, needed = {}):
+        """Evict the least recently used values until the store is within budget. 
+           Variables with a positive count in needed are not evicted."""
+        if self._budget == None or self._store_stats["size"] <= self._budget:
+            return
+        excess = self._store_stats["size"] - self._budget
+        victims = []
+        for var in self._store:
+            if excess <= 0:
+                break
+            if needed.get(var, 0) <= 0 and self._evictable(var):
+                victims.append(var)
+                excess -= self._store[var]
+        for var in victims:
+            self._unstore(var)
+            self._map[var] = None
+            self._evicted[var] = 1
+            self._store_stats["evicted"] += 1
+
+    def _add_order(self, vertex):
+        """Put a new vertex last in the topological order"""
+        self._order[vertex] = self._next_order
+        self._next_order += 1
+
+    def _reorder(self, source, target):
+        """Restore the topological order after adding an edge from source to target. 
+           Returns False iff the edge closes a cycle, in which case the order 
+           is not changed. 
+
+           Only the vertices between target and source in the current order
+           are visited and reordered (Pearce and Kelly, 2006). 
+        """
+        lower = self._order[target]
+        upper = self._order[source]
+        if lower > upper:
+            return True
+        # vertices reachable from target that are not after source 
+        forward = []
+        visited = {target:1}
+        front = [target]
+        while len(front) > 0:
+            vertex = front.pop()
+            forward.append(vertex)
+            for next in self._graph.outgoing_vertices(vertex):
+                if next == source:
+                    return False
+                if next not in visited and self._order[next] < upper:
+                    visited[next] = 1
+                    front.append(next)
+        # vertices reaching source that are not before target
+        backward = []
+        visited = {source:1}
+        front = [source]
+        while len(front) > 0:
+            vertex = front.pop()
+            backward.append(vertex)
+            for prev in self._graph.ingoing_vertices(vertex):
+                if prev not in visited and self._order[prev] > lower:
+                    visited[prev] = 1
+                    front.append(prev)
+        # backward vertices go before forward vertices, in the places they had 
+        forward.sort(key=self._order.get)
+        backward.sort(key=self._order.get)
+        places = map(self._order.get, backward + forward)
+        places.sort()
+        for (vertex, place) in zip(backward + forward, places):
+            self._order[vertex] = place
+        return True
+
+    def propagation_stats(self):
+        """Return a dictionary with the number of propagations ("propagations"), 
+           the total number of method executions ("executed"), the number
+           of method executions in the last propagation ("last"), and the
+           number of downstream methods skipped because their inputs did not 
+           change, in total ("skipped") and in the last propagation ("last_skipped")"""
+        return dict(self._propagation_stats)
     
     def clear(self):
         """clear methodgraph by removing all variables"""
@@ -241,51 +587,81 @@ class MethodGraph:
         #wend
     #def
     
-    def execute(self, met):
-        """Execute a method and proagate changes. Method must be in Methodgraph"""
+    def execute(self, met, prop = True):
+        """Execute a method and proagate changes. Method must be in Methodgraph
+        
+           Iff prop is false then the method is only executed at the
+           next propagation. 
+        """
         if met in self._methods:
-            self._execute(met)
-            self.propagate()
+            self._pending[met] = 1
+            if prop:
+                self.propagate()
         else:
             raise StandardError, "method not in graph"
 
     def _execute(self, met):
         """Execute a method. 
         Method is executed only if all inputvariable values are not None
-        Updates mapping and change flags.  
+        Updates mapping. Downstream methods are executed by propagate.
+        Returns a list of output variables whose value changed. 
         """
-        # create input map and check for None-values
-        inmap = {}
-        hasNoneValues = False
-        for var in met.inputs():
-            value = self._map[var]
-            if value == None:
-                hasNoneValues = True
-            inmap[var] = value
-        for var in met.outputs():
-            inmap[var] = self._map[var]
+        return self._update(met, self._execute_all([met])[0])
+
+    def _execute_all(self, methods):
+        """Execute methods that do not depend on each other, with the executor 
+           if there are several (see set_executor). 
+           Methods are executed only if all inputvariable values are not None.
+           Returns a list of output maps, one for each method. 
+        """
+        outmaps = map(lambda met: {}, methods)
+        tasks = []
+        indices = []
+        for (index, met) in enumerate(methods):
+            # create input map and check for None-values
+            inmap = {}
+            hasNoneValues = False
+            for var in met.inputs():
+                value = self._map[var]
+                if value == None:
+                    hasNoneValues = True
+                inmap[var] = value
+            for var in met.outputs():
+                inmap[var] = self._map[var]
+            if not hasNoneValues:
+                tasks.append((met, inmap))
+                indices.append(index)
         # call method.execute
-        if hasNoneValues:
-            outmap = {}
+        if self._executor != None and len(tasks) > 1:
+            results = self._executor.map(tasks)
         else:
-            outmap = met.execute(inmap)
+            results = map(_execute_task, tasks)
+        for (index, outmap) in zip(indices, results):
+            outmaps[index] = outmap
+        return outmaps
+
+    def _update(self, met, outmap):
+        """Update mapping with the output map of an executed method. 
+        Returns a list of output variables whose value changed. 
+        """
+        if met in self._pending:
+            del self._pending[met]
         # update values in self._map
-        # set output variables changed
+        changed = []
         for var in met.outputs():
             if var in outmap:
-                self._map[var] = outmap[var]
-                self._changed[var] = 1
+                value = outmap[var]
             else:
-                if self._map[var] != None:
-                    self._changed[var] = 1
-                    self._map[var] = None
-                
-        #end for
-        # clear change flag on input variables 
-        for var in met.inputs():
-            if var in self._changed:
-                del self._changed[var]
+                value = None
+            if not self._equal(self._map[var], value):
+                changed.append(var)
+            self._map[var] = value
+            if var in self._evicted:
+                del self._evicted[var]
+            self._unstore(var)
+            self._restore(var)
         #end for
+        return changed
 
     # end def execute
 
@@ -299,6 +675,116 @@ class MethodGraph:
 
 # end class MethodGraph
 
+# ----------- Executors -------
+
+def _execute_task(task):
+    """Execute a (method, inmap) pair and return the output map"""
+    (met, inmap) = task
+    return met.execute(inmap)
+
+def _execute_pickled(data):
+    """Execute a pickled (method, inmap) pair and return the pickled values 
+       of the outputs, as a list of (index in outputs, value) pairs"""
+    (met, inmap) = cPickle.loads(data)
+    outmap = met.execute(inmap)
+    values = []
+    for (index, var) in enumerate(met.outputs()):
+        if var in outmap:
+            values.append((index, outmap[var]))
+    return cPickle.dumps(values, cPickle.HIGHEST_PROTOCOL)
+
+class Executor:
+    """Executes methods that do not depend on each other for a MethodGraph 
+       (see MethodGraph.set_executor). 
+       
+       This class executes methods one after another. Subclasses may execute 
+       methods at the same time, by overriding the map method. 
+    """
+
+    def map(self, tasks):
+        """Execute methods, given a list of (method, inmap) pairs. 
+           Returns a list of output maps, in the same order."""
+        return map(_execute_task, tasks)
+
+    def close(self):
+        """Release any resources (e.g. threads and processes) used by the executor"""
+        pass
+
+class ThreadExecutor(Executor):
+    """Executes methods in a pool of threads. 
+
+       Methods share the values of variables with the MethodGraph. Note that 
+       methods only run at the same time as far as they release the global 
+       interpreter lock, so for pure-Python methods, see ProcessExecutor.
+    """
+
+    def __init__(self, threads=None):
+        """Create an executor with the given number of threads 
+           (default the number of CPUs). Threads are started when first used."""
+        self._threads = threads
+        self._pool = None
+
+    def map(self, tasks):
+        if self._pool == None:
+            self._pool = ThreadPool(self._threads)
+        return self._pool.map(_execute_task, tasks)
+
+    def close(self):
+        if self._pool != None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+class ProcessExecutor(Executor):
+    """Executes methods in a pool of processes. 
+
+       Methods and the values of their input variables are pickled and 
+       shipped to the processes, and the values of output variables are 
+       shipped back. Methods that cannot be pickled are executed one after 
+       another in the calling process. 
+    """
+
+    def __init__(self, processes=None):
+        """Create an executor with the given number of processes 
+           (default the number of CPUs). Processes are started when first used."""
+        self._processes = processes
+        self._pool = None
+
+    def map(self, tasks):
+        if self._pool == None:
+            self._pool = Pool(self._processes)
+        # ship tasks 
+        results = []
+        for task in tasks:
+            try:
+                data = cPickle.dumps(task, cPickle.HIGHEST_PROTOCOL)
+            except (cPickle.PicklingError, TypeError, AttributeError):
+                results.append(None)
+            else:
+                results.append(self._pool.apply_async(_execute_pickled, (data,)))
+        # execute local tasks, while processes are busy
+        outmaps = []
+        for (task, result) in zip(tasks, results):
+            if result == None:
+                outmaps.append(_execute_task(task))
+            else:
+                outmaps.append(None)
+        # gather shipped results 
+        for (index, (task, result)) in enumerate(zip(tasks, results)):
+            if result != None:
+                outputs = task[0].outputs()
+                outmap = {}
+                for (output, value) in cPickle.loads(result.get()):
+                    outmap[outputs[output]] = value
+                outmaps[index] = outmap
+        return outmaps
+
+    def close(self):
+        if self._pool != None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
 # ----------- various Methods ---------
 
 class OrMethod(Method):
@@ -463,6 +949,34 @@ def test():
         print "success: should not be possible"
     except Exception, e:
         print e 
+    print "f := g + h"
+    mg.add_variable('h', 1)
+    mg.add_method(AddMethod('g','h','f'))
+    print "g := a + e"
+    mg.add_method(AddMethod('a','e','g'))
+    print "f = "+str(mg.get('f'))
+    print "set a = 1"
+    mg.set('a', 1)
+    print "f = "+str(mg.get('f'))
+    print "methods executed: "+str(mg.propagation_stats()["last"])
+    print "set a = 1"
+    mg.set('a', 1)
+    print "methods executed: "+str(mg.propagation_stats()["last"])
+    print "methods skipped: "+str(mg.propagation_stats()["last_skipped"])
+    print "lazy evaluation"
+    mg.set_lazy(True)
+    print "set a = 2"
+    mg.set('a', 2)
+    print "c = "+str(mg.get('c'))
+    print "methods executed: "+str(mg.propagation_stats()["last"])
+    print "f = "+str(mg.get('f'))
+    print "methods executed: "+str(mg.propagation_stats()["last"])
+    print "eager evaluation, budget of one value"
+    mg.set_lazy(False)
+    mg.set_budget(1, lambda value: 1)
+    print "values evicted: "+str(mg.store_stats()["evicted"])
+    print "c = "+str(mg.get('c'))
+    print "values restored: "+str(mg.store_stats()["restored"])
 
 if __name__ == "__main__": 
     test()
@@ -1,6 +1,84 @@
 """Base classes for multi-valued assignments in methodgraphs"""
 
+import heapq
+import threading
+from collections import OrderedDict
 from method import Method, MethodGraph
+from tolerance import default_tol
+
+# the MemoCache used by MultiMethod.execute, or None (see set_memo)
+_memo = None
+
+def set_memo(cache):
+    """Set the MemoCache used to remember the results of MultiMethod.execute,
+       or None (the default) to always execute"""
+    global _memo
+    _memo = cache
+
+def get_memo():
+    """Returns the MemoCache set with set_memo, or None"""
+    return _memo
+
+class MemoCache:
+    """A cache for the output values of MultiMethods, for given input values. 
+
+       Keys consist of a method and a fingerprint of its input values. Values with 
+       a 'fingerprint' method (e.g. Configuration) are fingerprinted by calling it 
+       with the tolerance, collections by the set of fingerprints of their items, 
+       and other values are used as they are. When the cache is full, the least 
+       recently used result is dropped. The cache may be shared by methods 
+       executing in several threads (see ThreadExecutor).
+    """
+
+    def __init__(self, size=1000, tolerance=default_tol):
+        """Create a cache for at most size results"""
+        self._size = size
+        self._tolerance = tolerance
+        self._results = OrderedDict()
+        self._stats = {"hits":0, "misses":0}
+        self._lock = threading.Lock()
+
+    def fingerprint(self, value):
+        """Returns a hashable fingerprint of a value"""
+        if hasattr(value, "fingerprint"):
+            return value.fingerprint(self._tolerance)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            return frozenset(map(self.fingerprint, value))
+        else:
+            return value
+
+    def lookup(self, key):
+        """Returns the result stored for key, or None"""
+        with self._lock:
+            if key in self._results:
+                self._stats["hits"] += 1
+                # most recently used
+                result = self._results.pop(key)
+                self._results[key] = result
+                return result
+            else:
+                self._stats["misses"] += 1
+                return None
+
+    def store(self, key, result):
+        """Store a result for key"""
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self._size:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        """Remove all results"""
+        with self._lock:
+            self._results = OrderedDict()
+
+    def stats(self):
+        """Return a dictionary with the number of results found ("hits") and 
+           not found ("misses") and the number of results stored ("size")"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._results)
+        return stats
 
 class MultiVariable:
     """For representing multi-valued variables
@@ -35,7 +113,17 @@ class MultiMethod(Method):
        output MultiVariable.
 
        Note that a set of values for the outputvariable is stored, so that equivalent values are only stored once.
+
+       Output values are generated one by one (see iter_execute). Only values accepted by all 
+       predicates (see add_predicate) are collected, up to a maximum number (see set_max_solutions).
+       Optionally, only the best ranked values are kept (see set_beam).
+
+       If a MemoCache is set (see set_memo), the output values are remembered for the input values. 
+       Subclasses whose output depends on anything but the input values, the predicates and the
+       maximum number of values should set 'memoize' to False or override memo_state.
     """
+
+    memoize = True
     
     def __init__(self):
         """Call this initialize after _inputs and _outputs has been set"""
@@ -47,32 +135,113 @@ class MultiMethod(Method):
             raise StandardError, "requires exactly one output" 
         if not isinstance(self._outputs[0], MultiVariable):
             raise StandardError, "requires a MultiVariable output" 
+        self._predicates = []
+        self._max_solutions = None
+        self._beam = None
+
+    def add_predicate(self, predicate):
+        """Add a function predicate(value, inmap), which returns False for output 
+           values to be discarded, given the input map of execute"""
+        self._predicates.append(predicate)
 
+    def rem_predicate(self, predicate):
+        """Remove a predicate added with add_predicate"""
+        self._predicates.remove(predicate)
+
+    def predicates(self):
+        """Returns a list of the predicates applied to output values (see add_predicate)"""
+        return list(self._predicates)
+
+    def set_max_solutions(self, max_solutions):
+        """Collect at most max_solutions output values, or all values if None (the default).
+           The values collected are the first ones generated (see iter_execute)."""
+        self._max_solutions = max_solutions
+
+    def get_max_solutions(self):
+        """Returns the maximum set with set_max_solutions, or None"""
+        return self._max_solutions
+
+    def set_beam(self, width):
+        """Keep only the width output values with the lowest rank (see rank), 
+           or all values if width is None (the default)"""
+        self._beam = width
+
+    def get_beam(self):
+        """Returns the width set with set_beam, or None"""
+        return self._beam
+
+    def rank(self, value, inmap):
+        """Returns the rank of an output value, given the input map of execute, 
+           used to select values with set_beam. Subclasses using set_beam must 
+           implement this method."""
+        raise NotImplementedError
+
+    def memo_state(self):
+        """Returns a hashable value with everything but the input values that 
+           determines the output values (used as part of the key for the MemoCache)"""
+        return (tuple(self.predicates()), self._max_solutions, self._beam)
    
     def execute(self, inmap):
         """calls multi_execute for each permutation of multi-valued input variables and collects
            result in multi-valued ouput variables. Subclasses should implement multi_execute."""
+        outvar = self._outputs[0]
+        memo = _memo
+        if memo != None and self.memoize:
+            key = (self, tuple(map(lambda var: memo.fingerprint(inmap[var]), self.inputs())), self.memo_state())
+            values = memo.lookup(key)
+            if values == None:
+                values = frozenset(self._collect(inmap))
+                memo.store(key, values)
+            return {outvar:set(values)}
+        return {outvar:set(self._collect(inmap))}
+
+    def _collect(self, inmap):
+        """Returns a list of the values generated by iter_execute, with the lowest 
+           ranked values only if a beam is set"""
+        if self._beam == None:
+            return list(self.iter_execute(inmap))
+        else:
+            return heapq.nsmallest(self._beam, self.iter_execute(inmap), key=lambda value: self.rank(value, inmap))
+
+    def iter_execute(self, inmap):
+        """Generates the distinct output values accepted by all predicates, calling 
+           multi_execute for one permutation of multi-valued input variables at a time, 
+           until the maximum number of values is reached (see set_max_solutions)."""
+        if self._max_solutions != None and self._max_solutions <= 0:
+            return
         base_inmap = {}
         for variable in self._inputs:
             if variable not in self._multi_inputs:
                 value = inmap[variable]
                 base_inmap[variable] = value
-           
-        outvar = self._outputs[0]
-        values = self._recurse_execute(inmap, base_inmap, self._multi_inputs)
-        return {outvar:values}
+        predicates = self.predicates()
+        found = set()
+        for value in self._recurse_execute(inmap, base_inmap, self._multi_inputs):
+            if value in found:
+                continue
+            accept = True
+            for predicate in predicates:
+                if not predicate(value, inmap):
+                    accept = False
+                    break
+            if accept:
+                found.add(value)
+                yield value
+                if len(found) == self._max_solutions:
+                    return
  
     def _recurse_execute(self, inmap, base_inmap, multi_inputs):
+        """Generates the values returned by multi_execute for all permutations of multi-valued inputs"""
         if len(multi_inputs) > 0:
             mvar = multi_inputs[0]
             values = inmap[mvar]
-            output = set()
             for value in values:
                 base_inmap[mvar] = value
-                output.update(self._recurse_execute(inmap, base_inmap, multi_inputs[1:]))
-            return output
+                for output in self._recurse_execute(inmap, base_inmap, multi_inputs[1:]):
+                    yield output
         else:
-            return self.multi_execute(base_inmap)
+            for output in self.multi_execute(base_inmap):
+                yield output
 
 
 #####
@@ -116,6 +285,22 @@ def test():
     graph.set('a', 100)
     print graph.get(mv_z)
 
+    print "at most 3 values of z greater than 300"
+    mv_z2 = MultiVariable('z2')
+    method = SumProdMethod(mv_x,mv_y,mv_z2)
+    method.add_predicate(lambda value, inmap: value > 300)
+    method.set_max_solutions(3)
+    graph.add_method(method)
+    print graph.get(mv_z2)
+
+    set_memo(MemoCache(10))
+    graph.set('a', 1)
+    graph.set('a', 100)
+    graph.set('a', 1)
+    print graph.get(mv_z)
+    print get_memo().stats()
+    set_memo(None)
+
 
 if __name__== '__main__': test()
     
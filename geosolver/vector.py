@@ -9,9 +9,24 @@ A list based vector class that supports elementwise mathematical operations
 
 In this version, the vector call inherits from list; this 
 requires Python 2.2 or later.
+
+The module also provides ndvector, a vector class with the same interface, 
+backed by a numpy array (if numpy is installed). The name 'vector' refers to 
+the class selected with set_backend: listvector (default) or ndvector. 
+The functions dot, cross and norm accept both kinds of vectors.
 """
 
-class vector(list):
+import operator
+try:
+        import numpy
+except ImportError:
+        numpy = None
+
+def _isscalar(x):
+        """True if x is a number, not a sequence"""
+        return not hasattr(x, '__len__')
+
+class listvector(list):
         """
         A list based vector class
         """
@@ -21,28 +36,27 @@ class vector(list):
                 try:
                         # use the list __getslice__ method and convert
                         # result to vector
-                        return vector(super(vector, self).__getslice__(i,j))
+                        return listvector(super(listvector, self).__getslice__(i,j))
                 except:
                         raise TypeError, 'vector::FAILURE in __getslice__'
                 
         def __add__(self, other):
-                return vector(map(lambda x,y: x+y, self, other))
+                return listvector(map(operator.add, self, other))
 
         def __neg__(self):
-                return vector(map(lambda x: -x, self))
+                return listvector(map(operator.neg, self))
         
         def __sub__(self, other):
-                return vector(map(lambda x,y: x-y, self, other))
+                return listvector(map(operator.sub, self, other))
 
         def __mul__(self, other):
             """
             Element by element multiplication
             """
-            try:
-                    return vector(map(lambda x,y: x*y, self,other))
-            except:
-                    # other is a const
-                    return vector(map(lambda x: x*other, self))
+            if _isscalar(other):
+                    return listvector([x*other for x in self])
+            else:
+                    return listvector(map(operator.mul, self, other))
 
 
         def __rmul__(self, other):
@@ -53,33 +67,32 @@ class vector(list):
             """
             Element by element division.
             """
-            try:
-                    return vector(map(lambda x,y: x/y, self, other))
-            except:
-                    return vector(map(lambda x: x/other, self))
+            if _isscalar(other):
+                    return listvector([x/other for x in self])
+            else:
+                    return listvector(map(operator.div, self, other))
 
         def __rdiv__(self, other):
             """
             The same as __div__
             """
-            try:
-                    return vector(map(lambda x,y: x/y, other, self))
-            except:
-                    # other is a const
-                    return vector(map(lambda x: other/x, self))
+            if _isscalar(other):
+                    return listvector([other/x for x in self])
+            else:
+                    return listvector(map(operator.div, other, self))
 
         def size(self): return len(self)
 
         def conjugate(self):
-            return vector(map(lambda x: x.conjugate(), self))
+            return listvector(map(lambda x: x.conjugate(), self))
 
         def ReIm(self):
                 """
                 Return the real and imaginary parts
                 """
                 return [
-                        vector(map(lambda x: x.real, self)),
-                        vector(map(lambda x: x.imag, self)),
+                        listvector(map(lambda x: x.real, self)),
+                        listvector(map(lambda x: x.imag, self)),
                         ]
         
         def AbsArg(self):
@@ -87,8 +100,8 @@ class vector(list):
                 Return modulus and phase parts
                 """
                 return [
-                        vector(map(lambda x: abs(x), self)),
-                        vector(map(lambda x: math.atan2(x.imag,x.real), self)),
+                        listvector(map(lambda x: abs(x), self)),
+                        listvector(map(lambda x: math.atan2(x.imag,x.real), self)),
                         ]
 
 
@@ -100,7 +113,137 @@ class vector(list):
 
         def concatonated(self,other):
             """this vector concatonated with another"""
-            return vector(list(self)+list(other))
+            return listvector(list(self)+list(other))
+
+class ndvector(object):
+        """
+        A vector class backed by a numpy array of floats, with the 
+        interface of listvector. Elements are returned as python floats.
+        Requires numpy.
+        """
+        __slots__ = ['_a']
+        __hash__ = None
+
+        def __init__(self, elems=()):
+                if isinstance(elems, ndvector):
+                        elems = elems._a
+                self._a = numpy.array(elems, dtype=numpy.float64)
+
+        @staticmethod
+        def _wrap(a):
+                v = ndvector.__new__(ndvector)
+                v._a = a
+                return v
+
+        def _operand(self, other):
+                if isinstance(other, ndvector):
+                        return other._a
+                else:
+                        return other
+
+        def __len__(self): 
+                return len(self._a)
+
+        def __iter__(self):
+                return iter(self._a.tolist())
+
+        def __getitem__(self, i):
+                if isinstance(i, slice):
+                        return ndvector._wrap(self._a[i].copy())
+                else:
+                        return float(self._a[i])
+
+        def __setitem__(self, i, value):
+                self._a[i] = self._operand(value)
+
+        def __array__(self, dtype=None):
+                return self._a
+
+        def append(self, x):
+                self._a = numpy.append(self._a, x)
+
+        def __eq__(self, other):
+                return list(self) == list(other)
+
+        def __ne__(self, other):
+                return not self == other
+
+        def __repr__(self):
+                return repr(self._a.tolist())
+
+        def __add__(self, other):
+                return ndvector._wrap(self._a + self._operand(other))
+
+        __radd__ = __add__
+
+        def __neg__(self):
+                return ndvector._wrap(-self._a)
+        
+        def __sub__(self, other):
+                return ndvector._wrap(self._a - self._operand(other))
+
+        def __rsub__(self, other):
+                return ndvector._wrap(self._operand(other) - self._a)
+
+        def __mul__(self, other):
+                """
+                Element by element multiplication
+                """
+                return ndvector._wrap(self._a * self._operand(other))
+
+        __rmul__ = __mul__
+
+        def __div__(self, other):
+                """
+                Element by element division.
+                """
+                return ndvector._wrap(self._a / self._operand(other))
+
+        __truediv__ = __div__
+
+        def __rdiv__(self, other):
+                return ndvector._wrap(self._operand(other) / self._a)
+
+        __rtruediv__ = __rdiv__
+
+        def size(self): return len(self)
+
+        def out(self):
+            """
+            Prints out the vector.
+            """
+            print self
+
+        def concatonated(self,other):
+            """this vector concatonated with another"""
+            return ndvector._wrap(numpy.concatenate((self._a, numpy.asarray(self._operand(other), dtype=numpy.float64))))
+
+# the vector class used by this module and its users (see set_backend)
+vector = listvector
+
+def set_backend(name):
+        """
+        Selects the class of new vectors: "list" for listvector, 
+        "numpy" for ndvector (requires numpy).
+        Vectors made before the switch keep their class. 
+        Modules that imported the name 'vector' keep the class they imported.
+        """
+        global vector
+        if name == "list":
+                vector = listvector
+        elif name == "numpy":
+                if numpy == None:
+                        raise Exception("the numpy vector backend requires numpy")
+                vector = ndvector
+        else:
+                raise Exception("unknown vector backend "+str(name))
+
+def get_backend():
+        """Returns the name of the backend selected with set_backend"""
+        if vector is ndvector:
+                return "numpy"
+        else:
+                return "list"
 
 ###############################################################################
 
@@ -109,7 +252,7 @@ def isVector(x):
     """
     Determines if the argument is a vector class object.
     """
-    return hasattr(x,'__class__') and x.__class__ is vector
+    return isinstance(x, (listvector, ndvector))
 
 def zeros(n):
     """
@@ -140,8 +283,10 @@ def dot(a, b):
     """
     dot product of two vectors.
     """
+    if isinstance(a, ndvector) and isinstance(b, ndvector):
+        return float(numpy.dot(a._a, b._a))
     try:
-        return reduce(lambda x, y: x+y, a*b, 0.)
+        return reduce(operator.add, map(operator.mul, a, b), 0.)
     except:
         raise TypeError, 'vector::FAILURE in dot'
         
@@ -150,9 +295,13 @@ def cross(a, b):
     cross product of two 3-vectors.
     """
     if len(a) == len(b) == 3:
-        return vector([a[1]*b[2] - a[2]*b[1],
-                a[2]*b[0] - a[0]*b[2],
-                a[0]*b[1] - a[1]*b[0]])
+        c = [a[1]*b[2] - a[2]*b[1],
+             a[2]*b[0] - a[0]*b[2],
+             a[0]*b[1] - a[1]*b[0]]
+        if isinstance(a, ndvector):
+            return ndvector(c)
+        else:
+            return listvector(c)
     else:
             raise TypeError, 'vector.cross - args be 3-vectors'
 
@@ -5,12 +5,26 @@ The tests are also simple examples of how to use of the GeomSolver API"""
 
 import random
 import math
+import threading
+import itertools
 from test_generic import test
-from geosolver.geometric import GeometricProblem, GeometricSolver, DistanceConstraint,AngleConstraint, FixConstraint,RightHandedConstraint
+from geosolver.geometric import GeometricProblem, GeometricSolver, GeometricDecomposition, DistanceConstraint,AngleConstraint, FixConstraint,RightHandedConstraint
 from geosolver.vector import vector 
 from geosolver.randomproblem import random_triangular_problem_3D, random_distance_problem_3D
 from geosolver.diagnostic import diag_select, diag_print
-from geosolver.intersections import distance_2p, angle_3p
+from geosolver.intersections import distance_2p, angle_3p, tol_eq
+from geosolver.intersections import translate_3D, rotate_3D_x, rotate_3D_z
+from geosolver.clsolver import ClusterSolver, ClusterMethod, CostScheduler, graph2pattern
+from geosolver.clsolver3D import ClusterSolver3D
+from geosolver import clsolver2D
+from geosolver.cluster import Rigid, Hedgehog, Balloon
+from geosolver.icpm import PatternMatches
+from geosolver.configuration import Configuration, equal_configurations
+from geosolver import configuration
+from geosolver import vector as vectors
+from geosolver import tolerance
+from geosolver.method import ThreadExecutor, ProcessExecutor
+from geosolver.multimethod import MemoCache, set_memo, get_memo
 
 # ---------- 3D problems -----
 
@@ -328,6 +342,738 @@ def selection_test():
     # solve again
     print len(solver.get_solutions()), "solutions"
 
+def test_batch():
+    """Adding constraints in a batch should give the same decomposition
+       as adding them one at a time"""
+    source = random_distance_problem_3D(8,10.0,0.0)
+    results = []
+    for batched in [False, True]:
+        problem = GeometricProblem(dimension=3)
+        solver = GeometricSolver(problem)
+        if batched:
+            problem.begin_batch()
+        for var in source.cg.variables():
+            problem.add_point(var, source.get_point(var))
+        for con in source.cg.constraints():
+            problem.add_constraint(con)
+        problem.add_constraint(FixConstraint('v0', source.get_point('v0')))
+        if batched:
+            problem.commit()
+        top = map(lambda c: frozenset(c.vars), solver.dr.top_level())
+        print "batched:", batched, "top-level clusters:", len(top), "status:", solver.get_status()
+        results.append((set(top), solver.get_status()))
+    result = solver.get_result()
+    check = results[0] == results[1] and len(result.solutions) > 0
+    for sol in result.solutions:
+        check = check and problem.verify(sol)
+    if check:
+        print "batch decomposition equal"
+    else:
+        print "INVALID"
+
+def test_selection_removal():
+    """Removing and re-adding a selection constraint while a solver 
+       is attached should drop and restore the selection"""
+    problem = GeometricProblem(dimension=3,use_prototype=False)
+    solver = GeometricSolver(problem)
+    problem.add_point('v1', vector([0.0, 0.0, 0.0]))
+    problem.add_point('v2', vector([1.0, 0.0, 0.0]))
+    problem.add_point('v3', vector([0.0, 1.0, 0.0]))
+    problem.add_point('v4', vector([0.5, 0.5, 1.0]))
+    problem.add_point('v5', vector([0.5, 0.5,-1.0]))
+    for (a,b) in [('v1','v2'),('v1','v3'),('v2','v3'),('v1','v4'),('v2','v4'),
+                  ('v3','v4'),('v1','v5'),('v2','v5'),('v3','v5')]:
+        problem.add_constraint(DistanceConstraint(a, b, 10.0))
+    s1 = RightHandedConstraint('v1','v2','v4','v5')
+    problem.add_constraint(s1)
+    counts = [len(solver.get_solutions())]
+    problem.set_prototype_selection(False)
+    problem.rem_constraint(s1)
+    counts.append(len(solver.get_solutions()))
+    problem.add_constraint(s1)
+    counts.append(len(solver.get_solutions()))
+    print "solutions with, without and with selection constraint:", counts
+    check = counts[0] == counts[2] and counts[1] > counts[0] 
+    for sol in solver.get_solutions():
+        check = check and problem.verify(sol)
+    if check:
+        print "selection constraint removed and restored"
+    else:
+        print "INVALID"
+
+def brute_force_matches(pattern, clusters):
+    """Returns the sets of clusters that match a pattern (see icpm.PatternMatches),
+       by trying all assignments of clusters and point variables"""
+    kinds = {"rigid":(Rigid,0), "distance":(Rigid,2), "point":(Rigid,1), 
+             "hedgehog":(Hedgehog,0), "balloon":(Balloon,0)}
+    matches = set()
+    for assigned in itertools.permutations(clusters, len(pattern)):
+        domains = {}
+        for ((kind, clustername, pointnames), cluster) in zip(pattern, assigned):
+            (classobj, maxpoints) = kinds[kind]
+            if (not isinstance(cluster, classobj) or len(cluster.vars) < len(pointnames) 
+                or (maxpoints > 0 and len(cluster.vars) > maxpoints)):
+                break
+            for point in pointnames:
+                if isinstance(cluster, Hedgehog) and point == pointnames[0]:
+                    vars = set([cluster.cvar])
+                elif isinstance(cluster, Hedgehog):
+                    vars = cluster.xvars
+                else:
+                    vars = cluster.vars
+                domains[point] = domains.get(point, set(vars)).intersection(vars)
+        else:
+            for values in itertools.product(*domains.values()):
+                if len(set(values)) == len(values):
+                    matches.add(frozenset(assigned))
+                    break
+    return matches
+
+def test_pattern_network():
+    """Matching patterns with a network of partial matches should give the 
+       same matches as trying all assignments, while clusters are added, 
+       removed and added again"""
+    patterns = [[["rigid","$d_ab",["$a", "$b"]], ["rigid", "$d_ac",["$a", "$c"]], ["rigid", "$d_bc",["$b","$c"]]],
+                [["rigid","$d_ab",["$a", "$b"]], ["hedgehog", "$a_abc",["$b", "$a", "$c"]], ["rigid", "$d_bc",["$b","$c"]]],
+                [["distance","$d",["$a","$b"]], ["point", "$p", ["$a"]]],
+                [["point","$p",["$a"]], ["balloon", "$s", ["$b", "$c", "$d"]]],
+                graph2pattern(clsolver2D.MergeSR.patterngraph)]
+    solver = ClusterSolver([])
+    networks = map(lambda pattern: PatternMatches(pattern, solver), patterns)
+    points = map(lambda i: "p"+str(i), range(6))
+    removed = []
+    check = True
+    steps = 0
+    for step in range(60):
+        top = list(solver.top_level())
+        action = random.random()
+        if action < 0.2 and len(top) > 0:
+            cluster = random.choice(top)
+            solver.remove(cluster)
+            removed.append(cluster)
+        elif action < 0.35 and len(removed) > 0:
+            cluster = random.choice(removed)
+            removed.remove(cluster)
+            solver.add(cluster)
+        else:
+            kind = random.choice(["rigid", "rigid", "hedgehog", "balloon"])
+            if kind == "rigid":
+                solver.add(Rigid(random.sample(points, random.randint(1,3))))
+            elif kind == "hedgehog":
+                vars = random.sample(points, 3)
+                solver.add(Hedgehog(vars[0], vars[1:]))
+            else:
+                solver.add(Balloon(random.sample(points, 3)))
+        clusters = list(solver.top_level())
+        for (pattern, network) in zip(patterns, networks):
+            clusternames = map(lambda (kind, clustername, pointnames): clustername, pattern)
+            matched = set(map(lambda match: frozenset(map(lambda (name, value): value, 
+                          filter(lambda (name, value): name in clusternames, match))), network))
+            check = check and len(matched) == len(network)
+            check = check and matched == brute_force_matches(pattern, clusters)
+        steps += 1
+    print "pattern network:", steps, "steps,", len(solver.top_level()), "clusters,", map(len, networks), "matches"
+    if check:
+        print "pattern network matches equal"
+    else:
+        print "INVALID"
+
+def constraint_rank(problem):
+    """rank of the Jacobian of the distance and angle constraints of problem
+       at the prototype, estimated by central differences"""
+    vars = list(problem.cg.variables())
+    rows = []
+    h = 1e-6
+    for con in problem.cg.constraints():
+        cvars = con.variables()
+        if isinstance(con, DistanceConstraint):
+            value = lambda p: distance_2p(p[cvars[0]], p[cvars[1]])
+        else:
+            value = lambda p: angle_3p(p[cvars[0]], p[cvars[1]], p[cvars[2]])
+        row = []
+        for var in vars:
+            for i in range(3):
+                points = {}
+                for v in cvars:
+                    points[v] = vector(problem.get_point(v))
+                points.setdefault(var, vector(problem.get_point(var)))
+                points[var][i] += h
+                f1 = value(points)
+                points[var][i] -= 2*h
+                f2 = value(points)
+                row.append((f1 - f2) / (2*h))
+        rows.append(row)
+    # gaussian elimination with partial pivoting
+    rank = 0
+    ncols = 3*len(vars)
+    for col in range(ncols):
+        pivot = None
+        for r in range(rank, len(rows)):
+            if abs(rows[r][col]) > 1e-6 and (pivot == None or abs(rows[r][col]) > abs(rows[pivot][col])):
+                pivot = r
+        if pivot == None: 
+            continue
+        rows[rank], rows[pivot] = rows[pivot], rows[rank]
+        for r in range(rank+1, len(rows)):
+            f = rows[r][col] / rows[rank][col]
+            for c in range(col, ncols):
+                rows[r][c] -= f * rows[rank][c]
+        rank += 1
+    return rank
+
+def test_angle_problems():
+    """Random problems with angles should give solutions that satisfy the 
+       constraints, and problems that are well-constrained at the prototype 
+       (independent constraints, 3n-6 of them) should not be reported as 
+       over-constrained or inconsistent."""
+    check = True
+    nwell = 0
+    regressions = 0
+    for seed in range(1, 59, 3):
+        random.seed(seed)
+        problem = random_triangular_problem_3D(7,10.0,0.0,0.5)
+        result = GeometricSolver(problem).get_result()
+        nvars = len(problem.cg.variables())
+        ncons = len(problem.cg.constraints())
+        if constraint_rank(problem) == ncons == 3*nvars-6:
+            nwell += 1
+            if result.flag in [GeometricDecomposition.OVERCONSTRAINED, GeometricDecomposition.INCONSISTENT]:
+                print "seed", seed, "well-constrained, but status:", result.flag
+                regressions += 1
+        for sol in result.solutions:
+            if not problem.verify(sol):
+                print "seed", seed, "solution does not verify"
+                check = False
+    print "angle problems:", regressions, "over-constrained or inconsistent of", nwell, "well-constrained"
+    if check and regressions == 0:
+        print "angle problem solutions valid, no well-constrained problems over-constrained"
+    else:
+        print "INVALID"
+
+def test_scheduler():
+    """Merging with a CostScheduler should give the same top-level 
+       decomposition and valid solutions"""
+    problem = random_distance_problem_3D(8,10.0,0.0)
+    problem.add_constraint(FixConstraint('v0', problem.get_point('v0')))
+    results = []
+    for scheduler in [None, CostScheduler()]:
+        solver = GeometricSolver(problem, scheduler)
+        top = map(lambda c: frozenset(c.vars), solver.dr.top_level())
+        print "scheduled:", scheduler != None, "clusters:", len(solver.dr.clusters()), "methods:", len(solver.dr.methods())
+        results.append((set(top), solver.get_status()))
+    result = solver.get_result()
+    check = results[0] == results[1] and len(result.solutions) > 0
+    for sol in result.solutions:
+        check = check and problem.verify(sol)
+    # batches of six rigids overlapping in three or more points, so that several 
+    # deferred merges are applicable at once
+    points = {}
+    for i in range(10):
+        points["p"+str(i)] = vector([random.uniform(-10.0,10.0) for j in range(3)])
+    batches = []
+    for seed in [86, 89, 105, 126, 145, 199]:
+        generator = random.Random(seed)
+        batches.append([generator.sample(sorted(points), generator.randint(3,6)) for i in range(6)])
+    counts = []
+    for scheduler in [None, CostScheduler()]:
+        nclusters = 0
+        nmethods = 0
+        for rigids in batches:
+            solver = ClusterSolver3D()
+            solver.set_scheduler(scheduler)
+            solver.begin_batch()
+            for var in set(sum(rigids, [])):
+                point = Rigid([var])
+                solver.add(point)
+                solver.set(point, [Configuration({var: points[var]})])
+            for vars in rigids:
+                rigid = Rigid(vars)
+                solver.add(rigid)
+                solver.set(rigid, [Configuration(dict(map(lambda var: (var, points[var]), vars)))])
+            solver.commit()
+            nclusters += len(solver.clusters())
+            nmethods += len(solver.methods())
+            top = list(solver.top_level())
+            solutions = list(solver.get(top[0]))
+            check = check and len(top) == 1 and len(solutions) == 1
+            check = check and tol_eq(solutions[0].rms_distance(Configuration(points)), 0.0)
+        print "scheduled:", scheduler != None, "clusters:", nclusters, "methods:", nmethods
+        counts.append((nclusters, nmethods))
+    check = check and counts[1][0] < counts[0][0] and counts[1][1] < counts[0][1]
+    if check:
+        print "scheduled decomposition equal, fewer clusters and methods"
+    else:
+        print "INVALID"
+
+def parametric_problem():
+    """Returns a random well-constrained problem, one of its distance constraints 
+       and a different value of that distance for which the problem has solutions"""
+    while True:
+        problem = random_triangular_problem_3D(8,10.0,0.0,0.0)
+        problem.add_constraint(FixConstraint('v0', problem.get_point('v0')))
+        constraint = random.choice(filter(lambda c: isinstance(c, DistanceConstraint), problem.cg.constraints()))
+        value = constraint.get_parameter()
+        constraint.set_parameter(value * 1.01)
+        result = GeometricSolver(problem).get_result()
+        constraint.set_parameter(value)
+        if result.flag == "well-constrained" and len(result.solutions) > 0:
+            return (problem, constraint, value * 1.01)
+
+def downstream_methods(solver, constraint):
+    """Returns the set of methods of the cluster solver that depend on a constraint"""
+    clusters = set([solver._map[constraint]])
+    downstream = set()
+    changed = True
+    while changed:
+        changed = False
+        for method in solver.dr.methods():
+            if method not in downstream and len(clusters.intersection(method.inputs())) > 0:
+                downstream.add(method)
+                clusters.update(method.outputs())
+                changed = True
+    return downstream
+
+def input_values(solver, methods):
+    """Returns a dictionary mapping the inputs of the methods to their values"""
+    values = {}
+    for method in methods:
+        for var in method.inputs():
+            values[var] = solver.dr.get(var)
+    return values
+
+def changed_methods(solver, methods, values):
+    """Returns the set of methods with an input whose value differs from the 
+       value in the given dictionary (see input_values)"""
+    changed = lambda var: not equal_configurations(values[var], solver.dr.get(var))
+    return set(filter(lambda method: len(filter(changed, method.inputs())) > 0, methods))
+
+def count_executions(solver):
+    """Counts the executions of the methods of the cluster solver from now on. 
+       Returns a dictionary mapping the executed methods to their number of executions"""
+    counts = {}
+    for method in solver.dr.methods():
+        def execute(inmap, method=method, execute=method.execute):
+            counts[method] = counts.get(method, 0) + 1
+            return execute(inmap)
+        method.execute = execute
+    return counts
+
+def same_solutions(solutions, others):
+    """True iff both lists of solutions have the same length and each solution 
+       is equal to one of the others, modulo rotation and translation"""
+    if len(solutions) != len(others):
+        return False
+    for sol in solutions:
+        if len(filter(lambda other: tol_eq(Configuration(sol).rms_distance(Configuration(other)), 0.0), others)) == 0:
+            return False
+    return True
+
+def test_propagation():
+    """Solutions after a parametric update should be the same as 
+       solutions from scratch, with each method whose inputs changed 
+       executed exactly once and the other methods not executed"""
+    (problem, constraint, value) = parametric_problem()
+    solver = GeometricSolver(problem)
+    downstream = downstream_methods(solver, constraint)
+    values = input_values(solver, downstream)
+    counts = count_executions(solver)
+    constraint.set_parameter(value)
+    executed = solver.dr.propagation_stats()["last"]
+    changed = changed_methods(solver, downstream, values)
+    print "methods executed:", executed, "with changed inputs:", len(changed), "downstream:", len(downstream), "total:", len(solver.dr.methods())
+    result = solver.get_result()
+    fresh = GeometricSolver(problem).get_result()
+    check = 0 < executed == len(counts) and set(counts.values()) == set([1])
+    check = check and set(counts) == changed
+    check = check and len(result.solutions) > 0 and same_solutions(result.solutions, fresh.solutions)
+    for sol in result.solutions:
+        check = check and problem.verify(sol)
+    if check:
+        print "propagated solutions equal"
+    else:
+        print "INVALID"
+
+def test_lazy():
+    """A lazy solver should give the same solutions as an eager solver, 
+       computing only the solutions that are requested, with each method 
+       executed at most once after a parametric update"""
+    (problem, constraint, value) = parametric_problem()
+    eager = GeometricSolver(problem)
+    lazy = GeometricSolver(problem, lazy=True)
+    downstream = downstream_methods(lazy, constraint)
+    values = input_values(lazy, downstream)
+    counts = count_executions(lazy)
+    constraint.set_parameter(value)
+    decomposition = lazy.get_decomposition()
+    check = len(counts) == 0
+    sub = decomposition.subs[0]
+    print "lazy sub-cluster:", len(sub.solutions), "solutions,", 
+    print sum(counts.values()), "methods executed"
+    check = check and decomposition.flag == eager.get_decomposition().flag
+    for sol in decomposition.solutions:
+        check = check and problem.verify(sol)
+    check = check and len(decomposition.solutions) > 0
+    check = check and same_solutions(decomposition.solutions, eager.get_result().solutions)
+    check = check and same_solutions(decomposition.solutions, GeometricSolver(problem).get_result().solutions)
+    check = check and set(counts.values()) == set([1]) 
+    check = check and set(counts).issubset(changed_methods(lazy, downstream, values))
+    if check:
+        print "lazy solutions equal"
+    else:
+        print "INVALID"
+
+def test_memory_budget():
+    """A solver with a memory budget should give the same solutions 
+       as a solver without, using less memory. After a parametric update, 
+       each method with changed inputs should be executed once, and other 
+       methods at most once (to restore evicted values, or because an 
+       evicted input was computed again)"""
+    (problem, constraint, value) = parametric_problem()
+    unbounded = GeometricSolver(problem)
+    unbounded.set_memory_budget(None)
+    bounded = GeometricSolver(problem)
+    bounded.set_memory_budget(10000)
+    downstream = downstream_methods(bounded, constraint)
+    values = input_values(bounded, downstream)
+    counts = count_executions(bounded)
+    constraint.set_parameter(value)
+    executed = dict(counts)
+    changed = changed_methods(bounded, downstream, values)
+    result = bounded.get_result()
+    fresh = unbounded.get_result()
+    before = unbounded.dr.store_stats()
+    after = bounded.dr.store_stats()
+    print "peak memory:", before["peak"], "bytes without budget,", after["peak"], "bytes with budget,",
+    print after["evicted"], "evicted,", after["restored"], "restored"
+    check = after["evicted"] > 0 and after["size"] < before["size"]
+    check = check and set(executed.values()) == set([1]) and changed.issubset(executed)
+    check = check and len(result.solutions) > 0 and same_solutions(result.solutions, fresh.solutions)
+    check = check and same_solutions(result.solutions, GeometricSolver(problem).get_result().solutions)
+    for sol in result.solutions:
+        check = check and problem.verify(sol)
+    if check:
+        print "bounded solutions equal"
+    else:
+        print "INVALID"
+
+def test_executor():
+    """Solvers executing independent merges in threads and processes 
+       should give the same solutions as a solver executing them one by one, 
+       executing each method with changed inputs once after a parametric update"""
+    (problem, constraint, value) = parametric_problem()
+    serial = GeometricSolver(problem)
+    executors = [ThreadExecutor(2), ProcessExecutor(2)]
+    solvers = map(lambda executor: GeometricSolver(problem, executor=executor), executors)
+    downstream = map(lambda solver: downstream_methods(solver, constraint), solvers)
+    values = map(input_values, solvers, downstream)
+    # counted methods cannot be shipped to processes
+    counts = count_executions(solvers[0])
+    constraint.set_parameter(value)
+    check = True
+    for (executor, solver, methods, inputs) in zip(executors, solvers, downstream, values):
+        executed = solver.dr.propagation_stats()["last"]
+        changed = changed_methods(solver, methods, inputs)
+        result = solver.get_result()
+        executor.close()
+        print executor.__class__.__name__+":", len(result.solutions), "solutions,", executed, "methods executed"
+        check = check and 0 < executed == len(changed)
+        if solver == solvers[0]:
+            check = check and set(counts.values()) == set([1]) and set(counts) == changed
+        check = check and len(result.solutions) > 0 and same_solutions(result.solutions, serial.get_result().solutions)
+        for sol in result.solutions:
+            check = check and problem.verify(sol)
+    if check:
+        print "parallel solutions equal"
+    else:
+        print "INVALID"
+
+def test_memo():
+    """Dragging a distance back and forth should reuse remembered merges 
+       and give the same solutions as solving from scratch"""
+    problem = random_triangular_problem_3D(8,10.0,0.0,0.0)
+    problem.add_constraint(FixConstraint('v0', problem.get_point('v0')))
+    set_memo(MemoCache(1000))
+    try:
+        solver = GeometricSolver(problem)
+        constraint = random.choice(filter(lambda c: isinstance(c, DistanceConstraint), problem.cg.constraints()))
+        value = constraint.get_parameter()
+        for parameter in [value * 1.01, value, value * 1.01, value]:
+            constraint.set_parameter(parameter)
+        result = solver.get_result()
+        stats = get_memo().stats()
+    finally:
+        set_memo(None)
+    print "memo:", stats["hits"], "hits,", stats["misses"], "misses"
+    fresh = GeometricSolver(problem).get_result()
+    check = stats["hits"] > 0 and len(result.solutions) == len(fresh.solutions) > 0
+    for sol in result.solutions:
+        check = check and problem.verify(sol)
+    if check:
+        print "remembered solutions equal"
+    else:
+        print "INVALID"
+
+def test_memo_threads():
+    """A MemoCache shared by methods executing in threads should stay consistent 
+       and give the same solutions as solving from scratch"""
+    cache = MemoCache(10)
+    errors = []
+    def hammer(offset):
+        try:
+            for i in range(2000):
+                key = (offset + i) % 25
+                if cache.lookup(key) == None:
+                    cache.store(key, key)
+        except Exception, e:
+            errors.append(e)
+    threads = map(lambda offset: threading.Thread(target=hammer, args=(offset,)), range(8))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    check = len(errors) == 0 and stats["hits"] + stats["misses"] == 8 * 2000 and stats["size"] <= 10
+    problem = random_triangular_problem_3D(8,10.0,0.0,0.0)
+    problem.add_constraint(FixConstraint('v0', problem.get_point('v0')))
+    executor = ThreadExecutor(4)
+    set_memo(MemoCache(1000))
+    try:
+        solver = GeometricSolver(problem, executor=executor)
+        constraint = random.choice(filter(lambda c: isinstance(c, DistanceConstraint), problem.cg.constraints()))
+        value = constraint.get_parameter()
+        for parameter in [value * 1.01, value, value * 1.01, value]:
+            constraint.set_parameter(parameter)
+        result = solver.get_result()
+        stats = get_memo().stats()
+    finally:
+        set_memo(None)
+        executor.close()
+    print "memo in threads:", len(errors), "errors,", stats["hits"], "hits,", stats["misses"], "misses"
+    fresh = GeometricSolver(problem).get_result()
+    check = check and stats["hits"] > 0 and len(result.solutions) == len(fresh.solutions) > 0
+    for sol in result.solutions:
+        check = check and problem.verify(sol)
+    if check:
+        print "remembered solutions in threads equal"
+    else:
+        print "INVALID"
+
+def test_fused():
+    """Merges that select their own solutions should give the same solutions
+       as merges followed by selection methods, with fewer clusters and methods, 
+       executing each method with changed inputs once after a parametric update"""
+    problems = [parametric_problem()]
+    problem = selection_problem()
+    constraint = random.choice(filter(lambda c: isinstance(c, DistanceConstraint), problem.cg.constraints()))
+    problems.append((problem, constraint, constraint.get_parameter() * 1.01))
+    check = True
+    for (problem, constraint, value) in problems:
+        solvers = [GeometricSolver(problem), GeometricSolver(problem, fused_selection=True)]
+        downstream = map(lambda solver: downstream_methods(solver, constraint), solvers)
+        values = map(input_values, solvers, downstream)
+        counts = map(count_executions, solvers)
+        constraint.set_parameter(value)
+        results = []
+        for (solver, methods, inputs, executed) in zip(solvers, downstream, values, counts):
+            print "fused:", solver.dr.is_fused_selection(), "clusters:", len(solver.dr.clusters()), "methods:", len(solver.dr.methods()),
+            print "executed:", solver.dr.propagation_stats()["last"]
+            check = check and 0 < len(executed) == solver.dr.propagation_stats()["last"] 
+            check = check and set(executed.values()) == set([1])
+            check = check and set(executed) == changed_methods(solver, methods, inputs)
+            results.append(solver.get_result())
+        check = check and len(solvers[1].dr.methods()) < len(solvers[0].dr.methods())
+        check = check and len(results[0].solutions) > 0 and same_solutions(results[0].solutions, results[1].solutions)
+        check = check and same_solutions(results[1].solutions, GeometricSolver(problem).get_result().solutions)
+        check = check and results[0].flag == results[1].flag
+        for sol in results[1].solutions:
+            check = check and problem.verify(sol)
+    if check:
+        print "fused solutions equal"
+    else:
+        print "INVALID"
+
+def test_max_solutions():
+    """Without prototype selection, limiting the number of solutions of merges 
+       to one should give one of the solutions found without a limit. The first 
+       solutions of merges are not always compatible, so some limits may have 
+       to be lifted (see test_lift_max_solutions)."""
+    problem = random_triangular_problem_3D(6,10.0,0.0,0.0)
+    solver = GeometricSolver(problem)
+    solver.dr.set_prototype_selection(False)
+    all = solver.get_result().solutions
+    solver.dr.set_max_solutions(1)
+    for cluster in list(solver.dr.top_level()):
+        solver.dr.lift_max_solutions(cluster)
+    limited = solver.get_result().solutions
+    print "max solutions: None ->", len(all), "solutions, 1 ->", len(limited), "solutions"
+    check = len(all) > 1 and len(limited) == 1
+    # without prototype selection, not all solutions satisfy the constraints
+    for sol in limited:
+        check = check and len(filter(lambda other: tol_eq(Configuration(sol).rms_distance(Configuration(other)), 0.0), all)) > 0
+    solver.dr.set_max_solutions(None)
+    check = check and len(solver.get_result().solutions) == len(all)
+    if check:
+        print "limited solutions valid"
+    else:
+        print "INVALID"
+
+def test_lift_max_solutions():
+    """A rigid with two shapes, merged with a limit of one solution, keeps only 
+       one shape. A hedgehog with the angle of the other shape then leaves no 
+       solutions, until the limit of the merge is lifted. Getting the 
+       configurations should not change the limits."""
+    shapes = [{'a':[0,0,0],'b':[4,0,0],'c':[0,3,0],'d':[1,1,2]},
+              {'a':[0,0,0],'b':[4,0,0],'c':[0,3,0],'d':[2,-1,3]}]
+    shapes = map(lambda shape: Configuration(dict(map(lambda var: (var, vector(shape[var])), shape))), shapes)
+    solver = ClusterSolver3D()
+    solver.set_max_solutions(1)
+    rigid = Rigid(['a','b','c','d'])
+    solver.add(rigid)
+    solver.set(rigid, shapes)
+    other = Rigid(['a','b','c','e'])
+    solver.add(other)
+    solver.set(other, [Configuration({'a':vector([0,0,0]), 'b':vector([4,0,0]), 'c':vector([0,3,0]), 'e':vector([-1,2,-2])})])
+    kept = list(solver.get(list(solver.top_level())[0]))
+    dropped = filter(lambda shape: not tol_eq(shape.rms_distance(kept[0]), 0.0), shapes)
+    check = len(kept) == 1 and len(dropped) == 1
+    hog = Hedgehog('a', ['b','d'])
+    solver.add(hog)
+    solver.set(hog, [Configuration(dict(map(lambda var: (var, dropped[0].get(var)), ['a','b','d'])))])
+    limits = lambda: map(lambda m: m.get_max_solutions(), filter(lambda m: isinstance(m, ClusterMethod), solver.methods()))
+    top = list(solver.top_level())
+    check = check and len(top) == 1 and len(solver.get(top[0])) == 0
+    check = check and limits() == [1]*len(limits()) and solver.lifted_methods() == []
+    solutions = list(solver.lift_max_solutions(top[0]))
+    lifted = solver.lifted_methods()
+    print "lifted:", map(str, lifted)
+    check = check and len(solutions) == 1 and tol_eq(solutions[0].rms_distance(dropped[0]), 0.0)
+    check = check and len(lifted) == 1 and lifted[0].get_max_solutions() == None
+    check = check and limits().count(None) == 1 and solver.get_max_solutions() == 1
+    # setting the limit again applies it to the lifted merges too
+    solver.set_max_solutions(1)
+    check = check and solver.lifted_methods() == [] and lifted[0].get_max_solutions() == 1
+    check = check and len(solver.get(top[0])) == 0
+    if check:
+        print "lifted limits consistent"
+    else:
+        print "INVALID"
+
+def test_solution_beam():
+    """Without prototype selection, a beam of two should keep two of the 
+       solutions, nearest to the prototype first"""
+    problem = random_triangular_problem_3D(6,10.0,0.0,0.0)
+    solver = GeometricSolver(problem)
+    solver.dr.set_prototype_selection(False)
+    problem.set_solution_beam(2)
+    ranked = solver.get_result().solutions
+    distances = map(lambda sol: solver.dr.prototype_distance(Configuration(sol)), ranked)
+    problem.set_solution_beam(None)
+    all = solver.get_result().solutions
+    nearest = min(map(lambda sol: solver.dr.prototype_distance(Configuration(sol)), all))
+    print "solution beam: None ->", len(all), "solutions, 2 ->", len(ranked), "solutions,", 
+    print "distances to prototype", distances
+    check = 0 < len(ranked) <= 2 < len(all) and distances == sorted(distances)
+    check = check and abs(distances[0] - nearest) < 1e-6
+    # without prototype selection, not all solutions satisfy the constraints. 
+    # The kept solutions may be placed differently, depending on the 
+    # solutions of the subclusters that they were derived from.
+    for sol in ranked:
+        check = check and len(filter(lambda other: tol_eq(Configuration(sol).rms_distance(Configuration(other)), 0.0), all)) > 0
+    if check:
+        print "nearest solutions kept"
+    else:
+        print "INVALID"
+
+def test_array_backend():
+    """Configurations stored in numpy arrays should give the same solutions 
+       as configurations stored in dictionaries (modulo rotation and translation,
+       because the variables are merged in a different order)"""
+    if configuration.numpy == None:
+        print "array backend: numpy not available, not tested"
+        return
+    problem = random_triangular_problem_3D(8,10.0,0.0,0.0)
+    problem.add_constraint(FixConstraint('v0', problem.get_point('v0')))
+    results = {}
+    for backend in ["dict", "array"]:
+        configuration.set_backend(backend)
+        try:
+            solver = GeometricSolver(problem)
+            results[backend] = solver.get_result().solutions
+            kinds = set(map(lambda conf: conf.__class__, solver.dr.get(iter(solver.dr.top_level()).next())))
+        finally:
+            configuration.set_backend("dict")
+    print "array backend:", len(results["array"]), "solutions with", kinds
+    check = kinds == set([configuration.ArrayConfiguration])
+    check = check and len(results["array"]) == len(results["dict"]) > 0
+    for sol in results["array"]:
+        check = check and problem.verify(sol)
+        check = check and len(filter(lambda other: Configuration(sol) == Configuration(other), results["dict"])) > 0
+    if check:
+        print "array solutions equal"
+    else:
+        print "INVALID"
+
+def test_vector_backend():
+    """Solving with numpy vectors should give the same solutions 
+       as solving with list vectors"""
+    if vectors.numpy == None:
+        print "vector backend: numpy not available, not tested"
+        return
+    problem = random_triangular_problem_3D(8,10.0,0.0,0.0)
+    problem.add_constraint(FixConstraint('v0', problem.get_point('v0')))
+    results = {}
+    for backend in ["list", "numpy"]:
+        vectors.set_backend(backend)
+        try:
+            results[backend] = GeometricSolver(problem).get_result().solutions
+            kinds = set(map(lambda sol: sol['v1'].__class__, results[backend]))
+        finally:
+            vectors.set_backend("list")
+    print "vector backend:", len(results["numpy"]), "solutions with", kinds
+    check = kinds == set([vectors.ndvector])
+    check = check and len(results["numpy"]) == len(results["list"]) > 0
+    for sol in results["numpy"]:
+        check = check and problem.verify(sol)
+        check = check and len(filter(lambda other: Configuration(sol) == Configuration(other), results["list"])) > 0
+    if check:
+        print "numpy vector solutions equal"
+    else:
+        print "INVALID"
+
+def test_configuration_hash():
+    """Rotated and translated configurations, and configurations that differ 
+       by less than the tolerance, should have the same hash and be equal; 
+       configurations with another shape should fail the quick distance test"""
+    points = {}
+    for i in range(10):
+        points[i] = vector([random.uniform(-10.0,10.0) for j in range(3)])
+    conf = Configuration(points)
+    moved = conf.transform(translate_3D(1.0,2.0,3.0).mmul(rotate_3D_x(0.5)).mmul(rotate_3D_z(1.0)))
+    check = hash(moved) == hash(conf) and moved == conf and moved.distances_match(conf)
+    # scale about the centroid, such that the rms distance of the points to the 
+    # centroid is just below and just above a multiple of a half of 1000 * tolerance 
+    centroid = sum(points.values(), vector([0.0,0.0,0.0])) / len(points)
+    radius = math.sqrt(sum(map(lambda p: vectors.norm(p - centroid)**2, points.values())) / len(points))
+    quantum = 1000 * tolerance.default_tol
+    boundary = (math.floor(radius / quantum) + 0.5) * quantum
+    straddling = []
+    for target in [boundary - 0.1 * tolerance.default_tol, boundary + 0.1 * tolerance.default_tol]:
+        scaled = {}
+        for var in points:
+            scaled[var] = centroid + (points[var] - centroid) * (target / radius)
+        straddling.append(Configuration(scaled))
+    (below, above) = straddling
+    check = check and below.coincides(above) and hash(below) == hash(above) and below == above
+    check = check and len(set([below, above])) == 1
+    points[0] = points[0] + vector([1.0,0.0,0.0])
+    other = Configuration(points)
+    check = check and not other.distances_match(conf) and other != conf
+    print "configuration hash: moved", hash(moved) == hash(conf), "straddling", hash(below) == hash(above)
+    if check:
+        print "hashes equal for equal configurations"
+    else:
+        print "INVALID"
+
 def selection_problem():
     """The double tetrahedron problem with selection constraints"""
     
@@ -366,6 +1112,24 @@ def test3d():
     test(fix1_problem_3d())
     test(fix2_problem_3d())
     test(fix3_problem_3d())
+    test_batch()
+    test_selection_removal()
+    test_pattern_network()
+    test_angle_problems()
+    test_scheduler()
+    test_propagation()
+    test_lazy()
+    test_memory_budget()
+    test_executor()
+    test_memo()
+    test_memo_threads()
+    test_fused()
+    test_max_solutions()
+    test_lift_max_solutions()
+    test_solution_beam()
+    test_array_backend()
+    test_vector_backend()
+    test_configuration_hash()
     #test(selection_problem())
     #selection_test()
     #test(overconstrained_tetra())
@@ -8,15 +8,23 @@ import math
 from test_generic import test
 from geosolver.geometric import GeometricProblem, GeometricSolver, DistanceConstraint,AngleConstraint, FixConstraint,RightHandedConstraint
 from geosolver.vector import vector 
-from geosolver.randomproblem import random_triangular_problem_3D, random_distance_problem_3D
+from geosolver.randomproblem import random_triangular_problem_3D, random_distance_problem_3D, random_problem_2D
 from geosolver.diagnostic import diag_select, diag_print
 from geosolver.intersections import distance_2p, angle_3p
+from geosolver import intersections
+from geosolver import vector as vectors
+from geosolver.gmatch import gmatch, imatch, compile_pattern
+from geosolver import clsolver, clsolver3D
+from geosolver.clsolver import CostScheduler
+from geosolver.method import ThreadExecutor, ProcessExecutor
+from geosolver.multimethod import MemoCache, set_memo
+from geosolver import configuration
 from time import time
 
 # create statistics for solving time
 def stats_solving(minsize, maxsize, repeats):
     print "times for solving problems from scratch"
-    print "size \t # \t time \t result"
+    print "size \t # \t time \t result \t redundancy checks"
     for size in range(minsize,maxsize+1):
         for i in range(1,repeats+1):
             problem = random_triangular_problem_3D(size,10.0,0.0,0.0)
@@ -25,7 +33,7 @@ def stats_solving(minsize, maxsize, repeats):
             result = solver.get_status()
             t2 = time()
             t = t2-t1
-            print size,"\t",i,"\t",t,"\t",result
+            print size,"\t",i,"\t",t,"\t",result,"\t",solver.dr.redundancy_stats()
 
 # create statistics for incremental solving time
 def stats_incremental(minsize, maxsize, repeats):
@@ -49,18 +57,213 @@ def stats_incremental(minsize, maxsize, repeats):
 def stats_parametric(minsize, maxsize, repeats):
     #diag_select("clsolver.remove")
     print "times for parameteric updates (one constraint parameter)"
-    print "size \t # \t time \t result"
+    print "size \t # \t time \t result \t methods executed \t skipped"
     for size in range(minsize,maxsize+1):
         for i in range(1,repeats+1):
             problem = random_triangular_problem_3D(size,10.0,0.0,0.0)
             solver = GeometricSolver(problem)
             constraint = random.choice(problem.cg.constraints())
+            executed = solver.dr.propagation_stats()["executed"]
+            skipped = solver.dr.propagation_stats()["skipped"]
             t1 = time()
             constraint.set_parameter(constraint.get_parameter())
             result = solver.get_status()
             t2 = time()
             t = t2-t1
-            print size,"\t",i,"\t",t,"\t",result
+            executed = solver.dr.propagation_stats()["executed"] - executed
+            skipped = solver.dr.propagation_stats()["skipped"] - skipped
+            print size,"\t",i,"\t",t,"\t",result,"\t",executed,"\t",skipped
+
+# compare graph matching with gmatch and the compiled, generating imatch
+def stats_matching(minsize, maxsize, repeats):
+    print "times for pattern matching on reference graphs from solving (gmatch, imatch first, imatch all)"
+    print "size \t # \t graphs \t gmatch \t first \t all \t matches"
+    # the patterns of the 3D methods, which are now matched incrementally
+    patterns = [
+        [["rigid","$r1",["$a","$b","$c"]], ["rigid", "$r2", ["$a", "$b", "$c"]]],
+        [["rigid","$d_ab",["$a", "$b"]], ["rigid", "$d_ac",["$a", "$c"]], ["rigid", "$d_bc",["$b","$c"]]],
+        [["rigid","$t_abc",["$a", "$b", "$c"]], ["rigid","$t_abd",["$a", "$b", "$d"]], ["rigid","$d_cd",["$c", "$d"]]],
+        [["rigid","$d_ab",["$a", "$b"]], ["hedgehog", "$a_abc",["$b", "$a", "$c"]], ["rigid", "$d_bc",["$b","$c"]]],
+        [["hedgehog","$a_cab",["$a", "$c", "$b"]], ["rigid", "$d_ab",["$a", "$b"]], ["rigid", "$d_bc",["$b","$c"]]],
+        [["hedgehog","$a_cab",["$a", "$c", "$b"]], ["hedgehog", "$a_abc",["$b", "$a","$c"]]],
+        [["rigid","$r",["$a","$b"]], ["balloon", "$s", ["$a", "$b"]]]]
+    patterngraphs = map(clsolver.pattern2graph, patterns)
+    compiled = map(compile_pattern, patterngraphs)
+    for size in range(minsize,maxsize+1):
+        for i in range(1,repeats+1):
+            # record the reference graphs of the clusters connected to each new cluster
+            references = []
+            add_cluster = clsolver.ClusterSolver._add_cluster
+            def recorder(solver, newcluster):
+                add_cluster(solver, newcluster)
+                connected = set()
+                for var in newcluster.vars:
+                    connected.update(solver.find_top_level(var))
+                references.append(clsolver.reference2graph(connected))
+            clsolver.ClusterSolver._add_cluster = recorder
+            try:
+                problem = random_triangular_problem_3D(size,10.0,0.0,0.0)
+                solver = GeometricSolver(problem)
+            finally:
+                clsolver.ClusterSolver._add_cluster = add_cluster
+            t1 = time()
+            ngmatch = 0
+            for graph in references:
+                for patterngraph in patterngraphs:
+                    ngmatch += len(gmatch(patterngraph, graph))
+            t2 = time()
+            for graph in references:
+                for pattern in compiled:
+                    for match in imatch(pattern, graph):
+                        break
+            t3 = time()
+            nimatch = 0
+            for graph in references:
+                for pattern in compiled:
+                    nimatch += len(list(imatch(pattern, graph)))
+            t4 = time()
+            print size,"\t",i,"\t",len(references),"\t",t2-t1,"\t",t3-t2,"\t",t4-t3,"\t",ngmatch,"/",nimatch
+
+# compare the number of clusters and methods created with and without scheduling
+def stats_scheduling(minsize, maxsize, repeats):
+    print "clusters and methods created, merging in the order found and with a CostScheduler"
+    print "problem \t size \t # \t clusters \t methods \t time \t scheduled clusters \t methods \t time"
+    for (name, generate) in [("3D", lambda size: random_triangular_problem_3D(size,10.0,0.0,0.5)),
+                             ("2D", lambda size: random_problem_2D(size,10.0,0.0,0.5))]:
+        for size in range(minsize,maxsize+1):
+            for i in range(1,repeats+1):
+                problem = generate(size)
+                row = [name, size, i]
+                for scheduler in [None, CostScheduler()]:
+                    t1 = time()
+                    solver = GeometricSolver(problem, scheduler)
+                    t2 = time()
+                    row += [len(solver.dr.clusters()), len(solver.dr.methods()), t2-t1]
+                print "\t ".join(map(str, row))
+
+# compare the memory used by configurations with and without a memory budget
+def stats_memory(minsize, maxsize, repeats, budget):
+    print "peak memory (bytes) used by configurations, without and with a budget of",budget,"bytes"
+    print "size \t # \t peak \t time \t budget peak \t time \t evicted \t restored"
+    for size in range(minsize,maxsize+1):
+        for i in range(1,repeats+1):
+            problem = random_triangular_problem_3D(size,10.0,0.0,0.0)
+            row = [size, i]
+            for limit in [None, budget]:
+                solver = GeometricSolver(problem)
+                solver.set_memory_budget(limit)
+                t1 = time()
+                constraint = random.choice(problem.cg.constraints())
+                constraint.set_parameter(constraint.get_parameter())
+                solver.get_result()
+                t2 = time()
+                row += [solver.dr.store_stats()["peak"], t2-t1]
+            row += [solver.dr.store_stats()["evicted"], solver.dr.store_stats()["restored"]]
+            print "\t ".join(map(str, row))
+
+# compare the time for re-solving after a global parameter change, with and without parallel execution
+def stats_parallel(minsize, maxsize, repeats, workers):
+    print "times for re-solving after scaling all distances, serial and with",workers,"threads and processes"
+    print "size \t # \t serial \t threads \t processes"
+    executors = [None, ThreadExecutor(workers), ProcessExecutor(workers)]
+    for size in range(minsize,maxsize+1):
+        for i in range(1,repeats+1):
+            problem = random_triangular_problem_3D(size,10.0,0.0,0.0)
+            row = [size, i]
+            for executor in executors:
+                solver = GeometricSolver(problem, executor=executor)
+                t1 = time()
+                problem.begin_batch()
+                for constraint in problem.cg.constraints():
+                    if isinstance(constraint, DistanceConstraint):
+                        constraint.set_parameter(constraint.get_parameter() * 1.1)
+                problem.commit()
+                solver.get_result()
+                t2 = time()
+                row.append(t2-t1)
+            print "\t ".join(map(str, row))
+    for executor in executors[1:]:
+        executor.close()
+
+# compare the time for dragging a distance back and forth, with and without a memo cache
+def stats_memo(minsize, maxsize, repeats, steps):
+    print "times for dragging a distance back and forth in",steps,"steps, without and with a memo cache"
+    print "size \t # \t time \t memo time \t hits \t misses"
+    for size in range(minsize,maxsize+1):
+        for i in range(1,repeats+1):
+            problem = random_triangular_problem_3D(size,10.0,0.0,0.0)
+            constraint = random.choice(filter(lambda c: isinstance(c, DistanceConstraint), problem.cg.constraints()))
+            value = constraint.get_parameter()
+            row = [size, i]
+            for cache in [None, MemoCache(10000)]:
+                set_memo(cache)
+                solver = GeometricSolver(problem)
+                t1 = time()
+                for step in range(steps):
+                    constraint.set_parameter(value * (1.0 + 0.01 * (step % 2)))
+                    solver.get_status()
+                t2 = time()
+                row.append(t2-t1)
+            row += [cache.stats()["hits"], cache.stats()["misses"]]
+            set_memo(None)
+            print "\t ".join(map(str, row))
+
+def stats_backend(minsize, maxsize, repeats):
+    print "times for solving problems with dictionary and numpy array configurations"
+    print "size \t # \t dict time \t array time"
+    for size in range(minsize,maxsize+1):
+        for i in range(1,repeats+1):
+            problem = random_triangular_problem_3D(size,10.0,0.0,0.0)
+            row = [size, i]
+            for backend in ["dict", "array"]:
+                configuration.set_backend(backend)
+                t1 = time()
+                GeometricSolver(problem).get_result()
+                t2 = time()
+                row.append(t2-t1)
+            configuration.set_backend("dict")
+            print "\t ".join(map(str, row))
+
+def stats_vector(calls):
+    print "microseconds per call of intersection functions, with list and numpy vectors"
+    print "function \t list \t numpy"
+    times = {}
+    for backend in ["list", "numpy"]:
+        vectors.set_backend(backend)
+        p = map(lambda i: vectors.vector([random.random() for j in range(3)]), range(4))
+        q = map(lambda i: vectors.vector([random.random() for j in range(2)]), range(2))
+        r = map(lambda point: vectors.norm(point - p[3]) + 0.5, p)
+        benchmarks = [
+            ("distance_2p", lambda: intersections.distance_2p(p[0], p[1])),
+            ("angle_3p", lambda: intersections.angle_3p(p[0], p[1], p[2])),
+            ("cc_int", lambda: intersections.cc_int(q[0], 0.8, q[1], 0.8)),
+            ("sss_int", lambda: intersections.sss_int(p[0], r[0], p[1], r[1], p[2], r[2])),
+            ("make_hcs_3d", lambda: intersections.make_hcs_3d(p[0], p[1], p[2])),
+            ("is_right_handed", lambda: intersections.is_right_handed(p[0], p[1], p[2], p[3])),
+        ]
+        for (name, function) in benchmarks:
+            t1 = time()
+            for i in range(calls):
+                function()
+            t2 = time()
+            times[(name, backend)] = (t2-t1) / calls * 1e6
+    vectors.set_backend("list")
+    for (name, function) in benchmarks:
+        print "\t ".join(map(str, [name, times[(name, "list")], times[(name, "numpy")]]))
+
+def stats_batch(sizes):
+    print "times for intersecting N triples of spheres, one by one and batched"
+    print "N \t single time \t batched time"
+    for n in sizes:
+        p = map(lambda i: map(lambda j: vectors.randvec(3, -3.0, 3.0), range(n)), range(3))
+        r = map(lambda i: map(lambda j: random.uniform(1.0, 4.0), range(n)), range(3))
+        t1 = time()
+        for j in range(n):
+            intersections.sss_int(p[0][j], r[0][j], p[1][j], r[1][j], p[2][j], r[2][j])
+        t2 = time()
+        intersections.sss_int_batch(p[0], r[0], p[1], r[1], p[2], r[2])
+        t3 = time()
+        print "\t ".join(map(str, [n, t2-t1, t3-t2]))
 
 def runstats():
     minsize = 4
@@ -69,6 +272,16 @@ def runstats():
     stats_solving(minsize, maxsize, repeats) 
     stats_incremental(minsize, maxsize, repeats) 
     stats_parametric(minsize, maxsize, repeats) 
+    stats_scheduling(minsize, maxsize, repeats) 
+    stats_memory(minsize, maxsize, repeats, 20000) 
+    stats_parallel(minsize, maxsize, repeats, 4) 
+    stats_memo(minsize, maxsize, repeats, 10) 
+    if configuration.numpy != None:
+        stats_backend(minsize, maxsize, repeats) 
+        stats_vector(10000) 
+        stats_batch([10, 100, 1000, 10000]) 
+    # generic matching of all reference graphs is slow for larger problems
+    stats_matching(minsize, minsize+2, repeats) 
 
 if __name__ == "__main__": 
     runstats()